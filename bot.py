@@ -3,6 +3,7 @@ import logging
 import os
 import re, textwrap 
 from html import unescape, escape
+from email.utils import parsedate_to_datetime
 import random
 import aiohttp
 import pytz
@@ -11,11 +12,11 @@ from pix2text import Pix2Text
 from PIL import Image
 from datetime import datetime
 from google.cloud import texttospeech
-from io import BytesIO
+from io import BytesIO, StringIO
 from aiogram import Bot, Dispatcher, F
 from aiogram.enums import ParseMode, ChatType
 from aiogram.types import (
-    FSInputFile, Message, InlineKeyboardMarkup, InlineKeyboardButton,
+    Message, InlineKeyboardMarkup, InlineKeyboardButton,
     CallbackQuery, BufferedInputFile, ReplyKeyboardRemove,
     ReplyKeyboardMarkup, KeyboardButton
 )
@@ -41,23 +42,49 @@ VOCAB_REMINDERS_FILE = DATA_DIR / "vocab_reminders.json"
 DISABLED_CHATS_FILE = DATA_DIR / "disabled_chats.json"
 UNIQUE_USERS_FILE = DATA_DIR / "unique_users.json"
 UNIQUE_GROUPS_FILE = DATA_DIR / "unique_groups.json"
+BROADCAST_STATE_FILE = DATA_DIR / "broadcast_state.json"
+BROADCAST_RECIPIENTS_FILE = DATA_DIR / "broadcast_recipients.json"
+RATES_FILE = DATA_DIR / "rates.json"
+GEO_LEARNED_FILE = DATA_DIR / "geo_learned.json"
+TRANSLATIONS_FILE = DATA_DIR / "translations.json"
+TTS_CACHE_DIR = DATA_DIR / "tts_cache"
+FILE_IDS_FILE = DATA_DIR / "file_ids.json"
+EXERCISE_BANK_FILE = DATA_DIR / "exercise_bank.json"
+EXERCISE_SEEN_FILE = DATA_DIR / "exercise_seen.json"
+WORD_POOL_FILE = DATA_DIR / "word_pool.json"
+CONTENT_CACHE_FILE = DATA_DIR / "content_cache.json"
+GAZETTEER_FILE = Path(__file__).resolve().parent / "geo" / "cities.json"
 
 import asyncio
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+import math
+import itertools
+import time
 import google.generativeai as genai
 import tempfile
-import requests
 from aiogram.filters import Command
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramMigrateToChat, TelegramRetryAfter
+)
 from pymorphy3 import MorphAnalyzer
 from string import punctuation
 from google.cloud import translate
 from google.oauth2 import service_account
+from google.api_core import exceptions as google_exceptions
 from docx import Document
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
 from PyPDF2 import PdfReader
 import json
+import hashlib
+import threading
+import uuid
 import speech_recognition as sr
 from pydub import AudioSegment
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from dataclasses import dataclass, asdict
+from typing import ClassVar
 dialogue_stats = defaultdict(int)
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
@@ -126,60 +153,61 @@ async def safe_send(chat_id: int, text: str, *, reply_to: int | None = None, mes
                                    **thread_kwargs(message)
                                   )
 
-def web_search(query: str, num_results: int = 5) -> str:
-    """
-    Делает запрос в Google Custom Search JSON API и возвращает
-    конкатенированные сниппеты результатов.
-    """
-    logging.info(f"[web_search] запрос: {query!r}")
-    url = "https://www.googleapis.com/customsearch/v1"
-    params = {
-        "key": GOOGLE_SEARCH_API_KEY,
-        "cx": GOOGLE_CX,
-        "q": query,
-        "num": num_results,
-    }
-    resp = requests.get(url, params=params)
-    logging.info(f"[web_search] status: {resp.status_code}")
-    data = resp.json()
-    snippets = []
-    for item in data.get("items", []):
-        snippets.append(f"- {item['snippet']}")
-    logging.info(f"[web_search] найдено сниппетов: {len(snippets)}")
-    return "\n".join(snippets)
-
-def extract_text_from_file(file_name: str, file_bytes: bytes) -> str:
+def iter_document_pages(file_name: str, file_bytes: bytes):
     """
-    Извлекает текст из файла по его расширению.
-    Поддерживаются .txt, .py, .md, .docx, .pdf.
-    Возвращает строку с содержимым или пустую строку, если не удалось.
+    Извлекает текст из файла по его расширению постранично, отдавая (номер, текст)
+    по мере разбора — PDF не читается дальше, чем нужно вызывающему.
+    Поддерживаются .txt, .py, .md, .docx, .pdf. У PDF страницы настоящие,
+    у остальных форматов — условные части по ~3000 символов.
+    Для неподдерживаемого формата ничего не отдаёт. Блокирующая — звать в пуле потоков.
     """
     ext = file_name.rsplit(".", 1)[-1].lower()
     
     # Текстовые файлы (код, разметка, обычный текст)
     if ext in ("txt", "py", "md"):
         try:
-            return file_bytes.decode("utf-8")
+            text = file_bytes.decode("utf-8")
         except UnicodeDecodeError:
-            return file_bytes.decode("latin-1", errors="ignore")
+            text = file_bytes.decode("latin-1", errors="ignore")
+        # строки читаем по одной, не разрезая весь текст на список заранее
+        yield from split_into_parts(line.rstrip("\n") for line in StringIO(text))
+        return
     
     # DOCX
     if ext == "docx":
         doc = Document(BytesIO(file_bytes))
-        return "\n".join(p.text for p in doc.paragraphs)
+        # doc.paragraphs сразу строит список всех абзацев — идём по XML лениво
+        yield from split_into_parts(
+            Paragraph(p, doc).text for p in doc.element.body.iterchildren(qn("w:p"))
+        )
+        return
     
     # PDF
     if ext == "pdf":
         reader = PdfReader(BytesIO(file_bytes))
-        texts = []
-        for page in reader.pages:
+        for no, page in enumerate(reader.pages, 1):
             page_text = page.extract_text()
             if page_text:
-                texts.append(page_text)
-        return "\n".join(texts)
-    
-    # Если формат не поддерживается
-    return ""
+                yield no, page_text
+
+def split_into_parts(lines, part_chars: int = 3000):
+    """
+    Собирает строки в условные «страницы» для форматов без разбиения на страницы
+    и отдаёт каждую, как только она набралась; пустые части пропускает.
+    """
+    no, buf, size = 0, [], 0
+    for line in lines:
+        buf.append(line)
+        size += len(line) + 1
+        if size >= part_chars:
+            text = "\n".join(buf)
+            buf, size = [], 0
+            if text.strip():
+                no += 1
+                yield no, text
+    text = "\n".join(buf)
+    if text.strip():
+        yield no + 1, text
 
 def detect_lang(text: str) -> str:
     return "ru" if re.search(r"[а-яА-Я]", text) else "en"
@@ -270,7 +298,6 @@ dialogues = load_dialogues()
 load_dotenv(dotenv_path=Path(__file__).resolve().parent / ".env")
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "/root/vandili/key2.json"
 credentials = service_account.Credentials.from_service_account_file("/root/vandili/key.json")
-translate_client = translate.TranslationServiceClient(credentials=credentials)
 
 TOKEN = os.getenv("BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -305,165 +332,185 @@ dp = Dispatcher(storage=MemoryStorage())
 morph = MorphAnalyzer()
 
 genai.configure(api_key=GEMINI_API_KEY)
-# Изменение модели на Gemini 2.5 Pro Experimental
-model = genai.GenerativeModel(model_name="models/gemini-2.5-pro-preview-03-25")
 
+# ---------------------- Профили моделей ---------------------- #
+# Короткие служебные запросы уходят в быструю модель, разговор и сложные
+# рассуждения — в Pro. Профиль выбирается в месте вызова: gemini_generate(..., profile=...).
+GEMINI_PRO_MODEL = os.getenv("GEMINI_PRO_MODEL", "models/gemini-2.5-pro-preview-03-25")
+GEMINI_FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", "models/gemini-2.0-flash")
+
+MODEL_PROFILES = {
+    # подписи к картинкам (до 15 слов)
+    "caption": {"model": GEMINI_FAST_MODEL, "max_output_tokens": 80, "temperature": 1.0},
+    # однострочные задания, определения, слово дня
+    "micro": {"model": GEMINI_FAST_MODEL, "max_output_tokens": 400, "temperature": 0.7},
+    # уроки, квизы, диалоги — объёмно, но без сложных рассуждений
+    "content": {"model": GEMINI_FAST_MODEL, "max_output_tokens": 2048, "temperature": 0.8},
+    # разговор, формулы, вопросы по файлам
+    "pro": {"model": GEMINI_PRO_MODEL},
+}
 
-if os.path.exists(ACHIEVEMENTS_FILE):
-    with open(ACHIEVEMENTS_FILE, "r", encoding="utf-8") as f:
-        user_achievements = json.load(f)
-else:
-    user_achievements = {}
+_profile_models: dict[str, genai.GenerativeModel] = {}
 
-if os.path.exists(REVIEW_STATS_FILE):
-    with open(REVIEW_STATS_FILE, "r", encoding="utf-8") as f:
-        review_stats = json.load(f)
-else:
-    review_stats = {}
+def get_model(profile: str = "pro") -> genai.GenerativeModel:
+    cached = _profile_models.get(profile)
+    if cached is None:
+        spec = MODEL_PROFILES[profile]
+        config = {k: v for k, v in spec.items() if k != "model"}
+        cached = genai.GenerativeModel(model_name=spec["model"], generation_config=config or None)
+        _profile_models[profile] = cached
+    return cached
 
-def load_timezones() -> dict:
-    if not os.path.exists(TIMEZONES_FILE):
-        return {}
-    try:
-        with open(TIMEZONES_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        logging.exception(f"Не удалось загрузить timezones.json: {e}")
-        return {}
+model = get_model("pro")
+
+# ---------------------- Планировщик запросов Gemini ---------------------- #
+from gemini_queue import GeminiScheduler, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+
+GEMINI_RETRYABLE = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+gemini_scheduler = GeminiScheduler(GEMINI_RETRYABLE, throttled=(google_exceptions.ResourceExhausted,))
+
+async def gemini_generate(contents, *, uid=None, priority: int = PRIORITY_INTERACTIVE,
+                          profile: str = "pro", **kwargs):
+    """generate_content_async модели профиля profile через планировщик."""
+    target = get_model(profile)
+    return await gemini_scheduler.submit(
+        lambda: target.generate_content_async(contents, **kwargs), uid=uid, priority=priority
+    )
+
+# ---------------------- Хранилище данных ---------------------- #
+# STORAGE_BACKEND: sqlite (по умолчанию, WAL) или json (старые файлы в DATA_DIR)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+DB_FILE = DATA_DIR / "vandili.db"
+# Как часто (сек) сбрасывать изменения на диск и после скольких изменений сбрасывать досрочно
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "5"))
+PERSIST_DIRTY_THRESHOLD = int(os.getenv("PERSIST_DIRTY_THRESHOLD", "100"))
 
-def save_timezones(timezones: dict):
+from storage import (
+    JsonStorage, SqliteStorage, WriteBehindStore, export_json_files, import_json_files, write_file_atomic
+)
+
+persist = WriteBehindStore(
+    SqliteStorage(DB_FILE) if STORAGE_BACKEND == "sqlite" else JsonStorage(),
+    PERSIST_FLUSH_INTERVAL,
+    PERSIST_DIRTY_THRESHOLD,
+)
+
+# Все коллекции бота; source() читается лениво, поэтому глобальные переменные могут появиться позже
+persist.register("reminders", REMINDERS_FILE, "reminders", lambda: reminders)
+persist.register("stats", STATS_FILE, "document", lambda: stats)
+persist.register("notes", NOTES_FILE, "mapping", lambda: user_notes)
+persist.register("support_map", SUPPORT_MAP_FILE, "support_map", lambda: support_reply_map)
+persist.register("timezones", TIMEZONES_FILE, "mapping", lambda: user_timezones)
+persist.register("progress", PROGRESS_FILE, "mapping", lambda: user_progress)
+persist.register("vocab", VOCAB_FILE, "mapping", lambda: user_vocab)
+persist.register("word_of_day_history", WORD_OF_DAY_HISTORY_FILE, "mapping", lambda: user_word_of_day_history)
+persist.register("review_stats", REVIEW_STATS_FILE, "mapping", lambda: review_stats)
+persist.register("achievements", ACHIEVEMENTS_FILE, "mapping", lambda: user_achievements)
+persist.register("vocab_reminders", VOCAB_REMINDERS_FILE, "mapping", lambda: vocab_reminders_enabled)
+persist.register("disabled_chats", DISABLED_CHATS_FILE, "set", lambda: disabled_chats)
+persist.register("unique_users", UNIQUE_USERS_FILE, "set", lambda: unique_users)
+persist.register("unique_groups", UNIQUE_GROUPS_FILE, "set", lambda: unique_groups)
+persist.register("broadcast", BROADCAST_STATE_FILE, "document", lambda: broadcast_state)
+persist.register("broadcast_recipients", BROADCAST_RECIPIENTS_FILE, "document", lambda: broadcast_recipients)
+persist.register("rates", RATES_FILE, "document", lambda: rates_snapshot)
+persist.register("geo_learned", GEO_LEARNED_FILE, "mapping", lambda: geo_learned)
+persist.register("translations", TRANSLATIONS_FILE, "mapping", lambda: translations_learned)
+persist.register("file_ids", FILE_IDS_FILE, "mapping", lambda: file_id_map)
+persist.register("exercise_bank", EXERCISE_BANK_FILE, "mapping", lambda: exercise_bank_data)
+persist.register("exercise_seen", EXERCISE_SEEN_FILE, "mapping", lambda: exercise_seen)
+persist.register("word_pool", WORD_POOL_FILE, "document", lambda: word_pool_state)
+persist.register("content_cache", CONTENT_CACHE_FILE, "mapping", lambda: content_cache_data)
+
+if isinstance(persist.backend, SqliteStorage) and not persist.backend.get_meta("json_imported"):
+    import_json_files(persist.backend, persist.collections)
+
+def load_collection(name: str, default):
     try:
-        with open(TIMEZONES_FILE, "w", encoding="utf-8") as f:
-            json.dump(timezones, f, ensure_ascii=False, indent=2)
+        data = persist.load(name)
     except Exception as e:
-        logging.exception(f"Не удалось сохранить timezones.json: {e}")
+        logging.exception(f"[STORAGE] Не удалось загрузить {name}: {e}")
+        return default
+    return default if data is None else data
+
+user_achievements = load_collection("achievements", {})
+review_stats = load_collection("review_stats", {})
+
+def load_timezones() -> dict:
+    # ключи — int, как и user_id в обработчиках
+    return {int(k): v for k, v in load_collection("timezones", {}).items()}
+
+def save_timezones(user_id: int | None = None):
+    persist.mark_dirty("timezones", user_id)
 
 # Глобальный словарь для часовых поясов пользователей
 user_timezones = load_timezones()
 
 def load_reminders():
-    if not os.path.exists(REMINDERS_FILE):
-        return []
+    # список словарей [{"user_id": ..., "datetime_utc": ..., "text": ...}]
+    data = load_collection("reminders", [])
     try:
-        with open(REMINDERS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            # data — список словарей [{"user_id": ..., "datetime_utc": ..., "text": ...}]
-            # Превратим datetime_utc обратно в datetime
-            out = []
-            for item in data:
-                dt_str = item["datetime_utc"]
-                dt_obj = datetime.fromisoformat(dt_str)
-                out.append((item["user_id"], dt_obj, item["text"]))
-            return out
+        # Превратим datetime_utc обратно в datetime
+        out = []
+        for item in data:
+            dt_str = item["datetime_utc"]
+            dt_obj = datetime.fromisoformat(dt_str)
+            out.append((item["user_id"], dt_obj, item["text"]))
+        return out
     except:
         return []
 
-def save_reminders():
-    data_to_save = []
-    for (user_id, dt_obj, text) in reminders:
-        data_to_save.append({
-            "user_id": user_id,
-            "datetime_utc": dt_obj.isoformat(),
-            "text": text
-        })
-    try:
-        with open(REMINDERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось сохранить reminders: {e}")
+def save_reminders(user_id: int | None = None):
+    persist.mark_dirty("reminders", user_id)
 
 def load_notes() -> dict:
-    if not os.path.exists(NOTES_FILE):
-        return defaultdict(list)
-    try:
-        with open(NOTES_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return defaultdict(list, {int(k): v for k, v in data.items()})
-    except:
-        return defaultdict(list)
+    data = load_collection("notes", {})
+    return defaultdict(list, {int(k): v for k, v in data.items()})
 
-def save_notes():
-    try:
-        with open(NOTES_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_notes, f, ensure_ascii=False)
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось сохранить заметки: {e}")
+def save_notes(user_id: int | None = None):
+    persist.mark_dirty("notes", user_id)
 
 def load_support_map() -> dict[tuple[int,int], int]:
-    if not os.path.exists(SUPPORT_MAP_FILE):
-        return {}
+    lst = load_collection("support_map", [])  # ожидаем [[chat_id, msg_id, user_id], ...]
     try:
-        lst = json.load(open(SUPPORT_MAP_FILE, encoding="utf-8"))  # ожидаем [[chat_id, msg_id, user_id], ...]
         return {(c, m): u for c, m, u in lst}
     except:
         return {}
 
-def save_support_map():
-    try:
-        lst = [[c, m, u] for (c, m), u in support_reply_map.items()]
-        with open(SUPPORT_MAP_FILE, "w", encoding="utf-8") as f:
-            json.dump(lst, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.exception(f"Ошибка при сохранении support_map: {e}")
+def save_support_map(key: tuple[int, int] | None = None):
+    persist.mark_dirty("support_map", key)
 
 def load_stats() -> dict:
     """
     Загружает основные метрики (messages_total, files_received, commands_used, unique_users) из stats.json.
     """
-    if not os.path.exists(STATS_FILE):
-        return {
-            "messages_total": 0,
-            "files_received": 0,
-            "commands_used": {},
-            "unique_users": []
-        }
-    try:
-        with open(STATS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            data.setdefault("messages_total", 0)
-            data.setdefault("files_received", 0)
-            data.setdefault("commands_used", {})
-            data.setdefault("unique_users", [])  
-            return data
-    except Exception as e:
-        logging.exception(f"Не удалось загрузить stats.json: {e}")
-        return {
-            "messages_total": 0,
-            "files_received": 0,
-            "commands_used": {},
-            "unique_users": []  
-        }
+    data = load_collection("stats", {})
+    data.setdefault("messages_total", 0)
+    data.setdefault("files_received", 0)
+    data.setdefault("commands_used", {})
+    data.setdefault("unique_users", [])
+    return data
 
 def save_stats():
     """
-    Сохраняет текущие метрики (messages_total, files_received, commands_used) в stats.json.
+    Помечает метрики (messages_total, files_received, commands_used) для записи в stats.json.
     """
-    try:
-        with open(STATS_FILE, "w", encoding="utf-8") as f:
-            json.dump(stats, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.exception(f"Не удалось сохранить stats.json: {e}")
+    persist.mark_dirty("stats")
 
 def load_progress() -> dict:
-    if not os.path.exists(PROGRESS_FILE):
-        return {}
-    try:
-        with open(PROGRESS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось загрузить progress.json: {e}")
-        return {}
+    # ключи — int, как и user_id в обработчиках
+    return {int(k): v for k, v in load_collection("progress", {}).items()}
 
-def save_progress(progress: dict):
-    try:
-        with open(PROGRESS_FILE, "w", encoding="utf-8") as f:
-            json.dump(progress, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось сохранить progress.json: {e}")
+def save_progress(user_id: int | None = None):
+    persist.mark_dirty("progress", user_id)
 
-def save_achievements():
-    with open(ACHIEVEMENTS_FILE, "w", encoding="utf-8") as f:
-        json.dump(user_achievements, f, ensure_ascii=False, indent=2)
+def save_achievements(uid: str | None = None):
+    persist.mark_dirty("achievements", uid)
 
 async def check_achievements(user_id: int, message_target):
     uid = str(user_id)
@@ -487,51 +534,171 @@ async def check_achievements(user_id: int, message_target):
     if new_achievements:
         achieved.extend(new_achievements)
         user_achievements[uid] = achieved
-        save_achievements()
+        save_achievements(uid)
         await message_target.answer(
             f"🏆 Новое достижение:\n" + "\n".join(f"• {a}" for a in new_achievements),
             show_alert=True
         )
 
 def load_vocab() -> dict[int, list[dict]]:
-    if not os.path.exists(VOCAB_FILE):
-        return {}
-    try:
-        with open(VOCAB_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return {int(k): v for k, v in data.items()}
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось загрузить vocab: {e}")
-        return {}
+    return {int(k): v for k, v in load_collection("vocab", {}).items()}
+
+def save_vocab(user_id: int | None = None):
+    persist.mark_dirty("vocab", user_id)
 
-def save_vocab(vocab: dict[int, list[dict]]):
+# ---------------------- Индекс повторения слов ---------------------- #
+REVIEW_INTERVAL_DAYS = [0, 1, 2, 4, 7, 14, 30]
+
+def compute_next_due(entry: dict) -> datetime:
+    """
+    Момент (UTC, naive), когда слово снова пора повторить:
+    last_reviewed + интервал по review_level.
+    """
     try:
-        with open(VOCAB_FILE, "w", encoding="utf-8") as f:
-            json.dump(vocab, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось сохранить vocab: {e}")
+        last = datetime.fromisoformat(entry["last_reviewed"])
+    except (KeyError, TypeError, ValueError):
+        last = datetime.utcnow()
+    level = entry.get("review_level", 0)
+    return last + timedelta(days=REVIEW_INTERVAL_DAYS[min(level, len(REVIEW_INTERVAL_DAYS) - 1)])
 
-def save_review_stats():
-    with open(REVIEW_STATS_FILE, "w", encoding="utf-8") as f:
-        json.dump(review_stats, f, ensure_ascii=False, indent=2)
+class VocabDueIndex:
+    """
+    Индекс слов по времени следующего повторения.
+    Записи различаются по постоянному entry["id"]. Элементы (next_due, seq, id)
+    лежат в общей куче (для напоминаний) и в куче пользователя (для /learn_review);
+    при изменении записи кладётся новый элемент, а старый отбрасывается лениво
+    по несовпадению seq. Когда устаревших элементов становится больше живых,
+    куча пересобирается, так что её размер держится на уровне числа слов.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[datetime, int, str]] = []
+        self._user_heaps: dict[int, list[tuple[datetime, int, str]]] = defaultdict(list)
+        self._entries: dict[str, tuple[int, dict, datetime, int]] = {}  # id -> (uid, entry, due, seq)
+        self._by_user: dict[int, set[str]] = defaultdict(set)
+        self._seq = itertools.count()
+
+    def rebuild(self, vocab: dict[int, list[dict]]) -> set[int]:
+        """Строит индекс заново. Возвращает пользователей, чьим записям пришлось выдать id/next_due."""
+        self._heap.clear()
+        self._user_heaps.clear()
+        self._entries.clear()
+        self._by_user.clear()
+        changed = set()
+        for uid, entries in vocab.items():
+            for entry in entries:
+                if "id" not in entry:
+                    entry["id"] = uuid.uuid4().hex
+                    changed.add(uid)
+                if "next_due" not in entry:
+                    # старые записи без next_due — считаем один раз при загрузке
+                    entry["next_due"] = compute_next_due(entry).isoformat()
+                    changed.add(uid)
+                self._put(uid, entry, push=False)
+        self._heap = [(due, seq, eid) for eid, (_, _, due, seq) in self._entries.items()]
+        heapq.heapify(self._heap)
+        for uid, ids in self._by_user.items():
+            heap = self._user_heaps[uid] = [(self._entries[eid][2], self._entries[eid][3], eid) for eid in ids]
+            heapq.heapify(heap)
+        return changed
+
+    def _put(self, uid: int, entry: dict, push: bool = True):
+        item = (datetime.fromisoformat(entry["next_due"]), next(self._seq), entry["id"])
+        self._entries[item[2]] = (uid, entry, item[0], item[1])
+        self._by_user[uid].add(item[2])
+        if push:
+            heapq.heappush(self._heap, item)
+            heapq.heappush(self._user_heaps[uid], item)
+            self._compact(uid)
+
+    def update(self, uid: int, entry: dict):
+        if "id" not in entry:
+            entry["id"] = uuid.uuid4().hex
+        self._put(uid, entry)
+
+    def remove(self, uid: int, entry: dict):
+        self._entries.pop(entry.get("id"), None)
+        self._by_user[uid].discard(entry.get("id"))
+        self._compact(uid)
+
+    def get(self, entry_id: str, uid: int | None = None) -> dict | None:
+        """Живая запись с данным id (None — слово удалено или принадлежит не uid)."""
+        rec = self._entries.get(entry_id)
+        if rec is None or (uid is not None and rec[0] != uid):
+            return None
+        return rec[1]
+
+    def _valid(self, item: tuple[datetime, int, str]) -> tuple | None:
+        rec = self._entries.get(item[2])
+        return rec if rec is not None and rec[3] == item[1] else None
+
+    def _compact(self, uid: int):
+        # лениво удалённых элементов больше, чем живых — пересобираем кучи
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [item for item in self._heap if self._valid(item)]
+            heapq.heapify(self._heap)
+        heap = self._user_heaps.get(uid)
+        if heap is not None and len(heap) > 2 * len(self._by_user[uid]) + 8:
+            heap[:] = [item for item in heap if self._valid(item)]
+            heapq.heapify(heap)
+
+    @staticmethod
+    def _pop_due(heap: list, now: datetime, valid) -> list[tuple]:
+        """
+        Живые созревшие к now элементы кучи (по возрастанию next_due).
+        Они возвращаются обратно — слова остаются к повторению, пока
+        пользователь их не отметит; устаревшие элементы выбрасываются.
+        """
+        out, keep = [], []
+        while heap and heap[0][0] <= now:
+            item = heapq.heappop(heap)
+            rec = valid(item)
+            if rec is None:
+                continue  # запись удалена или перепланирована
+            out.append(rec)
+            keep.append(item)
+        for item in keep:
+            heapq.heappush(heap, item)
+        return out
+
+    def due(self, now: datetime) -> list[tuple[int, dict]]:
+        """Все созревшие к now слова всех пользователей."""
+        return [(rec[0], rec[1]) for rec in self._pop_due(self._heap, now, self._valid)]
+
+    def due_for_user(self, uid: int, now: datetime) -> list[dict]:
+        """Созревшие слова одного пользователя — из его собственной кучи."""
+        heap = self._user_heaps.get(uid)
+        if not heap:
+            return []
+        return [rec[1] for rec in self._pop_due(heap, now, self._valid)]
+
+vocab_due_index = VocabDueIndex()
+
+def refresh_next_due(uid: int, entry: dict):
+    """Пересчитывает next_due после повторения/правки и обновляет индекс."""
+    entry["next_due"] = compute_next_due(entry).isoformat()
+    vocab_due_index.update(uid, entry)
+
+def add_vocab_entry(uid: int, word: str, meaning: str, example: str) -> dict:
+    entry = {
+        "word": word,
+        "meaning": meaning,
+        "example": example,
+        "last_reviewed": datetime.utcnow().isoformat(),
+        "review_level": 0
+    }
+    user_vocab.setdefault(uid, []).append(entry)
+    refresh_next_due(uid, entry)
+    return entry
+
+def save_review_stats(uid: str | None = None):
+    persist.mark_dirty("review_stats", uid)
 
 def load_word_of_day_history() -> dict[int, list[str]]:
-    if not os.path.exists(WORD_OF_DAY_HISTORY_FILE):
-        return {}
-    try:
-        with open(WORD_OF_DAY_HISTORY_FILE, "r", encoding="utf-8") as f:
-            raw = json.load(f)
-            return {int(k): v for k, v in raw.items()}
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось загрузить историю слов дня: {e}")
-        return {}
+    return {int(k): v for k, v in load_collection("word_of_day_history", {}).items()}
 
-def save_word_of_day_history(history: dict[int, list[str]]):
-    try:
-        with open(WORD_OF_DAY_HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось сохранить историю слов дня: {e}")
+def save_word_of_day_history(user_id: int | None = None):
+    persist.mark_dirty("word_of_day_history", user_id)
 
 def normalize_text(text: str) -> str:
     return re.sub(r"[^\w]", "", text.strip().lower())
@@ -592,29 +759,16 @@ vocab_reminders_enabled = {}
 VOCAB_REMINDERS_FILE = VOCAB_REMINDERS_FILE
 
 def load_vocab_reminder_settings():
-    if not os.path.exists(VOCAB_REMINDERS_FILE):
-        return {}
-    try:
-        with open(VOCAB_REMINDERS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось загрузить {VOCAB_REMINDERS_FILE}: {e}")
-        return {}
+    return load_collection("vocab_reminders", {})
 
-def save_vocab_reminder_settings():
-    try:
-        with open(VOCAB_REMINDERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(vocab_reminders_enabled, f)
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось сохранить {VOCAB_REMINDERS_FILE}: {e}")
+def save_vocab_reminder_settings(uid: str | None = None):
+    persist.mark_dirty("vocab_reminders", uid)
 
 vocab_reminders_enabled = load_vocab_reminder_settings()
 stats = load_stats()  # подгружаем основные метрики
 pending_note_or_reminder = {}
 support_mode_users = set()
 support_reply_map = load_support_map()
-chat_history = {}
-user_documents = {}
 user_notes = load_notes()
 reminders = []  # Список кортежей: (user_id, event_utc: datetime, text)
 reminders = load_reminders()
@@ -622,8 +776,143 @@ quiz_storage = {}
 user_progress = load_progress()
 reminder_status = {}
 user_vocab: dict[int, list[dict]] = load_vocab()
+for _uid in vocab_due_index.rebuild(user_vocab):
+    save_vocab(_uid)  # сохраняем выданные старым записям id и next_due
 user_word_of_day_history = load_word_of_day_history()
 user_images_text = {}
+
+# ---------------------- Память диалогов ---------------------- #
+# История разговоров с Gemini живёт в LRU с общим бюджетом по байтам и TTL простоя.
+# Когда история чата не влезает в бюджет токенов, старые реплики в фоне сжимаются
+# быстрой моделью в краткое содержание, а в промпт уходят только оно и свежие реплики.
+CHAT_MEMORY_BUDGET_BYTES = int(os.getenv("CHAT_MEMORY_BUDGET_BYTES", str(8 * 1024 * 1024)))
+CHAT_MEMORY_TTL = 6 * 3600
+CHAT_HISTORY_TOKEN_BUDGET = 3000
+CHAT_KEEP_RECENT_TURNS = 4
+CHAT_MAX_TURNS = 24           # жёсткий предел, если сжатие не успевает
+CHAT_TURN_MAX_CHARS = 4000    # длинные реплики (например, с текстом файла) храним усечёнными
+CHAT_SUMMARY_MAX_CHARS = 1500
+
+def estimate_tokens(text: str) -> int:
+    # грубая оценка: для смеси кириллицы и латиницы ~3 символа на токен
+    return len(text) // 3 + 1
+
+class ChatState:
+    __slots__ = ("turns", "summary", "last_used", "size", "compacting")
+
+    def __init__(self):
+        self.turns: list[dict] = []
+        self.summary = ""
+        self.last_used = time.monotonic()
+        self.size = 0
+        self.compacting = False
+
+    def recount(self) -> int:
+        self.size = len(self.summary.encode()) + sum(len(t["parts"][0].encode()) for t in self.turns)
+        return self.size
+
+    def tokens(self) -> int:
+        return estimate_tokens(self.summary) + sum(estimate_tokens(t["parts"][0]) for t in self.turns)
+
+class ChatMemory:
+    def __init__(self, budget_bytes: int, ttl: float):
+        self.budget = budget_bytes
+        self.ttl = ttl
+        self.chats: OrderedDict[int, ChatState] = OrderedDict()
+        self.total = 0
+        self.evicted = 0
+        self.compactions = 0
+
+    def _sweep(self):
+        deadline = time.monotonic() - self.ttl
+        while self.chats:
+            cid, state = next(iter(self.chats.items()))
+            if state.last_used >= deadline and self.total <= self.budget:
+                break
+            self.chats.popitem(last=False)
+            self.total -= state.size
+            self.evicted += 1
+
+    def _touch(self, cid: int) -> ChatState:
+        state = self.chats.get(cid)
+        if state is None:
+            state = self.chats[cid] = ChatState()
+        state.last_used = time.monotonic()
+        self.chats.move_to_end(cid)
+        return state
+
+    def build(self, cid: int, prompt: str) -> list[dict]:
+        """Контекст для Gemini: краткое содержание, свежие реплики и новый вопрос."""
+        self._sweep()
+        state = self._touch(cid)
+        contents = []
+        if state.summary:
+            contents.append({"role": "user", "parts": [f"Краткое содержание нашего разговора до этого:\n{state.summary}"]})
+            contents.append({"role": "model", "parts": ["Хорошо, учту."]})
+        contents.extend({"role": t["role"], "parts": list(t["parts"])} for t in state.turns)
+        contents.append({"role": "user", "parts": [prompt]})
+        return contents
+
+    def record(self, cid: int, user_text: str, model_text: str):
+        """Сохраняет удачный обмен репликами; при необходимости запускает сжатие."""
+        state = self._touch(cid)
+        before = state.size
+        state.turns.append({"role": "user", "parts": [user_text[:CHAT_TURN_MAX_CHARS]]})
+        state.turns.append({"role": "model", "parts": [model_text[:CHAT_TURN_MAX_CHARS]]})
+        del state.turns[:-CHAT_MAX_TURNS]
+        self.total += state.recount() - before
+        if (state.tokens() > CHAT_HISTORY_TOKEN_BUDGET and len(state.turns) > CHAT_KEEP_RECENT_TURNS
+                and not state.compacting):
+            state.compacting = True
+            asyncio.create_task(self._compact(cid, state))
+        self._sweep()
+
+    def clear(self, cid: int):
+        state = self.chats.pop(cid, None)
+        if state is not None:
+            self.total -= state.size
+
+    async def _compact(self, cid: int, state: ChatState):
+        old = state.turns[:-CHAT_KEEP_RECENT_TURNS]
+        transcript = "\n".join(
+            f"{'Пользователь' if t['role'] == 'user' else 'Ассистент'}: {t['parts'][0]}" for t in old
+        )
+        prompt = (
+            "Сожми историю диалога в краткое содержание до 120 слов на русском. "
+            "Сохрани факты, имена, числа, договорённости и вопросы, оставшиеся без ответа.\n\n"
+            + (f"Предыдущее содержание:\n{state.summary}\n\n" if state.summary else "")
+            + f"Новые реплики:\n{transcript}"
+        )
+        summary = state.summary
+        try:
+            resp = await gemini_generate(
+                [{"role": "user", "parts": [prompt]}], priority=PRIORITY_BACKGROUND, profile="micro"
+            )
+            summary = resp.text.strip() or summary
+            self.compactions += 1
+        except Exception as e:
+            # не удалось сжать — старые реплики просто отбрасываем
+            logging.warning(f"[MEMORY] Не удалось сжать историю чата {cid}: {e}")
+        finally:
+            state.compacting = False
+        # за время сжатия record() мог дописать реплики в конец и срезать начало по
+        # CHAT_MAX_TURNS, поэтому считаем не len(old), а сколько сжатых реплик ещё
+        # стоит в начале истории, и удаляем ровно их
+        drop = 0
+        for turn in old:
+            if drop < len(state.turns) and state.turns[drop] is turn:
+                drop += 1
+        del state.turns[:drop]
+        state.summary = summary[:CHAT_SUMMARY_MAX_CHARS]
+        before = state.size
+        if self.chats.get(cid) is state:
+            self.total += state.recount() - before
+
+    def stats_line(self) -> str:
+        return (f"• чатов {len(self.chats)}, {self.total // 1024} КБ из {self.budget // 1024} КБ\n"
+                f"• сжатий {self.compactions}, вытеснено {self.evicted}")
+
+chat_memory = ChatMemory(CHAT_MEMORY_BUDGET_BYTES, CHAT_MEMORY_TTL)
 _p2t = Pix2Text(use_fast=True)
 
 async def recognize_formula(image_bytes: bytes) -> str | None:
@@ -738,22 +1027,10 @@ def split_steps(raw: str) -> list[tuple[str, str, str]]:
 DISABLED_CHATS_FILE = DISABLED_CHATS_FILE
 
 def load_disabled_chats() -> set:
-    if not os.path.exists(DISABLED_CHATS_FILE):
-        return set()
-    try:
-        with open(DISABLED_CHATS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return set(data)
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось загрузить disabled_chats: {e}")
-        return set()
+    return set(load_collection("disabled_chats", []))
 
-def save_disabled_chats(chats: set):
-    try:
-        with open(DISABLED_CHATS_FILE, "w", encoding="utf-8") as f:
-            json.dump(list(chats), f)
-    except Exception as e:
-        logging.exception(f"[BOT] Не удалось сохранить disabled_chats: {e}")
+def save_disabled_chats(chat_id: int | None = None):
+    persist.mark_dirty("disabled_chats", chat_id)
 
 disabled_chats = load_disabled_chats()
 
@@ -762,40 +1039,16 @@ UNIQUE_USERS_FILE = UNIQUE_USERS_FILE
 UNIQUE_GROUPS_FILE = UNIQUE_GROUPS_FILE
 
 def load_unique_users() -> set:
-    if not os.path.exists(UNIQUE_USERS_FILE):
-        return set()
-    try:
-        with open(UNIQUE_USERS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return set(data)
-    except Exception as e:
-        logging.exception(f"Не удалось загрузить уникальных пользователей: {e}")
-        return set()
+    return set(load_collection("unique_users", []))
 
-def save_unique_users(users: set):
-    try:
-        with open(UNIQUE_USERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(list(users), f)
-    except Exception as e:
-        logging.exception(f"Не удалось сохранить уникальных пользователей: {e}")
+def save_unique_users(user_id: int | None = None):
+    persist.mark_dirty("unique_users", user_id)
 
 def load_unique_groups() -> set:
-    if not os.path.exists(UNIQUE_GROUPS_FILE):
-        return set()
-    try:
-        with open(UNIQUE_GROUPS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return set(data)
-    except Exception as e:
-        logging.exception(f"Не удалось загрузить уникальные группы: {e}")
-        return set()
+    return set(load_collection("unique_groups", []))
 
-def save_unique_groups(groups: set):
-    try:
-        with open(UNIQUE_GROUPS_FILE, "w", encoding="utf-8") as f:
-            json.dump(list(groups), f)
-    except Exception as e:
-        logging.exception(f"Не удалось сохранить уникальные группы: {e}")
+def save_unique_groups(chat_id: int | None = None):
+    persist.mark_dirty("unique_groups", chat_id)
 
 unique_users = load_unique_users()
 unique_groups = load_unique_groups()
@@ -815,20 +1068,18 @@ def _register_message_stats(message: Message):
     if message.chat.type == ChatType.PRIVATE:
         if message.from_user.id not in unique_users:
             unique_users.add(message.from_user.id)
-            save_unique_users(unique_users)
+            save_unique_users(message.from_user.id)
             stats["unique_users"] = list(unique_users)
-            save_stats()
     elif message.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
         if message.chat.id not in unique_groups:
             unique_groups.add(message.chat.id)
-            save_unique_groups(unique_groups)
+            save_unique_groups(message.chat.id)
 
     if message.text and message.text.startswith('/'):
         cmd = message.text.split()[0].strip().lower()
         cmd = cmd.split("@")[0].lstrip("!/")  # удаляем / ! и @VandiliBot
         cmd = f"/{cmd}"  # нормализуем обратно с префиксом
         stats["commands_used"][cmd] = stats["commands_used"].get(cmd, 0) + 1
-        save_stats()
 
 # ---------------------- Функция отправки ответа админа одним сообщением ---------------------- #
 async def send_admin_reply_as_single_message(admin_message: Message, user_id: int, message: Message):
@@ -890,6 +1141,518 @@ def normalize_city_name(raw_city: str) -> str:
             norm_words.append(best.normal_form)
     return " ".join(norm_words)
 
+# ---------------------- HTTP-клиент ---------------------- #
+HTTP_TIMEOUT = aiohttp.ClientTimeout(
+    total=float(os.getenv("HTTP_TIMEOUT", "30")),
+    connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", "10")),
+)
+
+class HttpClient:
+    """
+    Одна aiohttp.ClientSession на всё приложение: keep-alive пул соединений,
+    кэш DNS, лимиты на хост и общие таймауты. Счётчики reused/created по хостам
+    показывают, сколько запросов обошлись без нового TCP/TLS-соединения.
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 20, dns_ttl: int = 300,
+                 timeout: aiohttp.ClientTimeout = HTTP_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.timeout = timeout
+        self.reused: dict[str, int] = defaultdict(int)
+        self.created: dict[str, int] = defaultdict(int)
+        self._session: aiohttp.ClientSession | None = None
+
+    async def _on_request_start(self, session, ctx, params):
+        ctx.host = params.url.host
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self.reused[getattr(ctx, "host", "?")] += 1
+
+    async def _on_connection_create(self, session, ctx, params):
+        self.created[getattr(ctx, "host", "?")] += 1
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # создаётся в main(), но на всякий случай — лениво при первом запросе
+        if self._session is None or self._session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(self._on_request_start)
+            trace.on_connection_reuseconn.append(self._on_connection_reuse)
+            trace.on_connection_create_end.append(self._on_connection_create)
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=30,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout, trace_configs=[trace]
+            )
+        return self._session
+
+    async def start(self):
+        self.session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def stats_lines(self) -> list[str]:
+        hosts = sorted(set(self.reused) | set(self.created),
+                       key=lambda h: self.reused[h] + self.created[h], reverse=True)
+        return [f"• {h}: новых {self.created[h]}, повторно {self.reused[h]}" for h in hosts]
+
+http_client = HttpClient()
+
+async def download_telegram_file(file_id: str) -> bytes:
+    """Скачивает файл Telegram через общий HTTP-пул. При ответе не 2xx бросает aiohttp.ClientResponseError."""
+    tg_file = await bot.get_file(file_id)
+    url = f"https://api.telegram.org/file/bot{TOKEN}/{tg_file.file_path}"
+    async with http_client.session.get(url) as resp:
+        # тело ошибки (JSON Telegram) нельзя выдавать за содержимое файла
+        resp.raise_for_status()
+        return await resp.read()
+
+# ---------------------- Кэш file_id ---------------------- #
+FILE_ID_CACHE_MAX = 20000
+
+class FileIdCache:
+    """
+    Ключ содержимого -> file_id, который Telegram вернул после первой загрузки.
+    Повторная отправка того же файла идёт по file_id, без загрузки байтов.
+    """
+
+    def __init__(self, mapping: dict[str, str]):
+        self.map = mapping
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_key(kind: str, data: bytes | str) -> str:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return f"{kind}:{hashlib.sha256(data).hexdigest()}"
+
+    def get(self, key: str) -> str | None:
+        file_id = self.map.get(key)
+        if file_id:
+            self.hits += 1
+            # переставляем в конец: при переполнении вытесняются давно не использованные
+            self.map[key] = self.map.pop(key)
+        else:
+            self.misses += 1
+        return file_id
+
+    def set(self, key: str, file_id: str):
+        self.map[key] = file_id
+        save_file_ids(key)
+        while len(self.map) > FILE_ID_CACHE_MAX:
+            oldest = next(iter(self.map))
+            del self.map[oldest]
+            save_file_ids(oldest)
+
+    def drop(self, key: str):
+        if self.map.pop(key, None) is not None:
+            save_file_ids(key)
+
+    def stats_line(self) -> str:
+        return f"• по file_id {self.hits}, загрузок {self.misses}, записей {len(self.map)}"
+
+def save_file_ids(key: str | None = None):
+    persist.mark_dirty("file_ids", key)
+
+file_id_map: dict[str, str] = load_collection("file_ids", {})
+file_id_cache = FileIdCache(file_id_map)
+
+async def _send_cached(send, field: str, chat_id: int, data, filename: str, key: str, **kwargs) -> Message:
+    file_id = file_id_cache.get(key)
+    if file_id:
+        try:
+            return await send(chat_id, **{field: file_id}, **kwargs)
+        except TelegramBadRequest as e:
+            logging.warning(f"[FILE_ID] file_id для {key} не подошёл, загружаем заново: {e}")
+            file_id_cache.drop(key)
+
+    if callable(data):
+        data = await data()
+    sent = await send(chat_id, **{field: BufferedInputFile(data, filename=filename)}, **kwargs)
+    media = sent.photo[-1] if field == "photo" and sent.photo else getattr(sent, field, None)
+    if media is not None:
+        file_id_cache.set(key, media.file_id)
+    return sent
+
+async def send_cached_photo(chat_id: int, data, filename: str, key: str | None = None, **kwargs) -> Message:
+    """
+    Отправляет фото через кэш file_id. data — байты или async-функция, которая их вернёт
+    (тогда нужен key: по нему решаем, надо ли вообще готовить картинку).
+    """
+    return await _send_cached(bot.send_photo, "photo", chat_id, data, filename,
+                              key or FileIdCache.content_key("photo", data), **kwargs)
+
+async def send_cached_voice(chat_id: int, data, filename: str, key: str | None = None, **kwargs) -> Message:
+    return await _send_cached(bot.send_voice, "voice", chat_id, data, filename,
+                              key or FileIdCache.content_key("voice", data), **kwargs)
+
+def render_latex_png(latex: str) -> bytes:
+    path = latex_to_png(latex)
+    try:
+        return Path(path).read_bytes()
+    finally:
+        os.remove(path)
+
+async def send_latex_photo(chat_id: int, latex: str, filename: str, **kwargs) -> Message:
+    """Формула рендерится только при промахе кэша file_id."""
+    return await send_cached_photo(
+        chat_id,
+        lambda: asyncio.to_thread(render_latex_png, latex),
+        filename,
+        key=FileIdCache.content_key("latex", latex),
+        **kwargs
+    )
+
+_MISSING = object()
+
+class AsyncTTLCache:
+    """
+    TTL + LRU кэш для результатов корутин.
+    Одновременные запросы с одним ключом объединяются: загрузчик вызывается
+    один раз, остальные ждут его результат.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._inflight: dict = {}
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] <= time.monotonic():
+            return default
+        self._data.move_to_end(key)
+        return item[1]
+
+    def purge(self):
+        """Удаляет просроченные записи (обычно они вытесняются лишь по maxsize)."""
+        now = time.monotonic()
+        for key in [k for k, (expires, _) in self._data.items() if expires <= now]:
+            del self._data[key]
+
+    def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_load(self, key, loader, ttl: float | None = None):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.hits += 1
+            return await asyncio.shield(fut)
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # помечаем как полученное, если никто не ждал
+            raise
+        else:
+            self.set(key, value, ttl)
+            fut.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+# ---------------------- Веб-поиск ---------------------- #
+WEB_SEARCH_TIMEOUT = aiohttp.ClientTimeout(total=10)
+web_search_cache = AsyncTTLCache(ttl=float(os.getenv("WEB_SEARCH_CACHE_TTL", "600")), maxsize=256)
+
+async def _google_search(query: str, num_results: int) -> str:
+    url = "https://www.googleapis.com/customsearch/v1"
+    params = {
+        "key": GOOGLE_SEARCH_API_KEY,
+        "cx": GOOGLE_CX,
+        "q": query,
+        "num": num_results,
+    }
+    async with http_client.session.get(url, params=params, timeout=WEB_SEARCH_TIMEOUT) as resp:
+        logging.info(f"[web_search] status: {resp.status}")
+        resp.raise_for_status()
+        data = await resp.json()
+    snippets = []
+    for item in data.get("items", []):
+        snippets.append(f"- {item['snippet']}")
+    logging.info(f"[web_search] найдено сниппетов: {len(snippets)}")
+    return "\n".join(snippets)
+
+async def web_search(query: str, num_results: int = 5) -> str:
+    """
+    Делает запрос в Google Custom Search JSON API и возвращает
+    конкатенированные сниппеты результатов.
+    Результаты кэшируются по нормализованному запросу; ошибки не кэшируются.
+    """
+    key = (" ".join(query.lower().split()), num_results)
+    logging.info(f"[web_search] запрос: {query!r}")
+    try:
+        return await web_search_cache.get_or_load(key, lambda: _google_search(query, num_results))
+    except Exception as e:
+        logging.error(f"[web_search] ошибка запроса: {e}")
+        return ""
+
+# ---------------------- Поиск по документам ---------------------- #
+# Загруженный файл один раз режется на фрагменты и индексируется (BM25) в отдельном
+# потоке; на вопрос в Gemini уходят только самые релевантные фрагменты со ссылками
+# на страницы. Документы живут DOCUMENT_TTL с последней загрузки.
+DOCUMENT_TTL = 2 * 3600
+DOCUMENT_MAX = 500
+DOCUMENT_INLINE_CHARS = 12000   # небольшой файл проще отправить целиком
+DOCUMENT_TOP_K = 5
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP = 200
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+_STOP_TERMS = {
+    "и", "в", "во", "на", "не", "что", "как", "это", "по", "из", "за", "для", "от", "до", "или",
+    "the", "a", "an", "of", "to", "in", "on", "and", "or", "is", "are", "for", "with", "what",
+}
+
+def index_terms(text: str) -> list[str]:
+    # грубый стемминг префиксом: работает и для русского, и для английского без словарей
+    return [w[:6] for w in _TERM_RE.findall(text.lower()) if w not in _STOP_TERMS and len(w) > 1]
+
+def chunk_pages(pages: list[tuple[int, str]]) -> list[tuple[int, str]]:
+    """Режет страницы на фрагменты ~CHUNK_CHARS с перекрытием, по границам абзацев и предложений."""
+    chunks = []
+    for page_no, text in pages:
+        text = text.strip()
+        start = 0
+        while start < len(text):
+            end = min(len(text), start + CHUNK_CHARS)
+            if end < len(text):
+                window = text[start:end]
+                cut = max(window.rfind("\n\n"), window.rfind(". "), window.rfind("\n"))
+                if cut > CHUNK_CHARS // 2:
+                    end = start + cut + 1
+            piece = text[start:end].strip()
+            if piece:
+                chunks.append((page_no, piece))
+            if end >= len(text):
+                break
+            start = max(end - CHUNK_OVERLAP, start + 1)
+            # перекрытие начинаем с границы слова
+            space = text.find(" ", start, end)
+            if space != -1:
+                start = space + 1
+    return chunks
+
+class DocumentIndex:
+    def __init__(self, name: str, page_label: str, chunks: list[tuple[int, str]], complete: bool = True):
+        self.name = name
+        self.page_label = page_label
+        self.chunks = chunks
+        self.complete = complete  # False — индекс по началу файла, пока дочитывается остальное
+        self.total_chars = sum(len(c) for _, c in chunks)
+        self.postings: dict[str, list[tuple[int, int]]] = defaultdict(list)
+        self.lengths: list[int] = []
+        for idx, (_, text) in enumerate(chunks):
+            terms = index_terms(text)
+            self.lengths.append(len(terms))
+            counts: dict[str, int] = defaultdict(int)
+            for t in terms:
+                counts[t] += 1
+            for t, tf in counts.items():
+                self.postings[t].append((idx, tf))
+        self.avg_len = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+    @classmethod
+    def build(cls, name: str, pages: list[tuple[int, str]], page_label: str = "стр.",
+              complete: bool = True) -> "DocumentIndex":
+        return cls(name, page_label, chunk_pages(pages), complete)
+
+    def search(self, query: str, k: int = DOCUMENT_TOP_K) -> list[int]:
+        n = len(self.chunks)
+        scores: dict[int, float] = defaultdict(float)
+        for term in set(index_terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for idx, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[idx] / (self.avg_len or 1))
+                scores[idx] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+        return [idx for idx, _ in best]
+
+    def context_for(self, query: str) -> str:
+        """Текст документа для промпта: целиком, если он мал, иначе top-k фрагментов по порядку.
+        Каждый фрагмент помечен номером страницы, чтобы модель могла на него сослаться."""
+        if self.total_chars <= DOCUMENT_INLINE_CHARS:
+            hits = range(len(self.chunks))
+        else:
+            hits = sorted(self.search(query) or range(min(DOCUMENT_TOP_K, len(self.chunks))))
+        return "\n\n".join(f"[{self.page_label} {self.chunks[i][0]}] {self.chunks[i][1]}" for i in hits)
+
+user_documents = AsyncTTLCache(ttl=DOCUMENT_TTL, maxsize=DOCUMENT_MAX)
+
+DOCUMENT_MAX_BYTES = int(os.getenv("DOCUMENT_MAX_BYTES", str(20 * 1024 * 1024)))
+DOCUMENT_MAX_PAGES = int(os.getenv("DOCUMENT_MAX_PAGES", "300"))
+DOCUMENT_MAX_CHARS = int(os.getenv("DOCUMENT_MAX_CHARS", "2000000"))
+DOCUMENT_EARLY_PAGES = 10       # после стольких страниц можно задавать вопросы
+DOCUMENT_CACHE_TTL = 24 * 3600
+
+# разбор PDF/DOCX — в отдельных потоках, event loop только собирает страницы
+document_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DOCUMENT_WORKERS", "2")), thread_name_prefix="doc-extract"
+)
+# готовые индексы по file_unique_id: повторно присланный или пересланный файл не разбираем
+document_cache = AsyncTTLCache(ttl=DOCUMENT_CACHE_TTL, maxsize=100)
+_document_jobs: dict[str, asyncio.Future] = {}
+
+def _extract_pages_worker(file_name: str, file_bytes: bytes, loop, queue: asyncio.Queue,
+                          stop: threading.Event):
+    """
+    Выполняется в document_executor: отдаёт страницы в queue по мере разбора.
+    Если stop выставлен (обработчик отменён или больше не читает), бросает разбор
+    на следующей странице, не занимая поток до конца файла.
+    """
+    def put(item):
+        if not stop.is_set():
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+    pages = chars = 0
+    try:
+        for no, text in iter_document_pages(file_name, file_bytes):
+            if stop.is_set():
+                return
+            if pages >= DOCUMENT_MAX_PAGES or chars >= DOCUMENT_MAX_CHARS:
+                put(("done", True))
+                return
+            pages += 1
+            chars += len(text)
+            put(("page", (no, text)))
+        put(("done", False))
+    except Exception as e:
+        put(("error", e))
+
+async def _build_index(name: str, pages: list[tuple[int, str]], label: str, complete: bool) -> DocumentIndex:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(document_executor, DocumentIndex.build, name, pages, label, complete)
+
+async def process_document(message: Message, uid: int):
+    """
+    Принимает файл: берёт индекс из кэша по file_unique_id или разбирает файл
+    постранично в пуле потоков. Как только прочитано DOCUMENT_EARLY_PAGES страниц,
+    пользователь может задавать вопросы по началу файла.
+    """
+    doc = message.document
+    file_name = doc.file_name or "file"
+    key = doc.file_unique_id
+
+    cached = document_cache.get(key)
+    if cached is None and key in _document_jobs:
+        # тот же файл уже разбирается (например, переслали дважды подряд)
+        cached = await asyncio.shield(_document_jobs[key])
+    if cached is not None:
+        user_documents.set(uid, cached)
+        await message.answer("✅ Файл получен! Можешь задать вопрос по его содержимому.", **thread_kwargs(message))
+        return
+
+    if doc.file_size and doc.file_size > DOCUMENT_MAX_BYTES:
+        await message.answer(
+            f"⚠️ Файл слишком большой (больше {DOCUMENT_MAX_BYTES // (1024 * 1024)} МБ).",
+            **thread_kwargs(message)
+        )
+        return
+
+    job = _document_jobs[key] = asyncio.get_running_loop().create_future()
+    index = None
+    stop_extract = None
+    try:
+        try:
+            file_bytes = await download_telegram_file(doc.file_id)
+        except aiohttp.ClientError as e:
+            logging.warning(f"[DOCUMENT] Не удалось скачать {file_name}: {e}")
+            await message.answer("⚠️ Не удалось скачать файл, попробуй отправить его ещё раз.", **thread_kwargs(message))
+            return
+        label = "стр." if file_name.lower().endswith(".pdf") else "часть"
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop_extract = threading.Event()
+        loop.run_in_executor(
+            document_executor, _extract_pages_worker, file_name, file_bytes, loop, queue, stop_extract
+        )
+
+        pages: list[tuple[int, str]] = []
+        early_sent = truncated = failed = False
+        while True:
+            kind, payload = await queue.get()
+            if kind == "page":
+                pages.append(payload)
+                # страница сверх порога — значит файл длиннее, отдаём начало заранее
+                if not early_sent and len(pages) == DOCUMENT_EARLY_PAGES + 1:
+                    early = await _build_index(file_name, list(pages), label, False)
+                    user_documents.set(uid, early)
+                    early_sent = True
+                    await message.answer(
+                        f"✅ Прочитал начало файла ({label} 1–{pages[-1][0]}) — уже можно задавать вопросы, "
+                        "остальное дочитываю…",
+                        **thread_kwargs(message)
+                    )
+                continue
+            if kind == "error":
+                logging.warning(f"[DOCUMENT] Ошибка разбора {file_name}: {payload}")
+                failed = True
+            else:
+                truncated = payload is True
+            break
+
+        if not pages:
+            await message.answer("⚠️ Не удалось извлечь текст из файла.", **thread_kwargs(message))
+            return
+
+        if failed:
+            # неполный индекс не кэшируем: при повторной отправке файл разберём заново
+            partial = await _build_index(file_name, pages, label, False)
+            user_documents.purge()
+            user_documents.set(uid, partial)
+            await message.answer(
+                f"⚠️ Разбор файла прервался на {label} {pages[-1][0]} — вопросы можно задавать "
+                "только по уже прочитанной части.",
+                **thread_kwargs(message)
+            )
+            return
+
+        index = await _build_index(file_name, pages, label, True)
+        document_cache.set(key, index)
+        user_documents.purge()
+        user_documents.set(uid, index)
+        note = f"\nОбработаны только первые {len(pages)} ({label}) — файл превышает лимит." if truncated else ""
+        if early_sent:
+            await message.answer(f"✅ Файл обработан полностью.{note}", **thread_kwargs(message))
+        else:
+            await message.answer(f"✅ Файл получен! Можешь задать вопрос по его содержимому.{note}", **thread_kwargs(message))
+    finally:
+        if stop_extract is not None:
+            stop_extract.set()  # после отмены или ошибки поток разбора больше не нужен
+        _document_jobs.pop(key, None)
+        if not job.done():
+            job.set_result(index)
+
 # ---------------------- Словарь базовых форм валют (расширенный) ---------------------- #
 # Добавлено правило для "долар" с одной "л" для обработки опечаток
 CURRENCY_SYNONYMS = {
@@ -909,62 +1672,122 @@ CURRENCY_SYNONYMS = {
     "¥": "JPY",
 }
 
-async def get_floatrates_rate(from_curr: str, to_curr: str) -> float:
-    from_curr = from_curr.lower()
-    to_curr = to_curr.lower()
-    url = f"https://www.floatrates.com/daily/{from_curr}.json"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    logging.exception(f"Floatrates вернул статус {resp.status} для {url}")
-                    return None
-                data = await resp.json()
-    except Exception as e:
-        logging.error(f"Ошибка при запросе к Floatrates: {e}")
-        return None
-    if to_curr not in data:
-        return None
-    rate = data[to_curr].get("rate")
-    if rate is None:
-        return None
-    return float(rate)
+# ---------------------- Курсы валют ---------------------- #
+RATES_BASE = "USD"
+RATES_REFRESH_INTERVAL = float(os.getenv("RATES_REFRESH_INTERVAL", str(6 * 3600)))  # floatrates обновляется раз в сутки
+RATES_RETRY_INTERVAL = 15 * 60
+
+class RatesService:
+    """
+    Держит в памяти полную таблицу курсов к одной базовой валюте (USD)
+    и считает любую пару как кросс-курс. Таблица обновляется в фоне,
+    последний удачный снимок сохраняется через persist — им отвечаем
+    при холодном старте и когда источники недоступны.
+    """
+
+    def __init__(self, snapshot: dict):
+        self.snapshot = snapshot  # {"base", "rates": {code: units per base}, "date", "fetched_at"}
+        self._lock = asyncio.Lock()
+
+    @property
+    def rates(self) -> dict[str, float]:
+        return self.snapshot.get("rates", {})
+
+    def is_fresh(self) -> bool:
+        fetched_at = self.snapshot.get("fetched_at")
+        if not fetched_at:
+            return False
+        age = datetime.utcnow() - datetime.fromisoformat(fetched_at)
+        return age.total_seconds() < RATES_REFRESH_INTERVAL
+
+    async def _fetch_floatrates(self) -> tuple[dict[str, float], str] | None:
+        url = f"https://www.floatrates.com/daily/{RATES_BASE.lower()}.json"
+        async with http_client.session.get(url) as resp:
+            if resp.status != 200:
+                logging.warning(f"[RATES] Floatrates вернул статус {resp.status}")
+                return None
+            data = await resp.json(content_type=None)
+        rates = {item["code"].upper(): float(item["rate"]) for item in data.values() if item.get("rate")}
+        date = datetime.utcnow().strftime("%d.%m.%Y")
+        any_item = next(iter(data.values()), {})
+        if any_item.get("date"):
+            try:
+                date = parsedate_to_datetime(any_item["date"]).strftime("%d.%m.%Y")
+            except (TypeError, ValueError):
+                pass
+        return rates, date
+
+    async def _fetch_exchangerate_host(self) -> tuple[dict[str, float], str] | None:
+        url = f"https://api.exchangerate.host/latest?base={RATES_BASE}"
+        async with http_client.session.get(url) as resp:
+            if resp.status != 200:
+                logging.warning(f"[RATES] exchangerate.host вернул статус {resp.status}")
+                return None
+            data = await resp.json(content_type=None)
+        if not data.get("rates"):
+            return None
+        rates = {code.upper(): float(rate) for code, rate in data["rates"].items()}
+        api_date = data.get("date") or datetime.utcnow().strftime("%Y-%m-%d")
+        return rates, datetime.fromisoformat(api_date).strftime("%d.%m.%Y")
+
+    async def refresh(self) -> bool:
+        async with self._lock:
+            for source in (self._fetch_floatrates, self._fetch_exchangerate_host):
+                try:
+                    result = await source()
+                except Exception as e:
+                    logging.warning(f"[RATES] Ошибка источника {source.__name__}: {e}")
+                    continue
+                if result:
+                    rates, date = result
+                    rates[RATES_BASE] = 1.0
+                    self.snapshot.update({
+                        "base": RATES_BASE,
+                        "rates": rates,
+                        "date": date,
+                        "fetched_at": datetime.utcnow().isoformat(),
+                    })
+                    persist.mark_dirty("rates")
+                    logging.info(f"[RATES] Таблица обновлена: {len(rates)} валют на {date}")
+                    return True
+            return False
+
+    def convert(self, amount: float, from_code: str, to_code: str) -> tuple[float, str] | None:
+        rates = self.rates
+        if from_code not in rates or to_code not in rates:
+            return None
+        return amount * rates[to_code] / rates[from_code], self.snapshot.get("date", "")
+
+    async def run(self):
+        while True:
+            if self.is_fresh():
+                delay = RATES_REFRESH_INTERVAL - (
+                    datetime.utcnow() - datetime.fromisoformat(self.snapshot["fetched_at"])
+                ).total_seconds()
+            else:
+                delay = RATES_REFRESH_INTERVAL if await self.refresh() else RATES_RETRY_INTERVAL
+            await asyncio.sleep(max(delay, 60))
+
+rates_snapshot: dict = load_collection("rates", {})
+rates_service = RatesService(rates_snapshot)
 
 async def get_exchange_rate(amount: float, from_curr: str, to_curr: str) -> str:
     # 1) Получаем стандартные коды валют
     from_code = CURRENCY_SYNONYMS.get(from_curr.lower(), from_curr.upper())
     to_code   = CURRENCY_SYNONYMS.get(to_curr.lower(),   to_curr.upper())
 
-    # 2) Пробуем floatrates.com
-    rate = await get_floatrates_rate(from_code, to_code)
-    if rate is not None:
-        result = amount * rate
-        date = datetime.now().strftime("%d.%m.%Y")
+    # 2) Кросс-курс из таблицы в памяти; пустую таблицу (первый запуск) подгружаем один раз
+    if not rates_service.rates:
+        await rates_service.refresh()
+    converted = rates_service.convert(amount, from_code, to_code)
+    if converted is not None:
+        result, date = converted
         return (
             f"Курс {amount:.0f} {from_code} → {result:.2f} {to_code} на {date} 😊\n"
             "Курс в банках и на биржах может отличаться."
         )
 
-    # 3) Fallback — пробуем exchangerate.host
-    url = f"https://api.exchangerate.host/convert?from={from_code}&to={to_code}&amount={amount}"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                data = await resp.json()
-        if resp.status == 200 and data.get("result") is not None:
-            converted = data["result"]
-            # API возвращает поле 'date' в формате YYYY-MM-DD
-            api_date = data.get("date", datetime.now().strftime("%Y-%m-%d"))
-            # приводим к дд.мм.гггг
-            date = datetime.fromisoformat(api_date).strftime("%d.%m.%Y")
-            return (
-                f"Курс {amount:.0f} {from_code} → {converted:.2f} {to_code} на {date} 😊\n"
-                "Курс в банках и на биржах может отличаться."
-            )
-    except Exception:
-        pass
-
-    # 4) Если ни floatrates, ни exchangerate.host не сработали:
+    # 3) Если таблицы нет или валюты в ней нет:
     return "❌ Не удалось получить курс валют. Попробуй чуть позже."
 # Новый универсальный шаблон для запроса курса валют
 # Он обрабатывает запросы вида: "1 доллар сум" и "1 доллар в сум", а также с английскими обозначениями.
@@ -980,14 +1803,14 @@ EXCHANGE_PATTERN = re.compile(
 
 # ---------------------- Функции для погоды ---------------------- #
 async def do_geocoding_request(name: str) -> dict:
-    url = f"https://geocoding-api.open-meteo.com/v1/search?name={name}"
+    url = "https://geocoding-api.open-meteo.com/v1/search"
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    logging.exception(f"Ошибка геокодинга для {name}: статус {resp.status}")
-                    return None
-                geo_data = await resp.json()
+        # language=ru — каноническое название приходит по-русски, как в справочнике
+        async with http_client.session.get(url, params={"name": name, "language": "ru"}) as resp:
+            if resp.status != 200:
+                logging.exception(f"Ошибка геокодинга для {name}: статус {resp.status}")
+                return None
+            geo_data = await resp.json()
     except Exception as e:
         logging.error(f"Ошибка запроса геокодинга: {e}")
         return None
@@ -995,6 +1818,7 @@ async def do_geocoding_request(name: str) -> dict:
         return None
     best = geo_data["results"][0]
     return {
+        "name": best.get("name", name),
         "lat": best["latitude"],
         "lon": best["longitude"],
         "timezone": best.get("timezone", "Europe/Moscow")
@@ -1016,50 +1840,127 @@ def simple_transliterate(s: str) -> str:
         result.append(translit_map.get(lower_ch, ch))
     return "".join(result)
 
+# ---------------------- Локальный справочник городов ---------------------- #
+def normalize_place_key(name: str) -> str:
+    name = name.lower().replace("ё", "е")
+    name = re.sub(r"[-‐–—_.,]+", " ", name)
+    return " ".join(name.split())
+
+class CityIndex:
+    """
+    Префиксное дерево названий городов (русские, английские, транслит, синонимы).
+    Узел — dict «символ -> узел», ключ "" хранит номер места в self.places,
+    так что разные написания одного города ссылаются на одну запись.
+    """
+
+    def __init__(self):
+        self.root: dict = {}
+        self.places: list[dict] = []  # {"name", "lat", "lon", "timezone"}
+
+    def add(self, names: list[str], place: dict):
+        idx = len(self.places)
+        self.places.append(place)
+        for name in names:
+            key = normalize_place_key(name)
+            if not key:
+                continue
+            node = self.root
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node[""] = idx
+
+    def _node(self, key: str) -> dict | None:
+        node = self.root
+        for ch in key:
+            node = node.get(ch)
+            if node is None:
+                return None
+        return node
+
+    def complete(self, prefix: str, limit: int = 10) -> list[dict]:
+        """
+        Места, у которых какое-то из названий начинается с prefix.
+        Только для подсказок: недописанное название может относиться к другому
+        городу («кемер» — не Кемерово), поэтому lookup() префиксы не засчитывает.
+        """
+        node = self._node(normalize_place_key(prefix))
+        if node is None:
+            return []
+        found: list[int] = []
+        stack = [node]
+        while stack and len(found) < limit:
+            cur = stack.pop()
+            for ch, child in cur.items():
+                if ch == "":
+                    if child not in found:
+                        found.append(child)
+                else:
+                    stack.append(child)
+        return [self.places[i] for i in found[:limit]]
+
+    def lookup(self, name: str) -> dict | None:
+        """Место с точно таким названием или синонимом; остальное решает сетевой геокодер."""
+        node = self._node(normalize_place_key(name))
+        if node is not None and "" in node:
+            return self.places[node[""]]
+        return None
+
+def load_city_index() -> CityIndex:
+    index = CityIndex()
+    try:
+        with open(GAZETTEER_FILE, "r", encoding="utf-8") as f:
+            cities = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"[GEO] Не удалось загрузить справочник городов: {e}")
+        cities = []
+    for city in cities:
+        names = [city["ru"], city["en"], simple_transliterate(city["ru"]), *city.get("aliases", [])]
+        index.add(names, {"name": city["ru"], "lat": city["lat"], "lon": city["lon"], "timezone": city["tz"]})
+    # города, которые уже находили через сеть
+    for name, place in geo_learned.items():
+        index.add([name], place)
+    return index
+
+def learn_place(place: dict):
+    """Запоминает найденное через сеть место под его каноническим названием."""
+    key = normalize_place_key(place.get("name", ""))
+    if not key:
+        return
+    geo_learned[key] = place
+    save_geo_learned(key)
+    city_index.add([key], place)
+
+def save_geo_learned(key: str | None = None):
+    persist.mark_dirty("geo_learned", key)
+
+geo_learned: dict[str, dict] = load_collection("geo_learned", {})
+city_index = load_city_index()
+
 async def geocode_city(city_name: str) -> dict:
     city_name = city_name.strip().lower()
 
-    # Исключения, чтобы не ломать явно известные города
-    KNOWN_CITIES = {
-        "москва": "Europe/Moscow",
-        "ташкент": "Asia/Tashkent",
-        "санкт-петербург": "Europe/Saint Petersburg",
-        "петербург": "Europe/Saint Petersburg",
-        "сеул": "Asia/Seoul",
-        "алматы": "Asia/Almaty",
-        "астана": "Asia/Astana"
-    }
+    # Сначала локальный справочник — без сетевых запросов
+    place = city_index.lookup(city_name)
+    if place:
+        return place
 
-    if city_name in KNOWN_CITIES:
-        return {
-            "lat": 0,
-            "lon": 0,
-            "timezone": KNOWN_CITIES[city_name]
-        }
+    result = await geocode_city_online(city_name)
+    if result:
+        learn_place(result)
+    return result
 
+async def geocode_city_online(city_name: str) -> dict:
     # 1. Сначала пробуем как есть
     result = await do_geocoding_request(city_name)
     if result:
         return result
 
     # 2. Пробуем перевод через Google Translate
-    try:
-        project_id = "gen-lang-client-0588633435"
-        location = "global"
-        parent = f"projects/{project_id}/locations/{location}"
-        response = translate_client.translate_text(
-            parent=parent,
-            contents=[city_name],
-            mime_type="text/plain",
-            source_language_code="ru",
-            target_language_code="en",
-        )
-        translated = response.translations[0].translated_text
+    translated = await translator.translate(city_name)
+    if translated and translated.lower() != city_name:
         result = await do_geocoding_request(translated)
         if result:
             return result
-    except Exception as e:
-        logging.exception(f"[BOT] Ошибка перевода города '{city_name}': {e}")
 
     # 3. Пробуем транслитерацию
     translit_city = simple_transliterate(city_name)
@@ -1086,26 +1987,99 @@ def format_condition(condition_text: str) -> str:
     return f"{condition_text.capitalize()} 🙂"
 
 # Новая функция получения погоды через WeatherAPI.com
-async def get_weather_info(city: str, days: int = 1, mode: str = "") -> str:
-    base_url = "http://api.weatherapi.com/v1/forecast.json"
-    params = {
-        "key": WEATHER_API_KEY,
-        "q": city,
-        "days": max(days, 1),
-        "lang": "ru",
-        "aqi": "no",
-        "alerts": "no"
-    }
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(base_url, params=params) as resp:
+WEATHER_CURRENT_TTL = float(os.getenv("WEATHER_CURRENT_TTL", "600"))
+WEATHER_FORECAST_TTL = float(os.getenv("WEATHER_FORECAST_TTL", "3600"))
+WEATHER_STALE_FACTOR = 3  # сколько TTL ещё можно отдавать устаревший ответ, обновляя его в фоне
+WEATHER_CACHE_SIZE = 500
+
+class WeatherCache:
+    """
+    Кэш ответов WeatherAPI по (город, вид): "current" или "forecast".
+    Прогноз на N дней обслуживает и более короткие горизонты, и «завтра»/«послезавтра».
+    Просроченный ответ в пределах WEATHER_STALE_FACTOR * TTL отдаётся сразу,
+    а обновление идёт в фоне; одинаковые одновременные запросы объединяются.
+    """
+
+    def __init__(self):
+        self._data: dict[tuple[str, str], dict] = {}  # (city, kind) -> {"payload", "days", "fetched"}
+        self._inflight: dict[tuple, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    async def get(self, city: str, kind: str, days: int = 1, query: str | None = None) -> dict | None:
+        city_key = " ".join(city.lower().split())
+        key = (city_key, kind)
+        ttl = WEATHER_CURRENT_TTL if kind == "current" else WEATHER_FORECAST_TTL
+        now = time.monotonic()
+
+        if kind == "current":
+            # forecast.json тоже содержит блок current — свежий прогноз подходит
+            fc = self._data.get((city_key, "forecast"))
+            if fc and now - fc["fetched"] < WEATHER_CURRENT_TTL:
+                self.hits += 1
+                return fc["payload"]
+
+        entry = self._data.get(key)
+        if entry and entry["days"] >= days:
+            age = now - entry["fetched"]
+            if age < ttl:
+                self.hits += 1
+                return entry["payload"]
+            if age < ttl * WEATHER_STALE_FACTOR:
+                self.stale_hits += 1
+                self._refresh(key, query or city, kind, entry["days"])
+                return entry["payload"]
+
+        self.misses += 1
+        want = max(days, entry["days"]) if entry else days
+        return await asyncio.shield(self._refresh(key, query or city, kind, want))
+
+    def _refresh(self, key: tuple[str, str], city: str, kind: str, days: int) -> asyncio.Task:
+        ikey = (key, days)
+        task = self._inflight.get(ikey)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, city, kind, days))
+            self._inflight[ikey] = task
+            task.add_done_callback(lambda _: self._inflight.pop(ikey, None))
+        return task
+
+    async def _fetch(self, key: tuple[str, str], city: str, kind: str, days: int) -> dict | None:
+        params = {"key": WEATHER_API_KEY, "q": city, "lang": "ru", "aqi": "no"}
+        if kind == "current":
+            url = "http://api.weatherapi.com/v1/current.json"
+        else:
+            url = "http://api.weatherapi.com/v1/forecast.json"
+            params.update({"days": days, "alerts": "no"})
+        try:
+            async with http_client.session.get(url, params=params) as resp:
                 if resp.status != 200:
-                    logging.exception(f"Ошибка получения погоды: статус {resp.status}")
-                    return "Не удалось получить данные о погоде."
+                    logging.warning(f"Ошибка получения погоды: статус {resp.status}")
+                    return None
                 data = await resp.json()
-    except Exception as e:
-        logging.error(f"Ошибка запроса погоды: {e}")
-        return "Ошибка при получении данных о погоде."
+        except Exception as e:
+            logging.error(f"Ошибка запроса погоды: {e}")
+            return None
+
+        self._data[key] = {"payload": data, "days": days, "fetched": time.monotonic()}
+        if len(self._data) > WEATHER_CACHE_SIZE:
+            oldest = min(self._data, key=lambda k: self._data[k]["fetched"])
+            del self._data[oldest]
+        return data
+
+weather_cache = WeatherCache()
+
+async def get_weather_info(city: str, days: int = 1, mode: str = "") -> str:
+    place = city_index.lookup(city)
+    query = f"{place['lat']},{place['lon']}" if place else None
+    if days == 1 and not mode:
+        data = await weather_cache.get(city, "current", query=query)
+    else:
+        # «послезавтра» — это третий день прогноза (индекс 2), значит нужно days=3
+        horizon = {"завтра": 2, "послезавтра": 3}.get(mode, max(days, 1))
+        data = await weather_cache.get(city, "forecast", horizon, query=query)
+    if data is None:
+        return "Не удалось получить данные о погоде."
 
     if days == 1 and not mode:
         current = data.get("current", {})
@@ -1173,58 +2147,174 @@ def split_text_for_tts(text: str, max_bytes: int = 4800) -> list[str]:
         chunks.append(current)
     return chunks
 
-# ---------------------- Функция для отправки голосового ответа ---------------------- #
-async def send_voice_message(chat_id: int, text: str, lang: str = "en-US", message: Message | None = None):
-    client = texttospeech.TextToSpeechClient()
-    clean_text = clean_for_tts(text)
-
-    # теперь разбиваем по байтам, а не по символам
-    chunks = split_text_for_tts(clean_text)
-
-    for i, chunk in enumerate(chunks):
-        synthesis_input = texttospeech.SynthesisInput(text=chunk)
+# ---------------------- Синтез речи ---------------------- #
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
+tts_semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+_tts_client = None
 
-        if lang == "en-US":
-            voice_name = "en-US-Wavenet-F"
-        elif lang == "ru-RU":
-            voice_name = "ru-RU-Wavenet-B"
-        else:
-            voice_name = lang
+def get_tts_client():
+    """Один асинхронный клиент TTS на всё приложение (создаётся внутри event loop)."""
+    global _tts_client
+    if _tts_client is None:
+        _tts_client = texttospeech.TextToSpeechAsyncClient()
+    return _tts_client
 
-        voice = texttospeech.VoiceSelectionParams(
-            language_code=lang,
-            name=voice_name
-        )
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
 
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.OGG_OPUS
-        )
+class TTSCache:
+    """
+    Дисковый кэш синтезированной речи: файл <sha256>.ogg в TTS_CACHE_DIR.
+    Ключ — хэш (текст, язык, голос, кодировка). Порядок LRU держим в памяти
+    (при старте — по mtime файлов), при превышении бюджета удаляем самые старые.
+    """
 
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._index: OrderedDict[str, int] = OrderedDict()  # key -> размер файла
+        self._total = 0
+        self.directory.mkdir(exist_ok=True)
+        files = sorted(self.directory.glob("*.ogg"), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            size = path.stat().st_size
+            self._index[path.stem] = size
+            self._total += size
+
+    @staticmethod
+    def make_key(text: str, lang_code: str, voice_name: str, encoding: str) -> str:
+        return hashlib.sha256("\0".join((text, lang_code, voice_name, encoding)).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.ogg"
+
+    def _read(self, key: str) -> bytes:
+        path = self._path(key)
+        data = path.read_bytes()
+        os.utime(path)  # чтобы порядок LRU пережил перезапуск
+        return data
+
+    async def get(self, key: str) -> bytes | None:
+        if key not in self._index:
+            self.misses += 1
+            return None
         try:
-            response = client.synthesize_speech(
-                input=synthesis_input,
-                voice=voice,
-                audio_config=audio_config
-            )
-        except Exception as e:
-            logging.exception("[TTS] Ошибка при синтезе речи:")
-            await bot.send_message(chat_id, "❌ Ошибка при озвучке части текста.", **thread_kwargs(message))
+            data = await asyncio.to_thread(self._read, key)
+        except OSError:
+            self._total -= self._index.pop(key, 0)
+            self.misses += 1
+            return None
+        self._index.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def _evict(self) -> list[Path]:
+        victims = []
+        while self._total > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total -= size
+            victims.append(self._path(key))
+        return victims
+
+    def _write(self, key: str, data: bytes, victims: list[Path]):
+        write_file_atomic(self._path(key), data)
+        for path in victims:
+            path.unlink(missing_ok=True)
+
+    async def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
             return
+        if key in self._index:
+            self._total -= self._index.pop(key)
+        self._index[key] = len(data)
+        self._total += len(data)
+        victims = self._evict()
+        try:
+            await asyncio.to_thread(self._write, key, data, victims)
+        except OSError as e:
+            logging.warning(f"[TTS] Не удалось сохранить в кэш: {e}")
+            self._total -= self._index.pop(key, 0)
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as out:
-            out.write(response.audio_content)
-            out_path = out.name
+    def stats_line(self) -> str:
+        total = self.hits + self.misses
+        rate = f"{self.hits * 100 // total}%" if total else "—"
+        return (f"• попаданий {self.hits}, промахов {self.misses} ({rate}), "
+                f"{len(self._index)} файлов, {self._total // (1024 * 1024)} МБ")
 
-        await bot.send_voice(
-            chat_id=chat_id,
-            voice=FSInputFile(out_path, filename=f"voice_part_{i+1}.ogg")
+tts_cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES)
+
+async def synthesize_speech(text: str, lang_code: str, voice_name: str) -> bytes:
+    """
+    Возвращает OGG/Opus; сначала смотрит дисковый кэш,
+    одновременно к Google идёт не больше TTS_CONCURRENCY запросов.
+    """
+    key = TTSCache.make_key(text, lang_code, voice_name, "OGG_OPUS")
+    cached = await tts_cache.get(key)
+    if cached is not None:
+        return cached
+
+    async with tts_semaphore:
+        response = await get_tts_client().synthesize_speech(
+            input=texttospeech.SynthesisInput(text=text),
+            voice=texttospeech.VoiceSelectionParams(language_code=lang_code, name=voice_name),
+            audio_config=texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.OGG_OPUS),
         )
-        await asyncio.sleep(1.2)  # немного подождём между отправками
-        os.remove(out_path)
+    await tts_cache.put(key, response.audio_content)
+    return response.audio_content
+
+def concat_voice_parts(parts: list[bytes]) -> bytes:
+    """
+    Склеивает несколько OGG/Opus в одно голосовое.
+    PCM всех кусков собирается одним b"".join (линейно, без попарного «+»),
+    затем один раз кодируется обратно в Opus. Блокирующая — звать через asyncio.to_thread.
+    """
+    if len(parts) == 1:
+        return parts[0]
+    segments = [AudioSegment.from_file(BytesIO(p), format="ogg") for p in parts]
+    first = segments[0]
+    raw = b"".join(
+        seg.set_frame_rate(first.frame_rate).set_channels(first.channels).set_sample_width(first.sample_width).raw_data
+        for seg in segments
+    )
+    merged = AudioSegment(
+        data=raw,
+        sample_width=first.sample_width,
+        frame_rate=first.frame_rate,
+        channels=first.channels,
+    )
+    out = BytesIO()
+    merged.export(out, format="ogg", codec="libopus")
+    return out.getvalue()
 
-async def generate_voice_snippet(text: str, lang_code: str) -> str:
-    client = texttospeech.TextToSpeechClient()
+# ---------------------- Функция для отправки голосового ответа ---------------------- #
+async def send_voice_message(chat_id: int, text: str, lang: str = "en-US", message: Message | None = None):
+    clean_text = clean_for_tts(text)
+
+    # теперь разбиваем по байтам, а не по символам
+    chunks = split_text_for_tts(clean_text)
+    if not chunks:
+        return
+
+    if lang == "en-US":
+        voice_name = "en-US-Wavenet-F"
+    elif lang == "ru-RU":
+        voice_name = "ru-RU-Wavenet-B"
+    else:
+        voice_name = lang
+
+    # все куски синтезируются параллельно и отправляются одним голосовым
+    try:
+        parts = await asyncio.gather(*(synthesize_speech(chunk, lang, voice_name) for chunk in chunks))
+        audio = await asyncio.to_thread(concat_voice_parts, list(parts))
+    except Exception as e:
+        logging.exception("[TTS] Ошибка при синтезе речи:")
+        await bot.send_message(chat_id, "❌ Ошибка при озвучке текста.", **thread_kwargs(message))
+        return
 
+    await send_cached_voice(chat_id, audio, "voice.ogg", **thread_kwargs(message))
+
+async def generate_voice_snippet(text: str, lang_code: str) -> bytes:
     if lang_code == "ru-RU":
         voice_name = "ru-RU-Wavenet-D"
     elif lang_code == "en-US":
@@ -1232,79 +2322,79 @@ async def generate_voice_snippet(text: str, lang_code: str) -> str:
     else:
         voice_name = lang_code  # fallback
 
-    voice = texttospeech.VoiceSelectionParams(
-        language_code=lang_code,
-        name=voice_name
-    )
+    return await synthesize_speech(text, lang_code, voice_name)
+
+VOICE_PROGRESS_INTERVAL = 1.5  # сек: прогресс правим не чаще, чтобы не упираться в лимиты Telegram
 
-    synthesis_input = texttospeech.SynthesisInput(text=text)
-    audio_config = texttospeech.AudioConfig(
-        audio_encoding=texttospeech.AudioEncoding.OGG_OPUS
-    )
-    response = client.synthesize_speech(
-        input=synthesis_input,
-        voice=voice,
-        audio_config=audio_config
-    )
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as out_file:
-        out_file.write(response.audio_content)
-        return out_file.name
-        
 async def send_bilingual_voice(chat_id: int, dialogue_text: str, message: Message):
-    audio_segments = []
     lines = [l.strip() for l in dialogue_text.strip().splitlines() if l.strip()]
-    total = len(lines)
 
+    items: list[tuple[str, str]] = []
+    for line in lines:
+        raw_line = strip_html(line)
+        if not raw_line or re.match(r"^[#\-\*]+$", raw_line.strip()):
+            continue
+        cleaned = clean_for_tts(raw_line)
+        if not cleaned:
+            continue
+        # если строка на русском — используем ru-RU
+        lang_code = "ru-RU" if detect_lang(cleaned) == "ru" else "en-US"
+        items.append((cleaned, lang_code))
+
+    total = len(items)
     progress_msg = await bot.send_message(chat_id, f"🔊 Озвучка [░░░░░░░░░░░░░░░░░░░░] 0/{total}", **thread_kwargs(message))
+    if not total:
+        await progress_msg.edit_text("❌ Ничего не удалось озвучить.")
+        return
 
     def progress_bar(current: int, total: int, size: int = 20) -> str:
         filled = int(size * current / total)
         return "█" * filled + "░" * (size - filled)
 
-    for i, line in enumerate(lines, start=1):
-        raw_line = strip_html(line)
-        if not raw_line or re.match(r"^[#\-\*]+$", raw_line.strip()):
-            continue
-
-        cleaned = clean_for_tts(raw_line)
-        # если запрос на русском — используем ru-RU
-        if detect_lang(cleaned) == "ru":
-            lang_code = "ru-RU"
-        else:
-            lang_code = "en-US"
+    done = 0
 
+    async def voice_line(text: str, lang_code: str) -> bytes | None:
+        nonlocal done
         try:
-            ogg_path = await generate_voice_snippet(cleaned, lang_code)
-            segment = AudioSegment.from_file(ogg_path, format="ogg")
-            audio_segments.append(segment)
-            os.remove(ogg_path)
+            return await generate_voice_snippet(text, lang_code)
         except Exception as e:
-            logging.exception(f"[voice] Ошибка при озвучке строки: {cleaned}\n{e}")
-            continue
+            logging.exception(f"[voice] Ошибка при озвучке строки: {text}\n{e}")
+            return None
+        finally:
+            done += 1
+
+    async def report_progress():
+        shown = 0
+        while True:
+            await asyncio.sleep(VOICE_PROGRESS_INTERVAL)
+            if done == shown:
+                continue
+            shown = done
+            try:
+                await progress_msg.edit_text(f"🎙️ Озвучка [{progress_bar(shown, total)}] {shown}/{total}")
+            except Exception as e:
+                logging.warning(f"⚠️ Не удалось обновить сообщение прогресса: {e}")
 
-        # 📊 Обновляем прогресс
-        bar = progress_bar(i, total)
-        try:
-            await progress_msg.edit_text(f"🎙️ Озвучка [{bar}] {i}/{total}")
-        except Exception as e:
-            logging.warning(f"⚠️ Не удалось обновить сообщение прогресса: {e}")
+    # все строки синтезируются параллельно (ограничение — tts_semaphore), порядок сохраняет gather
+    reporter = asyncio.create_task(report_progress())
+    try:
+        parts = await asyncio.gather(*(voice_line(text, lang_code) for text, lang_code in items))
+    finally:
+        reporter.cancel()
 
-    if not audio_segments:
+    parts = [p for p in parts if p]
+    if not parts:
         await progress_msg.edit_text("❌ Ничего не удалось озвучить.")
         return
 
-    final_audio = sum(audio_segments[1:], audio_segments[0])
-    final_path = tempfile.NamedTemporaryFile(delete=False, suffix=".ogg").name
-    final_audio.export(final_path, format="ogg")
-
-    await bot.send_voice(chat_id=chat_id, voice=FSInputFile(final_path, filename="dialogue.ogg", **thread_kwargs(message)))
-    os.remove(final_path)
+    final_audio = await asyncio.to_thread(concat_voice_parts, parts)
+    await send_cached_voice(chat_id, final_audio, "dialogue.ogg", **thread_kwargs(message))
 
     await progress_msg.edit_text("✅ Озвучка завершена!")
 
 # ---------------------- Вспомогательная функция для thread ---------------------- #
-def thread_kwargs(message: Message) -> dict:
-    if message.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP] and message.message_thread_id:
+def thread_kwargs(message: Message | None) -> dict:
+    if message is not None and message.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP] and message.message_thread_id:
         return {"message_thread_id": message.message_thread_id}
     return {}
 
@@ -1347,7 +2437,7 @@ async def cmd_start(message: Message, command: CommandObject):
     if message.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
         if message.chat.id in disabled_chats:
             disabled_chats.remove(message.chat.id)
-            save_disabled_chats(disabled_chats)
+            save_disabled_chats(message.chat.id)
             logging.info(f"[BOT] Бот снова включён в группе {message.chat.id}")
         await message.answer("Бот включён ✅")
         await message.answer(greet, reply_markup=main_menu_keyboard)
@@ -1361,7 +2451,7 @@ async def cmd_stop(message: Message, command: CommandObject):
     _register_message_stats(message)
     if message.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
         disabled_chats.add(message.chat.id)
-        save_disabled_chats(disabled_chats)
+        save_disabled_chats(message.chat.id)
         logging.info(f"[BOT] Бот отключён в группе {message.chat.id}")
         await message.answer("Бот отключён в группе 🚫")
     else:
@@ -1406,63 +2496,285 @@ async def cmd_adminstats(message: Message):
         f"🧠 Команд выполнено: <b>{total_cmds}</b>\n"
         f"📈 Среднее сообщений на пользователя: <b>{avg_per_user}</b>"
     )
+    http_lines = http_client.stats_lines()
+    if http_lines:
+        text += "\n\n🌐 <b>HTTP-соединения</b>\n" + "\n".join(http_lines[:5])
+    text += "\n\n🔊 <b>Кэш озвучки</b>\n" + tts_cache.stats_line()
+    text += "\n🖼 <b>Кэш file_id</b>\n" + file_id_cache.stats_line()
+    text += "\n🤖 <b>Очередь Gemini</b>\n" + gemini_scheduler.stats_line()
+    text += "\n💭 <b>Память диалогов</b>\n" + chat_memory.stats_line()
+    json_lines = structured_stats_lines()
+    if json_lines:
+        text += "\n🧩 <b>JSON-ответы</b>\n" + "\n".join(json_lines)
 
     chart_path = render_top_commands_bar_chart(cmd_usage)
     if chart_path:
-        await message.answer_photo(photo=FSInputFile(chart_path, filename="top_commands.png"), caption=text)
+        chart_bytes = Path(chart_path).read_bytes()
         os.remove(chart_path)
+        await send_cached_photo(message.chat.id, chart_bytes, "top_commands.png", caption=text, **thread_kwargs(message))
     else:
         await message.answer(text + "\nНет данных по командам.")
 
+@dp.message(Command("exportdata"))
+async def cmd_exportdata(message: Message):
+    _register_message_stats(message)
+    if message.from_user.id != ADMIN_ID:
+        return
+    if not isinstance(persist.backend, SqliteStorage):
+        await message.answer("Данные и так хранятся в JSON-файлах в папке data.")
+        return
+
+    await persist.flush()
+    target_dir = DATA_DIR / "export"
+    try:
+        count = await asyncio.to_thread(export_json_files, persist.backend, persist.collections, target_dir)
+    except Exception as e:
+        logging.exception(f"[STORAGE] Ошибка экспорта в JSON: {e}")
+        await message.answer("❌ Не удалось выгрузить данные.")
+        return
+    await message.answer(f"✅ Выгружено коллекций: <b>{count}</b>\nПапка: <code>{target_dir}</code>")
+
+# ---------------------- Рассылка ---------------------- #
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # лимит Telegram ~30 сообщений/с на бота
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCAST_PREFIX = "<b>Admin Message:</b>"
+
+# Состояние текущей рассылки (курсор, счётчики, что отправляем) — переживает перезапуск.
+# Список получателей хранится отдельно: он пишется один раз при старте рассылки,
+# а при каждом сбросе прогресса сохраняется только маленький документ с курсором.
+broadcast_state: dict = load_collection("broadcast", {})
+broadcast_recipients: list[int] = load_collection("broadcast_recipients", [])
+
+class TokenBucket:
+    """Глобальное ведро токенов: не больше rate отправок в секунду, всплеск до capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        # RetryAfter относится ко всему боту — притормаживаем всех воркеров сразу
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class BroadcastEngine:
+    """
+    Рассылка пулом воркеров за общим TokenBucket.
+    Курсор — граница, до которой все получатели уже обработаны; он сохраняется
+    через persist, поэтому прерванная рассылка продолжается с этого места
+    (несколько получателей сразу за курсором могут получить сообщение повторно).
+    """
+
+    def __init__(self, state: dict, recipients: list[int], rate: float, workers: int):
+        self.state = state
+        self.recipients = recipients
+        self.bucket = TokenBucket(rate, rate)
+        self.workers = workers
+        self.task: asyncio.Task | None = None
+        self._done: set[int] = set()
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self, admin_chat_id: int, source: Message | None, text: str | None):
+        self.recipients[:] = sorted(unique_users.union(unique_groups))
+        persist.mark_dirty("broadcast_recipients")
+        self.state.clear()
+        self.state.update({
+            "admin_chat_id": admin_chat_id,
+            "cursor": 0,
+            "sent": 0,
+            "failed": 0,
+            "pruned": 0,
+        })
+        if source is not None and not source.text:
+            # медиа пересылаем copy_message — файл не перезаливается и не нужен разбор типов
+            self.state["from_chat_id"] = source.chat.id
+            self.state["message_id"] = source.message_id
+            caption = source.html_text if source.caption else ""
+            self.state["caption"] = f"{BROADCAST_PREFIX}\n{caption}"
+        else:
+            body = source.html_text if source is not None else text
+            self.state["text"] = f"{BROADCAST_PREFIX}\n{body}"
+        persist.mark_dirty("broadcast")
+        self.task = asyncio.create_task(self._run())
+
+    def resume(self):
+        if self.state and self.recipients and not self.running:
+            logging.info(f"[BROADCAST] Продолжаем рассылку с позиции {self.state['cursor']}")
+            self.task = asyncio.create_task(self._run(resumed=True))
+
+    async def _send(self, chat_id: int):
+        if "text" in self.state:
+            await bot.send_message(chat_id, self.state["text"])
+        else:
+            await bot.copy_message(
+                chat_id=chat_id,
+                from_chat_id=self.state["from_chat_id"],
+                message_id=self.state["message_id"],
+                caption=self.state["caption"],
+            )
+
+    def _prune(self, chat_id: int):
+        if chat_id in unique_users:
+            unique_users.discard(chat_id)
+            save_unique_users(chat_id)
+        if chat_id in unique_groups:
+            unique_groups.discard(chat_id)
+            save_unique_groups(chat_id)
+        self.state["pruned"] += 1
+
+    async def _deliver(self, chat_id: int):
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                await self._send(chat_id)
+                self.state["sent"] += 1
+                return
+            except TelegramRetryAfter as e:
+                logging.warning(f"[BROADCAST] RetryAfter {e.retry_after}s для чата {chat_id}")
+                self.bucket.pause(e.retry_after)
+            except TelegramMigrateToChat as e:
+                # группа стала супергруппой — запоминаем новый id и шлём туда
+                unique_groups.discard(chat_id)
+                save_unique_groups(chat_id)
+                chat_id = e.migrate_to_chat_id
+                unique_groups.add(chat_id)
+                save_unique_groups(chat_id)
+            except TelegramForbiddenError:
+                self._prune(chat_id)
+                return
+            except TelegramBadRequest as e:
+                if "chat not found" in str(e).lower():
+                    self._prune(chat_id)
+                else:
+                    logging.warning(f"[BROADCAST] Ошибка при отправке в чат {chat_id}: {e}")
+                    self.state["failed"] += 1
+                return
+            except Exception as e:
+                logging.exception(f"[BROADCAST] Ошибка при отправке в чат {chat_id}: {e}")
+                self.state["failed"] += 1
+                return
+        self.state["failed"] += 1
+
+    def _mark_done(self, pos: int):
+        self._done.add(pos)
+        cursor = self.state["cursor"]
+        while cursor in self._done:
+            self._done.discard(cursor)
+            cursor += 1
+        self.state["cursor"] = cursor
+        persist.mark_dirty("broadcast")
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            pos, chat_id = await queue.get()
+            try:
+                await self._deliver(chat_id)
+            finally:
+                self._mark_done(pos)
+                queue.task_done()
+
+    def _progress_text(self) -> str:
+        total = len(self.recipients)
+        return (
+            f"📣 Рассылка: <b>{self.state['cursor']}/{total}</b>\n"
+            f"✅ Доставлено: <b>{self.state['sent']}</b>\n"
+            f"⚠️ Ошибок: <b>{self.state['failed']}</b>\n"
+            f"🚫 Удалено недоступных чатов: <b>{self.state['pruned']}</b>"
+        )
+
+    async def _report(self, progress_msg: Message | None):
+        last_text = ""
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            text = self._progress_text()
+            if progress_msg is None or text == last_text:
+                continue
+            try:
+                await progress_msg.edit_text(text)
+                last_text = text
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest:
+                pass
+
+    async def _run(self, resumed: bool = False):
+        admin_chat_id = self.state["admin_chat_id"]
+        self._done.clear()
+        progress_msg = None
+        try:
+            prefix = "🔄 Продолжаю прерванную рассылку.\n\n" if resumed else ""
+            progress_msg = await bot.send_message(admin_chat_id, prefix + self._progress_text())
+        except Exception as e:
+            logging.warning(f"[BROADCAST] Не удалось отправить прогресс админу: {e}")
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for pos in range(self.state["cursor"], len(self.recipients)):
+            queue.put_nowait((pos, self.recipients[pos]))
+
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        reporter = asyncio.create_task(self._report(progress_msg))
+        try:
+            await queue.join()
+        finally:
+            reporter.cancel()
+            for w in workers:
+                w.cancel()
+
+        summary = "✅ Рассылка завершена.\n\n" + self._progress_text()
+        logging.info(f"[BROADCAST] Завершено: sent={self.state['sent']} failed={self.state['failed']} pruned={self.state['pruned']}")
+        self.state.clear()
+        self.recipients.clear()
+        persist.mark_dirty("broadcast")
+        persist.mark_dirty("broadcast_recipients")
+        try:
+            if progress_msg is not None:
+                await progress_msg.edit_text(summary)
+            else:
+                await bot.send_message(admin_chat_id, summary)
+        except Exception as e:
+            logging.warning(f"[BROADCAST] Не удалось отправить итог админу: {e}")
+
+broadcast_engine = BroadcastEngine(broadcast_state, broadcast_recipients, BROADCAST_RATE, BROADCAST_WORKERS)
+
 @dp.message(Command("broadcast"))
 async def cmd_broadcast(message: Message):
     _register_message_stats(message)
     if message.from_user.id != ADMIN_ID:
         return
-    broadcast_prefix = "<b>Admin Message:</b>"
+    if broadcast_engine.running:
+        await message.answer("Рассылка уже идёт, дождись её завершения.", **thread_kwargs(message))
+        return
     if message.reply_to_message:
-        broadcast_msg = message.reply_to_message
+        broadcast_engine.start(message.chat.id, message.reply_to_message, None)
     else:
         text_parts = message.text.split(maxsplit=1)
         if len(text_parts) < 2:
             await message.answer("Нет текста для рассылки.", **thread_kwargs(message))
             return
-        broadcast_text = text_parts[1]
-        broadcast_msg = None
-
-    recipients = unique_users.union(unique_groups)
-    for recipient in recipients:
-        try:
-            if broadcast_msg:
-                if broadcast_msg.text:
-                    await bot.send_message(chat_id=recipient, text=f"{broadcast_prefix}\n{broadcast_msg.text}", **thread_kwargs(message))
-                elif broadcast_msg.photo:
-                    caption = broadcast_msg.caption or ""
-                    caption = f"{broadcast_prefix}\n{caption}"
-                    await bot.send_photo(chat_id=recipient, photo=broadcast_msg.photo[-1].file_id, caption=caption, **thread_kwargs(message))
-                elif broadcast_msg.video:
-                    caption = broadcast_msg.caption or ""
-                    caption = f"{broadcast_prefix}\n{caption}"
-                    await bot.send_video(chat_id=recipient, video=broadcast_msg.video.file_id, caption=caption, **thread_kwargs(message))
-                elif broadcast_msg.voice:
-                    caption = broadcast_msg.caption or ""
-                    caption = f"{broadcast_prefix}\n{caption}"
-                    await bot.send_voice(chat_id=recipient, voice=broadcast_msg.voice.file_id, caption=caption, **thread_kwargs(message))
-                elif broadcast_msg.document:
-                    caption = broadcast_msg.caption or ""
-                    caption = f"{broadcast_prefix}\n{caption}"
-                    await bot.send_document(chat_id=recipient, document=broadcast_msg.document.file_id, caption=caption, **thread_kwargs(message))
-                elif broadcast_msg.audio:
-                    caption = broadcast_msg.caption or ""
-                    caption = f"{broadcast_prefix}\n{caption}"
-                    await bot.send_audio(chat_id=recipient, audio=broadcast_msg.audio.file_id, caption=caption, **thread_kwargs(message))
-                else:
-                    await bot.send_message(chat_id=recipient, text=f"{broadcast_prefix}\n[Сообщение в неподдерживаемом формате]", **thread_kwargs(message))
-            else:
-                await bot.send_message(chat_id=recipient, text=f"{broadcast_prefix}\n{broadcast_text}", **thread_kwargs(message))
-        except Exception as e:
-            logging.exception(f"[BROADCAST] Ошибка при отправке в чат {recipient}: {e}")
-    await message.answer("Рассылка завершена.")
+        broadcast_engine.start(message.chat.id, None, text_parts[1])
 
 @dp.callback_query(F.data == "support_request")
 async def handle_support_click(callback: CallbackQuery):
@@ -1525,7 +2837,7 @@ async def handle_toggle_reminders(callback: CallbackQuery):
     uid = callback.from_user.id
     current = vocab_reminders_enabled.get(str(uid), True)
     vocab_reminders_enabled[str(uid)] = not current
-    save_vocab_reminder_settings()
+    save_vocab_reminder_settings(str(uid))
     status = "включены ✅" if not current else "отключены ❌"
     await callback.answer(f"Напоминания теперь {status}", show_alert=True)
     await callback.message.delete()
@@ -1597,41 +2909,17 @@ async def handle_dialogue_topic(callback: CallbackQuery, state: FSMContext):
     topic_raw = callback.data.split(":", 1)[1]
     topic_title = topic_raw.replace("_", " ").title()
 
-    await callback.message.edit_text(
-        f"📖 Генерирую 3–5 примеров диалогов на тему «{topic_title}»…",
-        parse_mode="HTML"
-    )
-
-    # Новый промпт с более удобной для разбора структурой
-    prompt = (
-        f"Ты — опытный преподаватель английского. Составь 3–5 коротких диалогов на тему «{topic_title}».\n"
-        "Ответь строго чистым JSON (без ```), в формате:\n"
-        "[\n"
-        "  {\n"
-        "    \"title\": \"Ordering Coffee\",\n"
-        "    \"dialogue\": [\n"
-        "      {\"speaker\": \"You\", \"en\": \"Hi, can I get a cappuccino to go, please?\", \"ru\": \"Здравствуйте, можно мне капучино с собой, пожалуйста?\"},\n"
-        "      {\"speaker\": \"VAI\", \"en\": \"Sure. What size would you like?\", \"ru\": \"Конечно. Какой размер вы бы хотели?\"}\n"
-        "    ]\n"
-        "  },\n"
-        "  …\n"
-        "]\n"
-        "Никаких Markdown‑ограждений, только чистый JSON-массив."
-    )
-
-    resp = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
-    raw = resp.text.strip()
-
-    # Убираем возможные ```json … ```  
-    raw = re.sub(r"^```json\s*|\s*```$", "", raw, flags=re.IGNORECASE).strip()
-
-    try:
-        dialogs = json.loads(raw)
-    except json.JSONDecodeError:
+    uid = callback.from_user.id
+    dialogs = content_cache.get(uid, "dialogue", topic_raw)
+    if dialogs is None:
         await callback.message.edit_text(
-            f"<b>💬 Тема: {topic_title}</b>\n\n"
-            f"<code>Не удалось распознать JSON, вот что вернуло Gemini:</code>\n"
-            f"{escape(raw)}",
+            f"📖 Генерирую 3–5 примеров диалогов на тему «{topic_title}»…",
+            parse_mode="HTML"
+        )
+        dialogs = await content_cache.fill(uid, "dialogue", topic_raw)
+    if dialogs is None:
+        await callback.message.edit_text(
+            f"<b>💬 Тема: {topic_title}</b>\n\n❌ Не удалось подготовить диалоги. Попробуй позже.",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="🔙 Назад", callback_data="learn_back")]
@@ -1639,21 +2927,15 @@ async def handle_dialogue_topic(callback: CallbackQuery, state: FSMContext):
         )
         return
 
-    # Очищаем любые звёздочки внутри строк
-    for dlg in dialogs:
-        for turn in dlg.get("dialogue", []):
-            turn["en"] = re.sub(r"\*+", "", turn["en"]).strip()
-            turn["ru"] = re.sub(r"\*+", "", turn["ru"]).strip()
-
     # Собираем HTML
     lines = [f"<b>💬 Тема: {topic_title}</b>\n"]
     for idx, block in enumerate(dialogs, 1):
         title = block.get("title", f"Диалог {idx}")
-        lines.append(f"<u>{title}</u>")
+        lines.append(f"<u>{escape(title)}</u>")
         for turn in block["dialogue"]:
             sp = turn["speaker"]
-            lines.append(f"• <b>{sp}:</b> {turn['en']}")
-            lines.append(f"  <i>«{turn['ru']}»</i>")
+            lines.append(f"• <b>{escape(sp)}:</b> {escape(turn['en'])}")
+            lines.append(f"  <i>«{escape(turn['ru'])}»</i>")
         lines.append("")  # пустая строка между диалогами
 
     full_text = "\n".join(lines)
@@ -1705,26 +2987,15 @@ async def handle_learn_course(callback: CallbackQuery):
 async def handle_learn_level(callback: CallbackQuery, state: FSMContext):
     level = callback.data.split(":")[1]
     await callback.answer()
-    await callback.message.edit_text(f"📚 Генерирую материалы для уровня {level}, подожди немного...")
-
-    prompt = (
-        f"Ты — профессиональный преподаватель английского языка. "
-        f"Составь краткий учебный план для уровня {level}.\n"
-        "Перечисли 3–5 тем. Для каждой:\n"
-        "- Название (на русском и в скобках на английском)\n"
-        "- Краткое описание\n"
-        "- Задание\n\n"
-        "Не используй HTML, верни обычный текст. Пример:\n\n"
-        "Уровень: A2 (Pre-Intermediate)\n\n"
-        "Тема 1: Название (Title)\n"
-        "Описание: ...\n"
-        "Задание: ...\n\n"
-        "Тема 2: ..."
-    )
+    uid = callback.from_user.id
 
     try:
-        response = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
-        raw_text = response.text.strip()
+        raw_text = content_cache.get(uid, "course", level=level)
+        if raw_text is None:
+            await callback.message.edit_text(f"📚 Генерирую материалы для уровня {level}, подожди немного...")
+            raw_text = await content_cache.fill(uid, "course", level=level)
+        if raw_text is None:
+            raise RuntimeError("кэш курса пуст, генерация не удалась")
         text = format_gemini_response(raw_text)
 
         # 💡 Добавим HTML-разметку вручную
@@ -1762,7 +3033,7 @@ async def handle_learn_voice(callback: CallbackQuery, state: FSMContext):
 
     try:
         # ✨ Используем билингвальную озвучку (строка за строкой, auto-detect языка)
-        await send_bilingual_voice(callback.message.chat.id, course_text, message=message)
+        await send_bilingual_voice(callback.message.chat.id, course_text, message=callback.message)
     except Exception as e:
         logging.exception(f"[learn_voice] Ошибка при озвучке: {e}")
         await callback.message.answer("❌ Не удалось озвучить темы.")
@@ -1771,66 +3042,33 @@ async def handle_learn_voice(callback: CallbackQuery, state: FSMContext):
 async def handle_learn_quiz(callback: CallbackQuery):
     level = callback.data.split(":")[1]
     user_id = callback.from_user.id
-    await callback.answer(f"🧪 Генерирую тест для уровня {level}...")
-
-    prompt = (
-        f"Составь тест из 3 вопросов по английскому языку для уровня {level}.\n"
-        "Каждый вопрос должен иметь 4 варианта ответа (A, B, C, D), с указанием правильного.\n"
-        "Ответ строго в формате JSON-массива:\n\n"
-        '[\n'
-        '  {\n'
-        '    "question": "What is the capital of France?",\n'
-        '    "options": {\n'
-        '      "A": "London",\n'
-        '      "B": "Paris",\n'
-        '      "C": "Berlin",\n'
-        '      "D": "Madrid"\n'
-        '    },\n'
-        '    "answer": "B"\n'
-        '  }\n'
-        ']'
-    )
-
-    try:
-        response = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
-        raw_text = response.text.strip()
-
-        if not raw_text:
-            raise ValueError("Пустой ответ от Gemini")
-
-        # 🔧 Удаляем Markdown-обёртку типа ```json ... ```
-        if raw_text.startswith("```json"):
-            raw_text = raw_text[7:]  # удаляем ```json\n
-        if raw_text.endswith("```"):
-            raw_text = raw_text[:-3]  # удаляем ```
-
-        # 🧪 Пробуем распарсить JSON
-        try:
-            questions = json.loads(raw_text)
-        except json.JSONDecodeError:
-            logging.error(f"[learn_quiz:{level}] Невозможно распарсить JSON:\n{raw_text}")
-            await callback.message.answer("❌ Ошибка разбора ответа. Gemini вернул некорректный формат.")
-            return
+    await callback.answer()
 
-        # Сохраняем правильные ответы
-        quiz_storage[user_id] = {}
-        for i, q in enumerate(questions):
-            quiz_storage[user_id][i + 1] = q["answer"]
+    questions = exercise_bank.take(user_id, "quiz", level, count=3)
+    if len(questions) < 3:
+        await callback.message.answer(f"🧪 Готовлю тест для уровня {level}...")
+        questions += await exercise_bank.wait_and_take(
+            user_id, "quiz", level, count=3 - len(questions), exclude={q["id"] for q in questions}
+        )
+    if not questions:
+        await callback.message.answer("❌ Не удалось подготовить тест.")
+        return
 
-            buttons = [
-                [InlineKeyboardButton(text=f"{k}) {v}", callback_data=f"quiz_answer:{level}:{i+1}:{k}")]
-                for k, v in q["options"].items()
-            ]
+    # правильные ответы остаются у нас — проверка в handle_quiz_answer локальная
+    quiz_storage[user_id] = {}
+    for i, q in enumerate(questions):
+        quiz_storage[user_id][i + 1] = q["answer"]
 
-            await callback.message.answer(
-                f"<b>Вопрос {i+1}:</b> {q['question']}",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
-                parse_mode="HTML"
-            )
+        buttons = [
+            [InlineKeyboardButton(text=f"{k}) {v}", callback_data=f"quiz_answer:{level}:{i+1}:{k}")]
+            for k, v in q["options"].items()
+        ]
 
-    except Exception as e:
-        logging.exception(f"[learn_quiz:{level}] Ошибка Gemini: {e}")
-        await callback.message.answer("❌ Не удалось сгенерировать тест.")
+        await callback.message.answer(
+            f"<b>Вопрос {i+1}:</b> {escape(q['question'])}",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+            parse_mode="HTML"
+        )
 
 async def send_quiz_question(message: Message, state: FSMContext):
     data = await state.get_data()
@@ -1868,7 +3106,7 @@ async def handle_dialogue_voice(callback: CallbackQuery, state: FSMContext):
         await callback.message.answer("❌ Нет доступного диалога для озвучки.")
         return
 
-    await send_bilingual_voice(callback.message.chat.id, dialogue, message=message)
+    await send_bilingual_voice(callback.message.chat.id, dialogue, message=callback.message)
 
 @dp.callback_query(F.data == "learn_achievements")
 async def show_achievements(callback: CallbackQuery):
@@ -1907,7 +3145,7 @@ async def handle_dialogue_add_words(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text("🔍 Анализирую диалог...")
 
     try:
-        response = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
+        response = await gemini_generate([{"role": "user", "parts": [prompt]}], uid=callback.from_user.id, profile="micro")
         raw = response.text.strip()
         # быстро конвертим **жирный** и *курсив* в HTML‑теги
         html = format_gemini_response(raw)
@@ -1938,17 +3176,10 @@ async def handle_dialogue_add_confirm(callback: CallbackQuery, state: FSMContext
         word = lines[0].replace("Слово:", "").strip()
         meaning = lines[1].replace("Значение:", "").strip()
         example = lines[2].replace("Пример:", "").strip()
-        entry = {
-            "word": word,
-            "meaning": meaning,
-            "example": example,
-            "last_reviewed": datetime.utcnow().isoformat(),
-            "review_level": 0
-        }
-        user_vocab.setdefault(uid, []).append(entry)
+        add_vocab_entry(uid, word, meaning, example)
         count += 1
 
-    save_vocab(user_vocab)
+    save_vocab(uid)
     await check_achievements(uid, callback)
     await callback.message.edit_text(f"✅ Добавлено слов: <b>{count}</b>", parse_mode="HTML")
     await state.clear()
@@ -1960,23 +3191,24 @@ async def handle_dialogue_add_cancel(callback: CallbackQuery, state: FSMContext)
     await state.clear()
 
 
+# последние «дополнительные темы» пользователя — для кнопки озвучки
+last_materials = AsyncTTLCache(ttl=3600, maxsize=1000)
+
 @dp.callback_query(F.data.startswith("learn_more:"))
 async def handle_learn_more(callback: CallbackQuery):
     level = callback.data.split(":")[1]
-    await callback.answer("Генерирую дополнительные темы...")
-
-    prompt = (
-        f"Сгенерируй ещё 3–5 новых учебных тем для уровня {level} по английскому языку.\n"
-        "Формат:\n\n"
-        "• Тема: Название\n"
-        "Описание: ...\n"
-        "Задание: ..."
-    )
+    uid = callback.from_user.id
+    await callback.answer()
 
     try:
-        response = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
-        text = format_gemini_response(response.text.strip())
-        chat_history[callback.from_user.id] = text
+        raw_text = content_cache.get(uid, "course_more", level=level)
+        if raw_text is None:
+            await callback.message.answer("⏳ Генерирую дополнительные темы...")
+            raw_text = await content_cache.fill(uid, "course_more", level=level)
+        if raw_text is None:
+            raise RuntimeError("кэш тем пуст, генерация не удалась")
+        text = format_gemini_response(raw_text)
+        last_materials.set(uid, text)
 
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [
@@ -1999,7 +3231,7 @@ async def handle_voice_material(callback: CallbackQuery):
     uid = callback.from_user.id
     await callback.answer()
 
-    text = chat_history.get(uid)
+    text = last_materials.get(uid)
     if not text:
         await callback.message.answer("❌ Не удалось найти последний текст.")
         return
@@ -2020,7 +3252,7 @@ async def handle_quiz_for_topic(callback: CallbackQuery):
     )
 
     try:
-        response = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
+        response = await gemini_generate([{"role": "user", "parts": [prompt]}], uid=callback.from_user.id, profile="content")
         text = format_gemini_response(response.text.strip())
 
         # Парсим текст в структуру вопросов
@@ -2079,7 +3311,7 @@ async def handle_quiz_level(callback: CallbackQuery):
     )
 
     try:
-        response = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
+        response = await gemini_generate([{"role": "user", "parts": [prompt]}], uid=callback.from_user.id, profile="content")
         text = format_gemini_response(response.text.strip())
 
         questions = parse_quiz_questions(text)
@@ -2137,7 +3369,7 @@ async def handle_quiz_answer(callback: CallbackQuery):
     if user_choice == correct_answer:
         progress = user_progress.setdefault(callback.from_user.id, {})
         progress[level] = progress.get(level, 0) + 1
-        save_progress(user_progress)
+        save_progress(callback.from_user.id)
         correct = user_progress[callback.from_user.id][level]
         msg = f"📈 Прогресс: <b>{correct}</b> правильных ответов по уровню {level}"
         await callback.message.answer(msg)
@@ -2188,18 +3420,10 @@ async def handle_add_word_input(message: Message, state: FSMContext):
     uid = message.from_user.id
     word_raw = message.text.strip()
 
-    prompt = (
-        f"Дай краткое определение и пример для английского слова '{word_raw}'. "
-        "Ответ в формате:\n"
-        "Значение: ...\nПример: ..."
-    )
-
     await message.answer("🔄 Генерирую перевод и пример...", **thread_kwargs(message))
     try:
-        response = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
-        raw = response.text.strip().split("\n")
-        meaning = raw[0].replace("Значение:", "").strip()
-        example = raw[1].replace("Пример:", "").strip()
+        definition = await define_word(word_raw, uid=uid)
+        meaning, example = definition.meaning, definition.example
 
         await state.update_data(word=word_raw, meaning=meaning, example=example)
 
@@ -2224,63 +3448,29 @@ async def handle_progress_reset(callback: CallbackQuery):
     uid = callback.from_user.id
     if uid in user_progress:
         user_progress.pop(uid)
-        save_progress(user_progress)
+        save_progress(uid)
         await callback.answer("Прогресс сброшен ❌", show_alert=True)
     else:
         await callback.answer("У тебя и так нет прогресса 😄", show_alert=True)
 
 @dp.callback_query(F.data == "learn_word")
 async def handle_word_of_the_day(callback: CallbackQuery):
-    await callback.answer("Генерирую слово дня...")
+    await callback.answer()
 
     uid = callback.from_user.id
-    user_history = user_word_of_day_history.get(uid, [])
-
-    attempts = 0
-    max_attempts = 5
-    word = ""
-    meaning = ""
-    example = ""
-
-    while attempts < max_attempts:
-        attempts += 1
-
-        prompt = (
-            "Придумай одно уникальное английское слово, желательно нужное и важное. "
-            "Не повторяй слова, которые выдавал раньше, и не используй generic вроде 'hello'.\n\n"
-            "Ответ строго в формате:\n"
-            "Слово: cat\n"
-            "Значение: Кошка\n"
-            "Пример: I have a cat.\n\n"
-            "Пожалуйста, не добавляй ничего лишнего, кроме этих трёх строк. "
-            "На русском языке укажи «Слово:», «Значение:», «Пример:»."
-        )
-
-        try:
-            response = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
-            raw = response.text.strip().split("\n")
-
-            for line in raw:
-                if line.lower().startswith("слово:"):
-                    word = line.split(":", 1)[1].strip()
-                elif line.lower().startswith("значение:"):
-                    meaning = line.split(":", 1)[1].strip()
-                elif line.lower().startswith("пример:"):
-                    example = line.split(":", 1)[1].strip()
-
-            if word and word.lower() not in [w.lower() for w in user_history]:
-                user_history.append(word)
-                user_word_of_day_history[uid] = user_history[-100:]  # ограничим историю 100 словами
-                save_word_of_day_history(user_word_of_day_history)
-                break
-        except Exception as e:
-            logging.exception(f"[WORD_OF_DAY_ATTEMPT] Ошибка: {e}")
-            continue
-
-    if not word:
+    entry = word_pool.pick(uid)
+    if entry is None:
+        # пул пуст или пользователь видел всё — один раз ждём пополнения
+        await callback.message.edit_text("⏳ Подбираю новое слово...")
+        await word_pool.wait_refill()
+        entry = word_pool.pick(uid)
+
+    if entry is None:
         await callback.message.edit_text("❌ Не удалось получить уникальное слово.")
         return
 
+    word, meaning, example = entry["word"], entry["meaning"], entry["example"]
+
     text = (
         f"<b>📘 Слово дня:</b> <i>{word}</i>\n\n"
         f"<b>Значение:</b> {escape(meaning)}\n"
@@ -2362,28 +3552,21 @@ async def handle_vocab_review(callback: CallbackQuery, state: FSMContext):
         return
     
     await callback.answer()
-    await callback.message.delete()
-
-    vocab = user_vocab.get(uid, [])
-    if not vocab:
-        await callback.message.edit_text("📓 В твоём словаре пока нет слов для повторения.")
-        return
+    await callback.message.delete()
 
-    now = datetime.utcnow()
-    due_words = []
-    for i, entry in enumerate(vocab):
-        last = datetime.fromisoformat(entry.get("last_reviewed", now.isoformat()))
-        level = entry.get("review_level", 0)
-        interval_days = [0, 1, 2, 4, 7, 14, 30]
-        interval = interval_days[min(level, len(interval_days) - 1)]
-        if (now - last).days >= interval:
-            due_words.append((i, entry))
+    if not user_vocab.get(uid):
+        await callback.message.answer("📓 В твоём словаре пока нет слов для повторения.")
+        return
 
+    due_words = vocab_due_index.due_for_user(uid, datetime.utcnow())
     if not due_words:
-        await callback.message.edit_text("✅ У тебя нет слов, которые нужно повторить прямо сейчас.")
+        await callback.message.answer("✅ У тебя нет слов, которые нужно повторить прямо сейчас.")
         return
 
-    await state.update_data(queue=due_words, index=0)
+    # в очереди лежат id записей (FSM-хранилище может сериализовать данные):
+    # позиция в колбэке — индекс в очереди, поэтому удаление слов во время
+    # повторения не сдвигает ответы на чужие слова
+    await state.update_data(queue=[entry["id"] for entry in due_words], index=0)
     await state.set_state(VocabReview.reviewing)
     await send_next_review_word(callback.message.chat.id, state)
 
@@ -2392,17 +3575,23 @@ async def send_next_review_word(uid: int, state: FSMContext):
     queue = data.get("queue", [])
     index = data.get("index", 0)
 
-    if index >= len(queue):
-        await bot.send_message(uid, "✅ Все слова повторены!", **thread_kwargs(message))
+    entry = None
+    while index < len(queue):
+        entry = vocab_due_index.get(queue[index])
+        if entry is not None:
+            break
+        index += 1  # слово удалили, пока шло повторение
+    if entry is None:
+        await bot.send_message(uid, "✅ Все слова повторены!")
         await state.clear()
         return
-
-    i, entry = queue[index]
+    if index != data.get("index", 0):
+        await state.update_data(index=index)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
     [
-        InlineKeyboardButton(text="✅ Помню", callback_data=f"review_remember:{i}"),
-        InlineKeyboardButton(text="❌ Не помню", callback_data=f"review_forget:{i}")
+        InlineKeyboardButton(text="✅ Помню", callback_data=f"review_remember:{index}"),
+        InlineKeyboardButton(text="❌ Не помню", callback_data=f"review_forget:{index}")
     ],
     [
         InlineKeyboardButton(text="⏭ Пропустить", callback_data="review_skip"),
@@ -2414,22 +3603,31 @@ async def send_next_review_word(uid: int, state: FSMContext):
         uid,
         f"<b>{entry['word']}</b> — {entry['meaning']}\n\n<i>{entry['example']}</i>",
         reply_markup=keyboard,
-        parse_mode="HTML",
-        **thread_kwargs(message))
+        parse_mode="HTML")
+
+async def _review_entry(state: FSMContext, callback: CallbackQuery) -> dict | None:
+    data = await state.get_data()
+    queue = data.get("queue", [])
+    pos = int(callback.data.split(":")[1])
+    if 0 <= pos < len(queue):
+        return vocab_due_index.get(queue[pos], callback.from_user.id)
+    return None
 
 @dp.callback_query(F.data.startswith("review_remember:"))
 async def review_remember(callback: CallbackQuery, state: FSMContext):
     uid = callback.from_user.id
-    i = int(callback.data.split(":")[1])
-    user_vocab[uid][i]["review_level"] = min(user_vocab[uid][i].get("review_level", 0) + 1, 5)
-    user_vocab[uid][i]["last_reviewed"] = datetime.utcnow().isoformat()
-    save_vocab(user_vocab)
+    entry = await _review_entry(state, callback)
+    if entry is not None:
+        entry["review_level"] = min(entry.get("review_level", 0) + 1, 5)
+        entry["last_reviewed"] = datetime.utcnow().isoformat()
+        refresh_next_due(uid, entry)
+        save_vocab(uid)
 
     uid_str = str(uid)
     user_stats = review_stats.get(uid_str, {"correct": 0, "wrong": 0})
     user_stats["correct"] += 1
     review_stats[uid_str] = user_stats
-    save_review_stats()
+    save_review_stats(uid_str)
     await check_achievements(uid, callback)
 
 
@@ -2443,16 +3641,18 @@ async def review_remember(callback: CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data.startswith("review_forget:"))
 async def review_forget(callback: CallbackQuery, state: FSMContext):
     uid = callback.from_user.id
-    i = int(callback.data.split(":")[1])
-    user_vocab[uid][i]["review_level"] = max(user_vocab[uid][i].get("review_level", 0) - 1, 0)
-    user_vocab[uid][i]["last_reviewed"] = datetime.utcnow().isoformat()
-    save_vocab(user_vocab)
+    entry = await _review_entry(state, callback)
+    if entry is not None:
+        entry["review_level"] = max(entry.get("review_level", 0) - 1, 0)
+        entry["last_reviewed"] = datetime.utcnow().isoformat()
+        refresh_next_due(uid, entry)
+        save_vocab(uid)
 
     uid_str = str(uid)
     user_stats = review_stats.get(uid_str, {"correct": 0, "wrong": 0})
     user_stats["wrong"] += 1
     review_stats[uid_str] = user_stats
-    save_review_stats()
+    save_review_stats(uid_str)
 
     data = await state.get_data()
     data["index"] += 1
@@ -2495,7 +3695,7 @@ async def handle_vocab_stats(callback: CallbackQuery):
         level = entry.get("level", 1)
         levels[level] = levels.get(level, 0) + 1
 
-        due = entry.get("next_review")
+        due = entry.get("next_due")
         if due:
             try:
                 due_dt = datetime.fromisoformat(due)
@@ -2525,15 +3725,8 @@ async def handle_vocab_stats(callback: CallbackQuery):
 async def confirm_add_word(callback: CallbackQuery, state: FSMContext):
     uid = callback.from_user.id
     data = await state.get_data()
-    entry = {
-        "word": data["word"],
-        "meaning": data["meaning"],
-        "example": data["example"],
-        "last_reviewed": datetime.utcnow().isoformat(),
-        "review_level": 0
-    }
-    user_vocab.setdefault(uid, []).append(entry)
-    save_vocab(user_vocab)
+    add_vocab_entry(uid, data["word"], data["meaning"], data["example"])
+    save_vocab(uid)
     await callback.message.edit_text(f"✅ Слово <b>{data['word']}</b> добавлено в твой словарь.")
     await state.clear()
 
@@ -2560,7 +3753,8 @@ async def handle_vocab_delete(callback: CallbackQuery):
 
     if 0 <= index < len(vocab):
         deleted_word = vocab.pop(index)
-        save_vocab(user_vocab)
+        vocab_due_index.remove(uid, deleted_word)
+        save_vocab(uid)
         await callback.answer(f"Удалено: {deleted_word['word']}", show_alert=True)
     else:
         await callback.answer("❌ Не удалось найти слово для удаления.")
@@ -2606,7 +3800,7 @@ async def save_new_value(message: Message, state: FSMContext):
 
     if 0 <= index < len(vocab) and field in ["word", "meaning", "example"]:
         vocab[index][field] = new_value
-        save_vocab(user_vocab)
+        save_vocab(uid)
         await message.answer(f"✅ Обновлено: <b>{field}</b> → {new_value}", **thread_kwargs(message))
     else:
         await message.answer("❌ Ошибка при обновлении.", **thread_kwargs(message))
@@ -2618,7 +3812,7 @@ async def save_new_value(message: Message, state: FSMContext):
 
 
 @dp.callback_query(F.data.in_({"review_remember", "review_forget"}))
-async def handle_review_response(callback: CallbackQuery):
+async def handle_review_response(callback: CallbackQuery, state: FSMContext):
     uid = callback.from_user.id
     await callback.answer()
 
@@ -2627,16 +3821,710 @@ async def handle_review_response(callback: CallbackQuery):
         await callback.message.edit_text("Нет слов для повторения.")
         return
 
-    current = vocab[0]  # первое слово — текущее
+    # напоминание показывает самое «старое» созревшее слово — его и отмечаем
+    due = vocab_due_index.due_for_user(uid, datetime.utcnow())
+    current = due[0] if due else vocab[0]
     if callback.data == "review_remember":
         current["review_level"] = current.get("review_level", 0) + 1
     else:
         current["review_level"] = 0  # сбрасываем
 
     current["last_reviewed"] = datetime.utcnow().isoformat()
-    save_vocab(user_vocab)
+    refresh_next_due(uid, current)
+    save_vocab(uid)
+
+    await handle_vocab_review(callback, state)  # повторяем следующий
+
+# ---------------------- Структурированные ответы Gemini ---------------------- #
+# Для мест, где нужен разбор ответа, модель получает response_mime_type=application/json
+# и схему; результат проверяется в dataclass. Невалидный ответ сначала чиним локально,
+# потом одним дешёвым запросом «исправь JSON» — и только затем сдаёмся.
+
+class StructuredOutputError(ValueError):
+    pass
+
+def extract_json(raw: str):
+    """JSON из ответа модели: снимает ```json-обёртку, текст вокруг и висячие запятые."""
+    text = raw.strip()
+    fenced = re.search(r"```(?:json)?\s*([\s\S]+?)```", text)
+    if fenced:
+        text = fenced.group(1).strip()
+    starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+    if starts:
+        text = text[min(starts):]
+    text = re.sub(r",\s*([\]}])", r"\1", text)
+    return json.JSONDecoder().raw_decode(text)[0]
+
+def _str_field(raw, name: str) -> str:
+    value = raw.get(name) if isinstance(raw, dict) else None
+    if not isinstance(value, (str, int, float)) or not str(value).strip():
+        raise ValueError(f"поле {name!r} пустое")
+    return str(value).strip()
+
+def _object_schema(*names: str, **extra) -> dict:
+    props = {name: {"type": "STRING"} for name in names}
+    props.update(extra)
+    return {"type": "OBJECT", "properties": props, "required": list(props)}
+
+@dataclass
+class GrammarItem:
+    question: str
+    answer: str
+
+    SCHEMA: ClassVar[dict] = _object_schema("question", "answer")
+
+    @classmethod
+    def parse(cls, raw) -> "GrammarItem":
+        question = re.sub(r"\*+", "", _str_field(raw, "question"))
+        question = re.sub(r"(?i)^Вопрос[:\-\s]*", "", question)
+        question = re.sub(r"_{3,}", "____", question)
+        answer = _str_field(raw, "answer").strip("\"'«»")
+        if question.count("____") != 1:
+            raise ValueError("нужен ровно один пропуск ____")
+        if not normalize_text(answer) or len(answer.split()) > 4:
+            raise ValueError("ответ должен быть короткой формой глагола")
+        return cls(question, answer)
+
+@dataclass
+class QuizItem:
+    question: str
+    options: dict[str, str]
+    answer: str
+
+    SCHEMA: ClassVar[dict] = _object_schema(
+        "question", "answer", options=_object_schema("A", "B", "C", "D")
+    )
+
+    @classmethod
+    def parse(cls, raw) -> "QuizItem":
+        question = _str_field(raw, "question")
+        options = raw.get("options")
+        if isinstance(options, list) and len(options) == 4:
+            options = dict(zip("ABCD", options))
+        if not isinstance(options, dict):
+            raise ValueError("options должен быть объектом A–D")
+        options = {str(k).strip().upper()[:1]: str(v).strip() for k, v in options.items()}
+        if sorted(options) != list("ABCD") or not all(options.values()):
+            raise ValueError("нужны четыре непустых варианта A–D")
+        if len({v.lower() for v in options.values()}) != 4:
+            raise ValueError("варианты повторяются")
+        answer = _str_field(raw, "answer").upper()[:1]
+        if answer not in options:
+            raise ValueError("answer должен быть одной из букв A–D")
+        return cls(question, {k: options[k] for k in "ABCD"}, answer)
+
+@dataclass
+class WordCard:
+    word: str
+    meaning: str
+    example: str
+
+    SCHEMA: ClassVar[dict] = _object_schema("word", "meaning", "example")
+    STOPLIST: ClassVar[set] = {"hello", "cat", "dog", "yes", "no", "good", "bad", "thank", "thanks"}
+
+    @classmethod
+    def parse(cls, raw) -> "WordCard":
+        word = _str_field(raw, "word").strip("\"'«»*")
+        meaning = _str_field(raw, "meaning")
+        example = _str_field(raw, "example")
+        if not re.fullmatch(r"[A-Za-z][A-Za-z' -]{1,40}", word) or len(word.split()) > 3:
+            raise ValueError("слово должно быть английским, до трёх слов")
+        if word.lower() in cls.STOPLIST:
+            raise ValueError("слишком простое слово")
+        if not re.search(r"[А-Яа-яЁё]", meaning):
+            raise ValueError("значение должно быть на русском")
+        # пример должен использовать слово (допускаем другую форму: -s, -ed, -ing)
+        if word.lower()[:max(3, len(word) - 2)] not in example.lower():
+            raise ValueError("пример не содержит слово")
+        return cls(word, meaning, example)
+
+@dataclass
+class DialogueTurn:
+    speaker: str
+    en: str
+    ru: str
+
+    SCHEMA: ClassVar[dict] = _object_schema("speaker", "en", "ru")
+
+    @classmethod
+    def parse(cls, raw) -> "DialogueTurn":
+        speaker = str(raw.get("speaker") or "…").strip() if isinstance(raw, dict) else "…"
+        return cls(
+            speaker,
+            re.sub(r"\*+", "", _str_field(raw, "en")).strip(),
+            re.sub(r"\*+", "", _str_field(raw, "ru")).strip(),
+        )
+
+@dataclass
+class Dialogue:
+    title: str
+    dialogue: list[DialogueTurn]
+
+    SCHEMA: ClassVar[dict] = _object_schema(
+        "title", dialogue={"type": "ARRAY", "items": DialogueTurn.SCHEMA}
+    )
+
+    @classmethod
+    def parse(cls, raw) -> "Dialogue":
+        turns = []
+        for turn in (raw.get("dialogue") if isinstance(raw, dict) else None) or []:
+            try:
+                turns.append(DialogueTurn.parse(turn))
+            except ValueError:
+                continue
+        if not turns:
+            raise ValueError("в диалоге нет реплик")
+        return cls(str(raw.get("title") or "Диалог").strip(), turns)
+
+@dataclass
+class VocabDefinition:
+    meaning: str
+    example: str
+
+    SCHEMA: ClassVar[dict] = _object_schema("meaning", "example")
+
+    @classmethod
+    def parse(cls, raw) -> "VocabDefinition":
+        return cls(_str_field(raw, "meaning"), _str_field(raw, "example"))
+
+# место вызова → счётчики: сразу валидно / починено локально / починено моделью / сбой
+structured_stats: dict[str, dict[str, int]] = defaultdict(
+    lambda: {"calls": 0, "ok": 0, "repaired": 0, "model_repaired": 0, "failed": 0, "dropped": 0}
+)
+
+def parse_structured(cls, data, many: bool = False, stats: dict | None = None):
+    """Проверяет разобранный JSON. В режиме many отбрасывает плохие элементы, но не все."""
+    if not many:
+        return cls.parse(data)
+    if not isinstance(data, list):
+        raise ValueError("ожидался JSON-массив")
+    items = []
+    for raw in data:
+        try:
+            items.append(cls.parse(raw))
+        except (ValueError, TypeError, AttributeError):
+            continue
+    if stats is not None:
+        stats["dropped"] += len(data) - len(items)
+    if not items:
+        raise ValueError("в массиве нет ни одного корректного элемента")
+    return items
+
+async def gemini_json(site: str, prompt: str, cls, *, many: bool = False, uid=None,
+                      priority: int = PRIORITY_INTERACTIVE, profile: str = "micro"):
+    """
+    Запрос с JSON-схемой cls.SCHEMA (или массивом таких объектов, если many).
+    Возвращает экземпляр(ы) cls либо бросает StructuredOutputError.
+    """
+    schema = {"type": "ARRAY", "items": cls.SCHEMA} if many else cls.SCHEMA
+    config = {"response_mime_type": "application/json", "response_schema": schema}
+    stats = structured_stats[site]
+    stats["calls"] += 1
+
+    resp = await gemini_generate(
+        [{"role": "user", "parts": [prompt]}],
+        uid=uid, priority=priority, profile=profile, generation_config=config,
+    )
+    text = resp.text
+    try:
+        result = parse_structured(cls, json.loads(text), many, stats)
+        stats["ok"] += 1
+        return result
+    except (ValueError, TypeError, AttributeError) as e:
+        error = e
+
+    try:
+        result = parse_structured(cls, extract_json(text), many, stats)
+        stats["repaired"] += 1
+        return result
+    except (ValueError, TypeError, AttributeError) as e:
+        error = e
+
+    fix_prompt = (
+        "Исправь этот JSON так, чтобы он соответствовал схеме ответа. "
+        f"Ошибка: {error}. Верни только исправленный JSON.\n\n{text[:8000]}"
+    )
+    try:
+        resp = await gemini_generate(
+            [{"role": "user", "parts": [fix_prompt]}],
+            uid=uid, priority=priority, profile=profile, generation_config=config,
+        )
+        result = parse_structured(cls, extract_json(resp.text), many, stats)
+        stats["model_repaired"] += 1
+        return result
+    except Exception as e:
+        stats["failed"] += 1
+        logging.warning(f"[STRUCTURED:{site}] Не удалось получить валидный ответ: {e}")
+        raise StructuredOutputError(f"{site}: {e}") from e
+
+def structured_stats_lines() -> list[str]:
+    return [
+        f"• {site}: {s['calls']} запр., сразу {s['ok']}, починено {s['repaired']}+{s['model_repaired']}, "
+        f"сбоев {s['failed']}, отброшено элементов {s['dropped']}"
+        for site, s in sorted(structured_stats.items())
+    ]
+
+async def define_word(word: str, uid=None) -> VocabDefinition:
+    prompt = (
+        f"Дай краткое определение на русском и пример для английского слова '{word}'. "
+        "Поля: meaning — значение, example — пример предложения на английском."
+    )
+    return await gemini_json("vocab_definition", prompt, VocabDefinition, uid=uid, profile="micro")
+
+# ---------------------- Банк упражнений ---------------------- #
+# Упражнения по грамматике и вопросы теста готовятся заранее пачками и лежат
+# в хранилище по ключу "вид:уровень"; нажатие на уровень только достаёт из банка
+# непросмотренный пользователем элемент. Проверка ответов остаётся локальной.
+EXERCISE_LEVELS = ("A1", "A2", "B1", "B2", "C1", "C2")
+EXERCISE_LOW_WATERMARK = 12   # меньше непросмотренных — пополняем в фоне
+EXERCISE_BATCH = 10
+EXERCISE_BANK_MAX = 300       # на ключ; старые элементы вытесняются
+EXERCISE_SEEN_MAX = 1000      # сколько id помним на пользователя
+
+def _grammar_prompt(level: str, n: int) -> str:
+    return (
+        f"Составь {n} разных грамматических упражнений уровня {level}. "
+        "Каждое — предложение на английском с одним пропуском ____ и глаголом в скобках; "
+        "ответ — только нужная форма глагола. Верни только JSON-массив без пояснений:\n"
+        '[{"question": "By the time we arrived, the train ____ (leave).", "answer": "had left"}]'
+    )
+
+def _quiz_prompt(level: str, n: int) -> str:
+    return (
+        f"Составь {n} разных тестовых вопросов по английскому языку для уровня {level}. "
+        "У каждого 4 варианта ответа (A, B, C, D) и ровно один правильный. "
+        "Верни только JSON-массив без пояснений:\n"
+        '[{"question": "What is the capital of France?", '
+        '"options": {"A": "London", "B": "Paris", "C": "Berlin", "D": "Madrid"}, "answer": "B"}]'
+    )
+
+class ExerciseBank:
+    KINDS = {
+        "grammar": (_grammar_prompt, GrammarItem),
+        "quiz": (_quiz_prompt, QuizItem),
+    }
+
+    def __init__(self, bank: dict[str, list], seen: dict[int, list]):
+        self.bank = bank      # "grammar:A1" → [{"id": ..., ...}, ...]
+        self.seen = seen      # uid → id просмотренных элементов
+        self._refills: dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def item_id(kind: str, question: str) -> str:
+        return hashlib.sha1(f"{kind}:{normalize_text(question)}".encode()).hexdigest()[:12]
+
+    def unseen(self, uid: int, kind: str, level: str) -> list[dict]:
+        seen = set(self.seen.get(uid, ()))
+        return [it for it in self.bank.get(f"{kind}:{level}", []) if it["id"] not in seen]
+
+    def take(self, uid: int, kind: str, level: str, count: int = 1) -> list[dict]:
+        """Мгновенно выдаёт до count непросмотренных элементов и помечает их просмотренными."""
+        fresh = self.unseen(uid, kind, level)
+        picked = fresh[:count]
+        if picked:
+            seen = self.seen.setdefault(uid, [])
+            seen.extend(it["id"] for it in picked)
+            del seen[:-EXERCISE_SEEN_MAX]
+            save_exercise_seen(uid)
+        if len(fresh) - len(picked) < EXERCISE_LOW_WATERMARK:
+            self.refill(kind, level)
+        return picked
+
+    async def wait_and_take(self, uid: int, kind: str, level: str, count: int = 1,
+                            exclude: set[str] | None = None) -> list[dict]:
+        """
+        Как take, но при пустом банке дожидается пополнения; в крайнем случае повторяет старое.
+        exclude — id, уже выданные вызывающим, их не повторяем и при повторе старого.
+        """
+        picked = self.take(uid, kind, level, count)
+        if len(picked) < count:
+            await self.refill(kind, level, PRIORITY_INTERACTIVE)
+            picked += self.take(uid, kind, level, count - len(picked))
+        if len(picked) < count:
+            ids = {it["id"] for it in picked} | (exclude or set())
+            rest = [it for it in self.bank.get(f"{kind}:{level}", []) if it["id"] not in ids]
+            picked += random.sample(rest, min(len(rest), count - len(picked)))
+        return picked
+
+    def refill(self, kind: str, level: str, priority: int = PRIORITY_BACKGROUND) -> asyncio.Task:
+        key = f"{kind}:{level}"
+        task = self._refills.get(key)
+        if task is None or task.done():
+            task = self._refills[key] = asyncio.create_task(self._refill(kind, level, priority))
+        return task
+
+    async def _refill(self, kind: str, level: str, priority: int) -> int:
+        key = f"{kind}:{level}"
+        make_prompt, cls = self.KINDS[kind]
+        try:
+            fresh = await gemini_json(
+                f"exercise_{kind}", make_prompt(level, EXERCISE_BATCH), cls,
+                many=True, priority=priority, profile="content",
+            )
+        except Exception as e:
+            logging.warning(f"[EXERCISES] Не удалось пополнить {key}: {e}")
+            return 0
+
+        items = self.bank.setdefault(key, [])
+        known = {it["id"] for it in items}
+        added = 0
+        for parsed in fresh:
+            item = asdict(parsed)
+            item["id"] = self.item_id(kind, item["question"])
+            if item["id"] in known:
+                continue
+            known.add(item["id"])
+            items.append(item)
+            added += 1
+        del items[:-EXERCISE_BANK_MAX]
+        if added:
+            save_exercise_bank(key)
+        logging.info(f"[EXERCISES] {key}: +{added}, всего {len(items)}")
+        return added
+
+    def warm(self):
+        """Фоновое пополнение всех ключей, где элементов меньше порога."""
+        for kind in self.KINDS:
+            for level in EXERCISE_LEVELS:
+                if len(self.bank.get(f"{kind}:{level}", [])) < EXERCISE_LOW_WATERMARK:
+                    self.refill(kind, level)
+
+def save_exercise_bank(key: str | None = None):
+    persist.mark_dirty("exercise_bank", key)
+
+def save_exercise_seen(uid: int | None = None):
+    persist.mark_dirty("exercise_seen", uid)
+
+exercise_bank_data: dict[str, list] = load_collection("exercise_bank", {})
+exercise_seen: dict[int, list] = {int(k): v for k, v in load_collection("exercise_seen", {}).items()}
+exercise_bank = ExerciseBank(exercise_bank_data, exercise_seen)
+
+# ---------------------- Пул «слова дня» ---------------------- #
+# Общий пул проверенных троек слово/значение/пример пополняется в фоне пачками;
+# выдача — локальный выбор слова, которого пользователь ещё не видел.
+WORD_POOL_BATCH = 40
+WORD_POOL_LOW_WATERMARK = 60  # меньше непросмотренных у пользователя — пополняем
+WORD_POOL_MAX = 3000
+WORD_HISTORY_MAX = 1000
+WORD_SEEN_CACHE_USERS = 5000  # для скольких пользователей держим множество просмотренных в памяти
+
+def word_hash(word: str) -> int:
+    return int.from_bytes(hashlib.blake2b(word.strip().lower().encode(), digest_size=8).digest(), "big")
+
+class WordOfDayPool:
+    def __init__(self, state: dict, history: dict[int, list[str]]):
+        self.state = state
+        self.words: list[dict] = state.setdefault("words", [])
+        self.history = history
+        self._hashes = {word_hash(w["word"]) for w in self.words}
+        self._generation = 0  # растёт при каждом изменении состава пула
+        # uid -> [хэши просмотренных, сколько слов пула не просмотрено, поколение пула для счётчика];
+        # держим только недавних пользователей, остальные восстанавливаются из истории
+        self._users: OrderedDict[int, list] = OrderedDict()
+        self._refill: asyncio.Task | None = None
+
+    def _user(self, uid: int) -> list:
+        rec = self._users.get(uid)
+        if rec is None:
+            rec = self._users[uid] = [{word_hash(w) for w in self.history.get(uid, [])}, 0, -1]
+            if len(self._users) > WORD_SEEN_CACHE_USERS:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(uid)
+        if rec[2] != self._generation:
+            # пул пополнился или обрезался — пересчёт идёт по истории (не больше WORD_HISTORY_MAX),
+            # а не по пулу, и только раз на пополнение
+            rec[1] = len(self._hashes) - sum(1 for h in rec[0] if h in self._hashes)
+            rec[2] = self._generation
+        return rec
+
+    def pick(self, uid: int) -> dict | None:
+        """Случайное непросмотренное слово; к модели не обращается."""
+        seen, unseen_left, _ = self._user(uid)
+        if unseen_left < WORD_POOL_LOW_WATERMARK:
+            self.refill()
+        if unseen_left <= 0:
+            return None
+        choice = None
+        # обычно хватает пары случайных проб
+        for _ in range(8):
+            cand = random.choice(self.words)
+            if word_hash(cand["word"]) not in seen:
+                choice = cand
+                break
+        if choice is None:
+            # пользователь видел почти весь пул. Свежие слова дописываются в конец, а
+            # просмотренных в пуле не больше WORD_HISTORY_MAX — столько шагов максимум
+            for cand in reversed(self.words):
+                if word_hash(cand["word"]) not in seen:
+                    choice = cand
+                    break
+        if choice is None:
+            return None
+        self.mark_seen(uid, choice["word"])
+        return choice
+
+    def mark_seen(self, uid: int, word: str):
+        rec = self._user(uid)
+        history = self.history.setdefault(uid, [])
+        history.append(word)
+        if len(history) > WORD_HISTORY_MAX:
+            dropped = history[:-WORD_HISTORY_MAX]
+            del history[:-WORD_HISTORY_MAX]
+            for w in dropped:
+                h = word_hash(w)
+                if h in rec[0]:
+                    rec[0].discard(h)
+                    if h in self._hashes:
+                        rec[1] += 1
+        h = word_hash(word)
+        if h not in rec[0]:
+            rec[0].add(h)
+            if h in self._hashes:
+                rec[1] -= 1
+        save_word_of_day_history(uid)
+
+    def refill(self) -> asyncio.Task:
+        if self._refill is None or self._refill.done():
+            self._refill = asyncio.create_task(self._generate(PRIORITY_BACKGROUND))
+        return self._refill
+
+    async def _generate(self, priority: int) -> int:
+        avoid = ", ".join(w["word"] for w in self.words[-60:])
+        prompt = (
+            f"Придумай {WORD_POOL_BATCH} разных полезных английских слов уровня B1–C1 "
+            "(не generic вроде 'hello'). Для каждого дай перевод на русский и короткий пример.\n"
+            + (f"Не используй слова: {avoid}.\n" if avoid else "")
+            + "Верни только JSON-массив без пояснений:\n"
+            '[{"word": "reluctant", "meaning": "неохотный", "example": "She was reluctant to leave."}]'
+        )
+        try:
+            cards = await gemini_json(
+                "word_of_day", prompt, WordCard, many=True, priority=priority, profile="content"
+            )
+        except Exception as e:
+            logging.warning(f"[WORD_POOL] Не удалось пополнить пул: {e}")
+            return 0
+        added = 0
+        for card in cards:
+            item = asdict(card)
+            h = word_hash(item["word"])
+            if h in self._hashes:
+                continue
+            self._hashes.add(h)
+            self.words.append(item)
+            added += 1
+        if len(self.words) > WORD_POOL_MAX:
+            for old in self.words[:-WORD_POOL_MAX]:
+                self._hashes.discard(word_hash(old["word"]))
+            del self.words[:-WORD_POOL_MAX]
+        if added:
+            self._generation += 1
+            save_word_pool()
+        logging.info(f"[WORD_POOL] +{added}, всего {len(self.words)}")
+        return added
+
+    async def wait_refill(self) -> int:
+        """Для холодного старта: ждём пополнения с интерактивным приоритетом."""
+        if self._refill is None or self._refill.done():
+            self._refill = asyncio.create_task(self._generate(PRIORITY_INTERACTIVE))
+        return await self._refill
+
+def save_word_pool():
+    persist.mark_dirty("word_pool")
+
+word_pool_state: dict = load_collection("word_pool", {})
+word_pool = WordOfDayPool(word_pool_state, user_word_of_day_history)
+
+# ---------------------- Кэш учебных материалов ---------------------- #
+# Диалоги по темам и планы курсов хранятся по ключу (вид, тема, уровень) в
+# нескольких вариантах. Пользователь получает варианты по кругу, а Gemini только
+# пополняет кэш в фоне — когда вариантов мало или они старше CONTENT_TTL.
+CONTENT_MIN_VARIANTS = 3
+CONTENT_MAX_VARIANTS = 6
+CONTENT_TTL = 7 * 24 * 3600
+CONTENT_RETRY_DELAY = 600     # после неудачной генерации не дёргаем модель 10 минут
+
+def _dialogue_prompt(topic: str, level: str) -> str:
+    return (
+        f"Ты — опытный преподаватель английского. Составь 3–5 коротких диалогов на тему «{topic}».\n"
+        "Ответь строго чистым JSON (без ```), в формате:\n"
+        "[\n"
+        "  {\n"
+        "    \"title\": \"Ordering Coffee\",\n"
+        "    \"dialogue\": [\n"
+        "      {\"speaker\": \"You\", \"en\": \"Hi, can I get a cappuccino to go, please?\", \"ru\": \"Здравствуйте, можно мне капучино с собой, пожалуйста?\"},\n"
+        "      {\"speaker\": \"VAI\", \"en\": \"Sure. What size would you like?\", \"ru\": \"Конечно. Какой размер вы бы хотели?\"}\n"
+        "    ]\n"
+        "  },\n"
+        "  …\n"
+        "]\n"
+        "Никаких Markdown‑ограждений, только чистый JSON-массив."
+    )
+
+def _course_prompt(topic: str, level: str) -> str:
+    return (
+        f"Ты — профессиональный преподаватель английского языка. "
+        f"Составь краткий учебный план для уровня {level}.\n"
+        "Перечисли 3–5 тем. Для каждой:\n"
+        "- Название (на русском и в скобках на английском)\n"
+        "- Краткое описание\n"
+        "- Задание\n\n"
+        "Не используй HTML, верни обычный текст. Пример:\n\n"
+        "Уровень: A2 (Pre-Intermediate)\n\n"
+        "Тема 1: Название (Title)\n"
+        "Описание: ...\n"
+        "Задание: ...\n\n"
+        "Тема 2: ..."
+    )
 
-    await handle_vocab_review(callback)  # повторяем следующий
+def _course_more_prompt(topic: str, level: str) -> str:
+    return (
+        f"Сгенерируй ещё 3–5 новых учебных тем для уровня {level} по английскому языку.\n"
+        "Формат:\n\n"
+        "• Тема: Название\n"
+        "Описание: ...\n"
+        "Задание: ..."
+    )
+
+def _parse_course(raw: str) -> str:
+    text = raw.strip()
+    if len(re.findall(r"Тема", text)) < 2:
+        raise ValueError("в плане меньше двух тем")
+    return text
+
+class ContentCache:
+    KINDS = {
+        "dialogue": (_dialogue_prompt, Dialogue),
+        "course": (_course_prompt, _parse_course),
+        "course_more": (_course_more_prompt, _parse_course),
+    }
+
+    def __init__(self, store: dict[str, dict]):
+        self.store = store    # ключ → {"variants": [{"id", "data", "created"}], "refreshed": ts}
+        self._cursor: dict[tuple[int, str], int] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._retry_at: dict[str, float] = {}
+        self._interactive: set[str] = set()   # ключи, чья текущая генерация интерактивная
+
+    @staticmethod
+    def make_key(kind: str, topic: str = "", level: str = "") -> str:
+        return f"{kind}:{topic.strip().lower()}:{level}"
+
+    def add_variant(self, key: str, data) -> bool:
+        entry = self.store.setdefault(key, {"variants": [], "refreshed": 0})
+        vid = hashlib.sha1(json.dumps(data, ensure_ascii=False, sort_keys=True).encode()).hexdigest()[:12]
+        if any(v["id"] == vid for v in entry["variants"]):
+            return False
+        entry["variants"].append({"id": vid, "data": data, "created": time.time()})
+        del entry["variants"][:-CONTENT_MAX_VARIANTS]
+        entry["refreshed"] = time.time()
+        save_content_cache(key)
+        return True
+
+    def get(self, uid: int, kind: str, topic: str = "", level: str = ""):
+        """Следующий для пользователя вариант или None, если кэш по ключу пуст."""
+        key = self.make_key(kind, topic, level)
+        entry = self.store.get(key)
+        variants = entry["variants"] if entry else []
+        if len(variants) < CONTENT_MIN_VARIANTS or time.time() - (entry or {}).get("refreshed", 0) > CONTENT_TTL:
+            self._schedule(kind, topic, level, PRIORITY_BACKGROUND)
+        if not variants:
+            return None
+        pos = self._cursor.get((uid, key))
+        if pos is None:
+            pos = random.randrange(len(variants))
+        self._cursor[(uid, key)] = pos + 1
+        return variants[pos % len(variants)]["data"]
+
+    async def fill(self, uid: int, kind: str, topic: str = "", level: str = ""):
+        """Холодный ключ: ждём генерации (с интерактивным приоритетом) и отдаём вариант."""
+        key = self.make_key(kind, topic, level)
+        task = self._tasks.get(key)
+        if task is not None and not task.done() and key not in self._interactive:
+            # фоновый прогрев стоит в конце очереди планировщика — не ждём его,
+            # а запускаем собственный интерактивный запрос (к нему присоединятся и другие)
+            task = self._tasks[key] = asyncio.create_task(
+                self._generate(key, kind, topic, level, PRIORITY_INTERACTIVE)
+            )
+            self._interactive.add(key)
+        else:
+            task = self._schedule(kind, topic, level, PRIORITY_INTERACTIVE, force=True)
+        if task is not None:
+            await task
+        return self.get(uid, kind, topic, level)
+
+    def _schedule(self, kind: str, topic: str, level: str, priority: int, force: bool = False):
+        key = self.make_key(kind, topic, level)
+        task = self._tasks.get(key)
+        if task is not None and not task.done():
+            return task
+        if not force and time.time() < self._retry_at.get(key, 0):
+            return None
+        task = self._tasks[key] = asyncio.create_task(self._generate(key, kind, topic, level, priority))
+        if priority == PRIORITY_INTERACTIVE:
+            self._interactive.add(key)
+        else:
+            self._interactive.discard(key)
+        return task
+
+    async def _generate(self, key: str, kind: str, topic: str, level: str, priority: int):
+        make_prompt, target = self.KINDS[kind]
+        try:
+            if isinstance(target, type):
+                # структурированный вид — через JSON-схему
+                parsed = await gemini_json(
+                    f"content_{kind}", make_prompt(topic, level), target,
+                    many=True, priority=priority, profile="content",
+                )
+                data = [asdict(item) for item in parsed]
+            else:
+                resp = await gemini_generate(
+                    [{"role": "user", "parts": [make_prompt(topic, level)]}],
+                    priority=priority, profile="content",
+                )
+                data = target(resp.text)
+        except Exception as e:
+            self._retry_at[key] = time.time() + CONTENT_RETRY_DELAY
+            logging.warning(f"[CONTENT] Не удалось сгенерировать {key}: {e}")
+            return
+        if not self.add_variant(key, data):
+            # модель повторилась — считаем ключ свежим, чтобы не крутить её зря
+            self.store[key]["refreshed"] = time.time()
+            save_content_cache(key)
+        logging.info(f"[CONTENT] {key}: вариантов {len(self.store[key]['variants'])}")
+
+    def seed_dialogues(self, library):
+        """Диалоги из learning/dialogues.json — как готовые варианты."""
+        if isinstance(library, dict):
+            items = [(topic, dialogs) for topic, dialogs in library.items()]
+        else:
+            items = [(d.get("topic", ""), d.get("dialogues") or [d]) for d in library if isinstance(d, dict)]
+        for topic, dialogs in items:
+            try:
+                parsed = parse_structured(Dialogue, dialogs if isinstance(dialogs, list) else [dialogs], many=True)
+            except ValueError:
+                continue
+            data = [asdict(item) for item in parsed]
+            if topic:
+                self.add_variant(self.make_key("dialogue", topic), data)
+
+    def warm(self, keys: list[tuple[str, str, str]]):
+        for kind, topic, level in keys:
+            if not self.store.get(self.make_key(kind, topic, level)):
+                self._schedule(kind, topic, level, PRIORITY_BACKGROUND)
+
+def save_content_cache(key: str | None = None):
+    persist.mark_dirty("content_cache", key)
+
+content_cache_data: dict[str, dict] = load_collection("content_cache", {})
+content_cache = ContentCache(content_cache_data)
+content_cache.seed_dialogues(dialogues)
+
+DIALOGUE_TOPICS = [
+    "Small Talk", "Airport", "Cafe", "Hotel", "Doctor", "Shopping", "Taxi", "Phone Call",
+    "In Class", "Making an Appointment", "Asking for Directions", "Job Interview", "Bank",
+]
 
 @dp.callback_query(F.data == "learn_grammar")
 async def handle_grammar(callback: CallbackQuery):
@@ -2656,38 +4544,24 @@ async def handle_grammar(callback: CallbackQuery):
 @dp.callback_query(F.data.startswith("grammar_level:"))
 async def handle_grammar_level(callback: CallbackQuery, state: FSMContext):
     level = callback.data.split(":", 1)[1]
-    await callback.answer(f"Генерирую упражнение для уровня {level}…")
-
-    prompt = (
-        f"Составь одно небольшое грамматическое упражнение уровня {level}. "
-        "Нужно ровно два поля (без лишнего текста):\n"
-        "1) Вопрос (на английском): предложение с одним пропуском ____ и глагол в скобках.\n"
-        "2) Ответ: только нужная форма глагола.\n\n"
-        "Пример:\n"
-        "Вопрос: By the time we arrived, the train ____ (leave).\n"
-        "Ответ: had left"
-    )
-    resp = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
-    raw = resp.text.strip()
+    uid = callback.from_user.id
+    await callback.answer()
 
-    # ищем блок "Ответ"
-    m = re.search(r"Ответ\s*[:\-]\s*(.+)", raw, flags=re.IGNORECASE)
-    if not m:
-        logging.error(f"[GRAMMAR:{level}] Bad response:\n{raw}")
+    items = exercise_bank.take(uid, "grammar", level)
+    if not items:
+        # банк уровня ещё пуст (первый запуск) — ждём пополнения
+        await callback.message.edit_text(f"⏳ Готовлю упражнения уровня {level}…")
+        items = await exercise_bank.wait_and_take(uid, "grammar", level)
+    if not items:
         kb_retry = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔁 Ещё раз", callback_data=f"grammar_level:{level}")],
             [InlineKeyboardButton(text="🔙 Назад", callback_data="learn_back")],
         ])
-        await callback.message.edit_text("❌ Не удалось распознать ответ. Попробуй ещё раз.", reply_markup=kb_retry)
+        await callback.message.edit_text("❌ Не удалось подготовить упражнение. Попробуй ещё раз.", reply_markup=kb_retry)
         return
 
-    # отделяем вопрос до "Ответ"
-    raw_q = raw.split("Ответ", 1)[0].strip()
-    # убираем любые '*' и метку "Вопрос:"
-    question = re.sub(r"\*+", "", raw_q)
-    question = re.sub(r"(?i)^Вопрос[:\-\s]*", "", question).strip()
-
-    correct = m.group(1).strip()
+    question = items[0]["question"]
+    correct = items[0]["answer"]
 
     await state.set_state(GrammarExercise.waiting_for_answer)
     await state.update_data(correct_answer=correct)
@@ -2751,7 +4625,7 @@ async def handle_note_type_choice(callback: CallbackQuery):
 
     if choice == "note":
         user_notes[user_id].append(original_text)
-        save_notes()
+        save_notes(user_id)
         await callback.message.edit_text("📝 Сохранил как заметку.")
     elif choice == "reminder":
         await callback.message.edit_text(
@@ -2782,25 +4656,28 @@ async def handle_timezone_setting(message: Message):
         value = normalize_city_name(value)
         geo = await geocode_city(value)
         if not geo or "timezone" not in geo:
+            hints = [p["name"] for p in city_index.complete(value, limit=3) if p.get("name")]
+            hint_line = f"Похожие города из справочника: {', '.join(h.capitalize() for h in hints)}\n" if hints else ""
             await message.answer(
                 f"❌ Не удалось определить часовой пояс для <b>{value}</b>.\n"
+                + hint_line +
                 "Попробуй указать другой город или написать: <code>Мой часовой пояс: Europe/Warsaw</code>"
             , **thread_kwargs(message))
             return
         tz_str = geo["timezone"]
 
         user_timezones[user_id] = tz_str
-        save_timezones(user_timezones)
+        save_timezones(user_id)
 
         await message.answer(
-            f"Запомнил: <b>{value.capitalize(**thread_kwargs(message))}</b> ✅\n"
+            f"Запомнил: <b>{value.capitalize()}</b> ✅\n"
             f"Теперь я буду использовать часовой пояс: <code>{tz_str}</code> для напоминаний."
-        )
+        , **thread_kwargs(message))
 
     else:
         tz_str = value
         user_timezones[user_id] = tz_str
-        save_timezones(user_timezones)
+        save_timezones(user_id)
 
         await message.answer(
             f"Часовой пояс установлен: <code>{tz_str}</code>. "
@@ -2835,12 +4712,12 @@ async def handle_formula_image(message: Message):
     notify_msg = await message.answer("🔄 Обрабатываю изображение, пожалуйста, подождите…", **thread_kwargs(message))
     # 1️⃣  — получаем байты картинки
     file_id = message.photo[-1].file_id if message.photo else message.document.file_id
-    tg_file = await bot.get_file(file_id)
-    url     = f"https://api.telegram.org/file/bot{TOKEN}/{tg_file.file_path}"
-
-    async with aiohttp.ClientSession() as sess:
-        async with sess.get(url) as r:
-            img_bytes = await r.read()
+    try:
+        img_bytes = await download_telegram_file(file_id)
+    except aiohttp.ClientError as e:
+        logging.warning(f"Ошибка скачивания изображения: {e}")
+        await notify_msg.edit_text("❌ Не удалось скачать изображение.")
+        return
 
     # 2️⃣  — распознаём формулу
     latex = await recognize_formula(img_bytes)
@@ -2857,17 +4734,15 @@ async def handle_formula_image(message: Message):
     user_images_text[message.from_user.id] = latex
 
     #     делаем маленькое превью, чтобы человек видел, что именно распознано
-    png_path = latex_to_png(latex)
-    try:
-        await bot.send_photo(
-            chat_id = message.chat.id,
-            photo   = FSInputFile(png_path, "formula.png", **thread_kwargs(message)),
-            caption = (f"Я вижу это 👆\n<code>{latex}</code>\n\n"
-                       "Спроси что‑нибудь об этом!"),
-            parse_mode = "HTML"
-        )
-    finally:
-        os.remove(png_path)
+    await send_latex_photo(
+        message.chat.id,
+        latex,
+        "formula.png",
+        caption = (f"Я вижу это 👆\n<code>{latex}</code>\n\n"
+                   "Спроси что‑нибудь об этом!"),
+        parse_mode = "HTML",
+        **thread_kwargs(message)
+    )
 
     # 🔚  больше ничего не делаем – ждём дальнейший вопрос пользователя
     return
@@ -2878,11 +4753,7 @@ async def handle_voice_message(message: Message):
     _register_message_stats(message)
     await message.answer("Секундочку, я обрабатываю ваше голосовое сообщение...", **thread_kwargs(message))
     try:
-        file = await bot.get_file(message.voice.file_id)
-        url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                voice_bytes = await resp.read()
+        voice_bytes = await download_telegram_file(message.voice.file_id)
     except Exception as e:
         logging.error(f"Ошибка скачивания голосового файла: {e}")
         return
@@ -2927,7 +4798,7 @@ async def delete_note(callback: CallbackQuery):
     notes = user_notes.get(uid, [])
     if 0 <= index < len(notes):
         notes.pop(index)
-        save_notes()
+        save_notes(uid)
     await show_notes(uid)
 
 @dp.callback_query(F.data == "note_delete_all")
@@ -2944,7 +4815,7 @@ async def confirm_delete_all_notes(callback: CallbackQuery):
 async def do_delete_all_notes(callback: CallbackQuery):
     uid = callback.from_user.id
     user_notes[uid] = []
-    save_notes()
+    save_notes(uid)
     await show_notes(uid, callback=callback)
 
 @dp.callback_query(F.data == "note_cancel_delete_all")
@@ -2981,7 +4852,7 @@ async def delete_reminder(callback: CallbackQuery):
     if 0 <= index < len(user_reminders):
         real_index = user_reminders[index][0]
         reminders.pop(real_index)
-        save_reminders()
+        save_reminders(uid)
     await show_reminders(uid, callback=callback)
 
 @dp.callback_query(F.data.startswith("reminder_edit:"))
@@ -3091,9 +4962,12 @@ async def edit_reminder_time(message: Message, state: FSMContext):
         dt_localized = local_tz.localize(dt_local)
         dt_utc = dt_localized.astimezone(pytz.utc)
 
-        reminders[index] = (user_id, dt_utc, new_text)
-        save_reminders()
-        await message.answer(f"✅ Напоминание обновлено: <b>{new_text}</b> — <code>{dt_local.strftime('%d.%m.%Y %H:%M', **thread_kwargs(message))}</code> ({tz_str})")
+        item = (user_id, dt_utc, new_text)
+        reminders[index] = item
+        save_reminders(user_id)
+        # старая запись останется в куче, но при срабатывании её уже не будет в reminders
+        reminder_scheduler.schedule(item)
+        await message.answer(f"✅ Напоминание обновлено: <b>{new_text}</b> — <code>{dt_local.strftime('%d.%m.%Y %H:%M')}</code> ({tz_str})", **thread_kwargs(message))
     except Exception as e:
         logging.exception(f"[REMINDER_EDIT] Ошибка: {e}")
         await message.answer("❌ Не удалось обновить напоминание.", **thread_kwargs(message))
@@ -3154,7 +5028,7 @@ async def do_delete_all_reminders(callback: CallbackQuery):
     uid = callback.from_user.id
     global reminders
     reminders = [r for r in reminders if r[0] != uid]
-    save_reminders()
+    save_reminders(uid)
     await show_reminders(uid, callback=callback)
 
 @dp.callback_query(F.data == "reminder_cancel_delete_all")
@@ -3228,9 +5102,11 @@ async def process_reminder_text(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    reminders.append((user_id, dt_utc, text))
-    save_reminders()
-    await message.answer(f"✅ Напоминание установлено на <code>{dt_local.strftime('%Y-%m-%d %H:%M', **thread_kwargs(message))}</code> ({tz_str})")
+    item = (user_id, dt_utc, text)
+    reminders.append(item)
+    save_reminders(user_id)
+    reminder_scheduler.schedule(item)
+    await message.answer(f"✅ Напоминание установлено на <code>{dt_local.strftime('%Y-%m-%d %H:%M')}</code> ({tz_str})", **thread_kwargs(message))
     await state.clear()
 
 from datetime import timedelta
@@ -3254,17 +5130,18 @@ async def handle_reminder(message: Message):
         date = reminder_data.get("date")
         time = reminder_data.get("time")
         if date and time:
-            dt_local = datetime.combine(date, time)
+            dt_local = local_tz.localize(datetime.combine(date, time))
         else:
             # Иначе — ближайшая минута
             dt_local = datetime.now(local_tz) + timedelta(minutes=1)
 
-        dt_localized = local_tz.localize(dt_local)
-        dt_utc = dt_localized.astimezone(pytz.utc)
+        dt_utc = dt_local.astimezone(pytz.utc)
 
-        reminders.append((user_id, dt_utc, reminder_data["text"]))
-        save_reminders()
-        await message.answer(f"✅ Напоминание установлено на <code>{dt_local.strftime('%Y-%m-%d %H:%M', **thread_kwargs(message))}</code> ({tz_str})")
+        item = (user_id, dt_utc, reminder_data["text"])
+        reminders.append(item)
+        save_reminders(user_id)
+        reminder_scheduler.schedule(item)
+        await message.answer(f"✅ Напоминание установлено на <code>{dt_local.strftime('%Y-%m-%d %H:%M')}</code> ({tz_str})", **thread_kwargs(message))
     except Exception as e:
         logging.exception(f"[DELAYED_REMINDER] Ошибка: {e}")
         await message.answer("❌ Не удалось установить напоминание.", **thread_kwargs(message))
@@ -3278,32 +5155,15 @@ async def handle_add_vocab(message: Message):
         await message.answer("Формат: <code>Добавь слово: example</code>", **thread_kwargs(message))
         return
 
-    prompt = (
-        f"Дай краткое определение и пример для английского слова '{word_raw}'. "
-        "Ответ в формате:\n"
-        "Значение: ...\nПример: ..."
-    )
-
     try:
-        response = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
-        raw = response.text.strip().split("\n")
-        meaning = raw[0].replace("Значение:", "").strip()
-        example = raw[1].replace("Пример:", "").strip()
-        from datetime import datetime
-        entry = {
-            "word": word_raw,
-            "meaning": meaning,
-            "example": example,
-            "last_reviewed": datetime.utcnow().isoformat(),
-            "review_level": 0
-        }
-
-        user_vocab.setdefault(uid, []).append(entry)
-        save_vocab(user_vocab)
-        await message.answer(f"✅ Слово <b>{word_raw}</b> добавлено в твой словарь.", message=message)
+        definition = await define_word(word_raw, uid=uid)
+        meaning, example = definition.meaning, definition.example
+        add_vocab_entry(uid, word_raw, meaning, example)
+        save_vocab(uid)
+        await message.answer(f"✅ Слово <b>{word_raw}</b> добавлено в твой словарь.", **thread_kwargs(message))
     except Exception as e:
         logging.exception(f"[VOCAB_ADD] Ошибка: {e}")
-        await message.answer("❌ Не удалось добавить слово.", message=message)
+        await message.answer("❌ Не удалось добавить слово.", **thread_kwargs(message))
 
 @dp.message(F.text == "📝 Мои заметки")
 async def handle_notes_button(message: Message):
@@ -3336,28 +5196,12 @@ async def handle_vocab_word_input(message: Message, state: FSMContext):
         await message.answer("❌ Слово слишком короткое. Попробуй снова.", **thread_kwargs(message))
         return
 
-    prompt = (
-        f"Дай краткое определение и пример для английского слова '{word_raw}'. "
-        "Ответ в формате:\n"
-        "Значение: ...\nПример: ..."
-    )
-
     try:
-        response = await model.generate_content_async([{"role": "user", "parts": [prompt]}])
-        raw = response.text.strip().split("\n")
-        meaning = raw[0].replace("Значение:", "").strip()
-        example = raw[1].replace("Пример:", "").strip()
-
-        entry = {
-            "word": word_raw,
-            "meaning": meaning,
-            "example": example,
-            "last_reviewed": datetime.utcnow().isoformat(),
-            "review_level": 0
-        }
+        definition = await define_word(word_raw, uid=uid)
+        meaning, example = definition.meaning, definition.example
 
-        user_vocab.setdefault(uid, []).append(entry)
-        save_vocab(user_vocab)
+        add_vocab_entry(uid, word_raw, meaning, example)
+        save_vocab(uid)
 
         await message.answer(
             f"✅ Слово <b>{word_raw}</b> добавлено в твой словарь.\n"
@@ -3411,7 +5255,7 @@ async def show_reminders(uid: int, callback: CallbackQuery = None):
     now_utc = datetime.utcnow().replace(tzinfo=pytz.utc)
     global reminders
     reminders = [r for r in reminders if not (r[0] == uid and r[1] <= now_utc)]
-    save_reminders()
+    save_reminders(uid)
     
     user_rem = [(i, r) for i, r in enumerate(reminders) if r[0] == uid]
     if callback:
@@ -3486,7 +5330,7 @@ async def handle_all_messages(message: Message):
         await message.reply("🎤 Генерирую ответ и озвучиваю...", **thread_kwargs(message))
 
         try:
-            response = await model.generate_content_async([{"role": "user", "parts": [cleaned]}])
+            response = await gemini_generate([{"role": "user", "parts": [cleaned]}], uid=message.from_user.id)
             reply_text = response.text.strip()
 
             # --------------- (ИЗМЕНЕНО) Очистим лишние символы. ---------------
@@ -3513,7 +5357,7 @@ async def _handle_all_messages_core(message: Message, user_input: str, uid: int,
     # ─────────── Обработка новостей от пользователя ───────────
     lower_input = user_input.lower()
     if "новости" in lower_input or lower_input.startswith("новости") or "последние новости" in lower_input:
-        snippets = web_search(user_input)
+        snippets = await web_search(user_input)
         if snippets:
             await message.answer(
                 f"⚡ Вот что нашёл в Google по запросу «{user_input}»:\n{snippets}",
@@ -3528,14 +5372,14 @@ async def _handle_all_messages_core(message: Message, user_input: str, uid: int,
         data = pending_note_or_reminder.pop(uid)
         if data["type"] == "note":
             user_notes[uid].append(user_input)
-            save_notes()
+            save_notes(uid)
             await show_notes(uid)
             return
         elif data["type"] == "edit_note":
             index = data.get("index")
             if index is not None and 0 <= index < len(user_notes.get(uid, [])):
                 user_notes[uid][index] = user_input
-                save_notes()
+                save_notes(uid)
                 await show_notes(uid)
             else:
                 await message.answer("Не удалось найти заметку для редактирования.", **thread_kwargs(message))
@@ -3582,25 +5426,17 @@ async def _handle_all_messages_core(message: Message, user_input: str, uid: int,
                        f"(id: <code>{uid}</code>):\n\n{caption}")
             sent_msg = None
             if message.photo:
-                file = await bot.get_file(message.photo[-1].file_id)
-                url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url) as resp:
-                        photo_bytes = await resp.read()
-                sent_msg = await bot.send_photo(chat_id=ADMIN_ID, photo=BufferedInputFile(photo_bytes, filename="image.jpg", **thread_kwargs(message)), caption=content)
+                photo_bytes = await download_telegram_file(message.photo[-1].file_id)
+                sent_msg = await bot.send_photo(chat_id=ADMIN_ID, photo=BufferedInputFile(photo_bytes, filename="image.jpg"), caption=content)
             elif message.video:
-                file = await bot.get_file(message.video.file_id)
-                url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url) as resp:
-                        video_bytes = await resp.read()
-                sent_msg = await bot.send_video(chat_id=ADMIN_ID, video=BufferedInputFile(video_bytes, filename="video.mp4", **thread_kwargs(message)), caption=content)
+                video_bytes = await download_telegram_file(message.video.file_id)
+                sent_msg = await bot.send_video(chat_id=ADMIN_ID, video=BufferedInputFile(video_bytes, filename="video.mp4"), caption=content)
             else:
                 for support_id in SUPPORT_IDS:
                     try:
                         sent_msg = await bot.send_message(chat_id=support_id, text=content, **thread_kwargs(message))
                         support_reply_map[(sent_msg.chat.id, sent_msg.message_id)] = uid
-                        save_support_map()
+                        save_support_map((sent_msg.chat.id, sent_msg.message_id))
                     except Exception as e:
                         logging.exception(f"[BOT] Не удалось отправить сообщение в поддержку ({support_id}): {e}")
             await message.answer("Сообщение отправлено в поддержку.", **thread_kwargs(message))
@@ -3631,17 +5467,7 @@ async def _handle_all_messages_core(message: Message, user_input: str, uid: int,
     # Если пользователь отправил документ
     if message.document:
         stats["files_received"] += 1
-        file = await bot.get_file(message.document.file_id)
-        url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                file_bytes = await resp.read()
-        text = extract_text_from_file(message.document.file_name, file_bytes)
-        if text:
-            user_documents[uid] = text
-            await message.answer("✅ Файл получен! Можешь задать вопрос по его содержимому.", **thread_kwargs(message))
-        else:
-            await message.answer("⚠️ Не удалось извлечь текст из файла.", **thread_kwargs(message))
+        await process_document(message, uid)
         return
 
     # Проверка запроса на ответ голосом
@@ -3708,17 +5534,28 @@ async def _handle_all_messages_core(message: Message, user_input: str, uid: int,
         return
 
     # Проверка на вопрос по файлу (исправленная позиция, после return)
-    if uid in user_documents:
-        file_content = user_documents[uid]
-        prompt_with_file = (f"Пользователь отправил файл со следующим содержимым:\n\n{file_content}\n\n"
+    document = user_documents.get(uid)
+    if document is not None:
+        file_content = document.context_for(user_input)
+        partial = "" if document.complete else " Файл ещё дочитывается — пока доступно только его начало."
+        prompt_with_file = (f"Пользователь отправил файл «{document.name}».{partial} Фрагменты его содержимого "
+                            f"(в квадратных скобках — {document.page_label}):\n\n{file_content}\n\n"
                             f"Теперь пользователь задаёт вопрос:\n\n{user_input}\n\n"
-                            f"Ответь чётко и кратко, основываясь на содержимом файла.")
-        gemini_text = await generate_and_send_gemini_response(cid, prompt_with_file, False, "", "")
-
+                            f"Ответь чётко и кратко, основываясь на содержимом файла. "
+                            f"Указывай, откуда взят ответ, например ({document.page_label} 3). "
+                            f"Если во фрагментах ответа нет — так и скажи.")
         if voice_response_requested:
+            gemini_text = await generate_and_send_gemini_response(
+                cid, prompt_with_file, False, "", "", uid=uid
+            )
             await send_voice_message(cid, gemini_text, message=message)
         else:
-            await message.answer(gemini_text, **thread_kwargs(message))
+            reply = StreamedReply(cid, **thread_kwargs(message))
+            gemini_text = await generate_and_send_gemini_response(
+                cid, prompt_with_file, False, "", "", stream_to=reply, uid=uid
+            )
+            if not reply.delivered and gemini_text:
+                await message.answer(gemini_text, **thread_kwargs(message))
         return
 
     # Все остальные запросы идут сюда:
@@ -3822,6 +5659,165 @@ def format_gemini_response(text: str) -> str:
 
     return text
 
+# ---------------------- Потоковый вывод Gemini ---------------------- #
+STREAM_EDIT_INTERVAL = 1.2   # не чаще одного редактирования в ~секунду на чат
+STREAM_MIN_GROWTH = 40       # мелкие приросты копим до следующего редактирования
+
+class StreamedReply:
+    """
+    Сообщение, которое растёт по мере генерации ответа.
+    Первый фрагмент отправляется сразу, дальше сообщение редактируется не чаще
+    STREAM_EDIT_INTERVAL; при переполнении TELEGRAM_MSG_LIMIT текущее сообщение
+    «замораживается» и продолжение уходит в новое.
+    """
+
+    def __init__(self, chat_id: int, **send_kwargs):
+        self.chat_id = chat_id
+        self.send_kwargs = send_kwargs
+        self.fmt = format_gemini_response
+        self.raw = ""
+        self.base = 0                      # начало текущего сообщения в self.raw
+        self.message_ids: list[int] = []
+        self.current_id: int | None = None
+        self.shown = ""                    # что сейчас показано в текущем сообщении
+        self.next_edit = 0.0
+
+    @property
+    def delivered(self) -> bool:
+        return bool(self.message_ids)
+
+    async def feed(self, raw: str):
+        """Принимает весь накопленный сырой текст модели."""
+        self.raw = raw
+        await self._render(final=False)
+
+    async def finish(self, text: str | None = None):
+        """
+        Дорисовывает ответ без троттлинга. Если итоговый текст (уже в HTML)
+        отличается от потокового — например, сработал веб-поиск, — заменяет им
+        всё, что было показано.
+        """
+        if text is not None and text != self.fmt(self.raw.strip()):
+            for mid in self.message_ids[1:]:
+                try:
+                    await bot.delete_message(self.chat_id, mid)
+                except TelegramBadRequest:
+                    pass
+            self.message_ids = self.message_ids[:1]
+            self.current_id = self.message_ids[0] if self.message_ids else None
+            self.shown = ""
+            self.fmt = lambda s: s
+            self.raw, self.base = text, 0
+        else:
+            self.raw = self.raw.strip()
+        await self._render(final=True)
+
+    def _cut_point(self, seg: str) -> int:
+        """Где разрезать сырой текст, чтобы отформатированная голова влезла в лимит."""
+        limit = min(len(seg), TELEGRAM_MSG_LIMIT)
+        while limit > 1:
+            window = seg[:limit]
+            cut = limit
+            for sep in ("\n\n", "\n", ". ", " "):
+                pos = window.rfind(sep)
+                if pos > 0:
+                    cut = pos + len(sep)
+                    break
+            # не режем внутри блока кода
+            if window[:cut].count("```") % 2:
+                fence = window.rfind("```", 0, cut)
+                if fence > 0:
+                    cut = fence
+            if len(self.fmt(seg[:cut])) <= TELEGRAM_MSG_LIMIT:
+                return cut
+            limit = min(limit - 1, int(cut * 0.9))
+        return max(1, limit)
+
+    async def _render(self, final: bool):
+        seg = self.raw[self.base:]
+        while len(self.fmt(seg.strip())) > TELEGRAM_MSG_LIMIT:
+            cut = self._cut_point(seg)
+            await self._show(self.fmt(seg[:cut].strip()), force=True)
+            self.base += cut
+            self.current_id, self.shown = None, ""
+            seg = self.raw[self.base:]
+
+        html = self.fmt(seg.strip())
+        if not final and self.current_id is not None:
+            if time.monotonic() < self.next_edit or len(html) - len(self.shown) < STREAM_MIN_GROWTH:
+                return
+        await self._show(html, force=final)
+
+    async def _show(self, html: str, force: bool):
+        if not html or html == self.shown:
+            return
+        while True:
+            try:
+                if self.current_id is None:
+                    msg = await self._send(html)
+                    self.current_id = msg.message_id
+                    self.message_ids.append(msg.message_id)
+                else:
+                    await self._edit(html)
+                self.shown = html
+                self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+                return
+            except TelegramRetryAfter as e:
+                self.next_edit = time.monotonic() + e.retry_after
+                if not force:
+                    return
+                await asyncio.sleep(e.retry_after)
+
+    async def _send(self, html: str):
+        try:
+            return await bot.send_message(self.chat_id, html, parse_mode="HTML", **self.send_kwargs)
+        except TelegramBadRequest:
+            return await bot.send_message(self.chat_id, _plain(html), parse_mode=None, **self.send_kwargs)
+
+    async def _edit(self, html: str):
+        try:
+            await bot.edit_message_text(html, chat_id=self.chat_id, message_id=self.current_id, parse_mode="HTML")
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                return
+            try:
+                await bot.edit_message_text(_plain(html), chat_id=self.chat_id, message_id=self.current_id, parse_mode=None)
+            except TelegramBadRequest as e2:
+                if "not modified" not in str(e2):
+                    raise
+
+def _plain(html: str) -> str:
+    """HTML-разметка ответа → простой текст (если Telegram не принял теги)."""
+    return unescape(re.sub(r"<[^>]+>", "", html))
+
+class GeminiStreamInterrupted(Exception):
+    """Поток оборвался после первых фрагментов — такой запрос планировщик не повторяет."""
+
+async def stream_gemini_text(conversation: list, reply: StreamedReply, uid=None) -> str:
+    """Генерирует ответ потоково, по ходу дела обновляя reply. Возвращает сырой текст."""
+    async def run() -> str:
+        parts: list[str] = []
+        try:
+            resp = await model.generate_content_async(conversation, stream=True)
+            async for chunk in resp:
+                try:
+                    piece = chunk.text
+                except ValueError:
+                    # пустой или заблокированный кандидат — пропускаем
+                    continue
+                if piece:
+                    parts.append(piece)
+                    await reply.feed("".join(parts))
+        except GEMINI_RETRYABLE as e:
+            # часть ответа уже в чате: повтор начал бы поток заново в тот же reply
+            if parts:
+                raise GeminiStreamInterrupted(str(e)) from e
+            raise
+        return "".join(parts).strip()
+
+    # слот планировщика держим, пока идёт поток
+    return await gemini_scheduler.submit(run, uid=uid, timed=False)
+
 def parse_quiz_questions(text: str) -> list[dict]:
     """
     Парсит текст квиза в формате:
@@ -3898,38 +5894,105 @@ async def get_unsplash_image_url(prompt: str, access_key: str) -> str:
         return None
     url = f"https://api.unsplash.com/photos/random?query={prompt}&client_id={access_key}"
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    logging.exception(f"Unsplash returned status {response.status} for prompt '{prompt}'")
-                    return None
-                data = await response.json()
-                if "urls" not in data or "regular" not in data["urls"]:
-                    logging.exception(f"No 'regular' URL in response for '{prompt}': {data}")
-                    return None
-                return data["urls"]["regular"]
+        async with http_client.session.get(url) as response:
+            if response.status != 200:
+                logging.exception(f"Unsplash returned status {response.status} for prompt '{prompt}'")
+                return None
+            data = await response.json()
+            if "urls" not in data or "regular" not in data["urls"]:
+                logging.exception(f"No 'regular' URL in response for '{prompt}': {data}")
+                return None
+            return data["urls"]["regular"]
     except Exception as e:
         logging.exception(f"Ошибка при получении изображения: {e}")
     return None
 
-def fallback_translate_to_english(rus_word: str) -> str:
-    try:
-        project_id = "gen-lang-client-0588633435"
-        location = "global"
-        parent = f"projects/{project_id}/locations/{location}"
-        response = translate_client.translate_text(
-            parent=parent,
-            contents=[rus_word],
-            mime_type="text/plain",
-            source_language_code="ru",
-            target_language_code="en",
-        )
-        return response.translations[0].translated_text
-    except Exception as e:
-        logging.exception(f"Ошибка при переводе слова '{rus_word}': {e}")
-        return rus_word
+# ---------------------- Перевод ru→en ---------------------- #
+TRANSLATE_PARENT = "projects/gen-lang-client-0588633435/locations/global"
+TRANSLATE_BATCH_WINDOW = 0.01  # сек: запросы, пришедшие за это время, уходят одним вызовом
+TRANSLATE_BATCH_SIZE = 100
+TRANSLATE_CACHE_MAX_LEN = 64  # запоминаем только слова и короткие фразы
+
+class Translator:
+    """
+    Перевод ru→en через асинхронный клиент Cloud Translation.
+    Сначала смотрим RU_EN_DICT и уже выученные переводы (хранятся через persist),
+    остальные запросы копятся TRANSLATE_BATCH_WINDOW и уходят одним contents=[...].
+    """
 
-async def generate_short_caption(rus_word: str) -> str:
+    def __init__(self, seed: dict[str, str], learned: dict[str, str]):
+        self.seed = seed
+        self.learned = learned
+        self.hits = 0
+        self.misses = 0
+        self.calls = 0
+        self._client = None
+        self._pending: dict[str, list[asyncio.Future]] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    @property
+    def client(self):
+        # grpc-канал привязан к event loop, поэтому создаём клиент уже внутри него
+        if self._client is None:
+            self._client = translate.TranslationServiceAsyncClient(credentials=credentials)
+        return self._client
+
+    async def translate(self, text: str) -> str | None:
+        """Перевод или None, если сервис недоступен."""
+        key = " ".join(text.lower().split())
+        if not key:
+            return text
+        cached = self.seed.get(key) or self.learned.get(key)
+        if cached:
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        # одинаковые строки в одном окне отправляются одним элементом contents
+        self._pending.setdefault(key, []).append(fut)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return await fut
+
+    async def _flush_later(self):
+        await asyncio.sleep(TRANSLATE_BATCH_WINDOW)
+        batch, self._pending = self._pending, {}
+        self._flush_task = None
+        keys = list(batch)
+        for i in range(0, len(keys), TRANSLATE_BATCH_SIZE):
+            chunk = keys[i:i + TRANSLATE_BATCH_SIZE]
+            self.calls += 1
+            try:
+                response = await self.client.translate_text(
+                    parent=TRANSLATE_PARENT,
+                    contents=chunk,
+                    mime_type="text/plain",
+                    source_language_code="ru",
+                    target_language_code="en",
+                )
+                results = [t.translated_text for t in response.translations]
+            except Exception as e:
+                logging.exception(f"[TRANSLATE] Ошибка перевода {len(chunk)} строк: {e}")
+                results = [None] * len(chunk)
+            for key, translated in zip(chunk, results):
+                if translated and len(key) <= TRANSLATE_CACHE_MAX_LEN:
+                    self.learned[key] = translated
+                    save_translations(key)
+                for fut in batch[key]:
+                    if not fut.done():
+                        fut.set_result(translated)
+
+def save_translations(key: str | None = None):
+    persist.mark_dirty("translations", key)
+
+translations_learned: dict[str, str] = load_collection("translations", {})
+translator = Translator(RU_EN_DICT, translations_learned)
+
+async def fallback_translate_to_english(rus_word: str) -> str:
+    return await translator.translate(rus_word) or rus_word
+
+async def generate_short_caption(rus_word: str, uid=None) -> str:
     short_prompt = (
         "ИНСТРУКЦИЯ: Ты — творческий помощник, который умеет писать очень короткие, дружелюбные подписи "
         "на русском языке. Не упоминай, что ты ИИ или Google. Старайся не превышать 15 слов.\n\n"
@@ -3937,16 +6000,16 @@ async def generate_short_caption(rus_word: str) -> str:
         "Можно с лёгкой эмоцией или юмором, не более 15 слов."
     )
     try:
-        response = await model.generate_content_async([
+        response = await gemini_generate([
             {"role": "user", "parts": [short_prompt]}
-        ])
+        ], uid=uid, profile="caption")
         caption = format_gemini_response(response.text.strip())
         return caption
     except Exception as e:
         logging.error(f"[BOT] Error generating short caption: {e}")
         return rus_word.capitalize()
 
-def parse_russian_show_request(user_text: str):
+async def parse_russian_show_request(user_text: str):
     lower_text = user_text.lower()
     triggered = any(trig in lower_text for trig in IMAGE_TRIGGERS_RU)
     if not triggered:
@@ -3969,23 +6032,11 @@ def parse_russian_show_request(user_text: str):
         leftover = re.sub(pattern_remove, "", user_text, flags=re.IGNORECASE).strip()
     else:
         leftover = user_text
-    RU_EN_DICT_CUSTOM = {
-        "обезьяна": "monkey",
-        "тигр": "tiger",
-        "кошка": "cat",
-        "собака": "dog",
-        "пейзаж": "landscape",
-        "чайка": "seagull",
-        "париж": "paris",
-        "утконос": "platypus",
-        "пудель": "poodle",
-        "медоед": "honey badger"
-    }
-    if rus_word in RU_EN_DICT_CUSTOM:
-        en_word = RU_EN_DICT_CUSTOM[rus_word]
-    else:
-        en_word = fallback_translate_to_english(rus_word)
-    return (True, rus_word, en_word, leftover) if rus_word else (False, "", "", user_text)
+    if not rus_word:
+        return (False, "", "", user_text)
+    # RU_EN_DICT проверяется внутри translator
+    en_word = await fallback_translate_to_english(rus_word)
+    return (True, rus_word, en_word, leftover)
 
 
 # ──────────────────────────────────────────────────────────────────────
@@ -4028,8 +6079,8 @@ async def handle_msg(
         )
 
         try:
-            resp = await model.generate_content_async(
-                [{"role": "user", "parts": [prompt]}]
+            resp = await gemini_generate(
+                [{"role": "user", "parts": [prompt]}], uid=message.from_user.id
             )
             raw_answer = resp.text.strip()
         except Exception as e:
@@ -4049,8 +6100,10 @@ async def handle_msg(
 
             # Шаги
             for idx, (latex_step, _h, explain_raw) in enumerate(steps, 1):
-                img_path = latex_to_png(_sanitize_for_png(latex_step))
+                step_latex = _sanitize_for_png(latex_step)
+                img_path = latex_to_png(step_latex)
                 step_imgs.append(img_path)
+                step_key = FileIdCache.content_key("latex", step_latex)
 
                 # Чистим текст пояснения
                 cleaned_lines = [
@@ -4067,21 +6120,27 @@ async def handle_msg(
                 caption = f"<b>Шаг {idx}.</b>\n{explain}"
                 if len(caption) > 1024:
                     # Если слишком длинный caption
-                    await bot.send_photo(
+                    await send_cached_photo(
                         cid,
-                        FSInputFile(img_path, "step.png", **thread_kwargs(message)),
+                        Path(img_path).read_bytes(),
+                        "step.png",
+                        key=step_key,
                         caption=f"<b>Шаг {idx}</b>",
                         parse_mode="HTML",
-                        reply_to_message_id=message.message_id
+                        reply_to_message_id=message.message_id,
+                        **thread_kwargs(message)
                     )
                     await safe_send(cid, explain, reply_to=message.message_id, message=message)
                 else:
-                    await bot.send_photo(
+                    await send_cached_photo(
                         cid,
-                        FSInputFile(img_path, "step.png", **thread_kwargs(message)),
+                        Path(img_path).read_bytes(),
+                        "step.png",
+                        key=step_key,
                         caption=caption,
                         parse_mode="HTML",
-                        reply_to_message_id=message.message_id
+                        reply_to_message_id=message.message_id,
+                        **thread_kwargs(message)
                     )
 
             # Итоговая формула
@@ -4089,17 +6148,15 @@ async def handle_msg(
             if all_latex:
                 final_latex = all_latex[-1].strip()
                 if final_latex not in {l for l, _, _ in steps}:
-                    try:
-                        final_img = latex_to_png(_sanitize_for_png(final_latex))
-                        await bot.send_photo(
-                            cid,
-                            FSInputFile(final_img, "result.png", **thread_kwargs(message)),
-                            caption="🏁 <b>Итог</b>",
-                            parse_mode="HTML",
-                            reply_to_message_id=message.message_id
-                        )
-                    finally:
-                        os.remove(final_img)
+                    await send_latex_photo(
+                        cid,
+                        _sanitize_for_png(final_latex),
+                        "result.png",
+                        caption="🏁 <b>Итог</b>",
+                        parse_mode="HTML",
+                        reply_to_message_id=message.message_id,
+                        **thread_kwargs(message)
+                    )
 
             # Общая доска
             if step_imgs:
@@ -4113,18 +6170,19 @@ async def handle_msg(
                         board.paste(ImageOps.expand(im, border=10, fill="white"), (0, y))
                         y += im.height + 20
 
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-                        board.save(tmp.name)
-                        await bot.send_photo(
-                            cid,
-                            FSInputFile(tmp.name, "board.png", **thread_kwargs(message)),
-                            caption="🟢 Общий вид решения",
-                            parse_mode="HTML"
-                        )
+                    buf = BytesIO()
+                    board.save(buf, format="PNG")
+                    await send_cached_photo(
+                        cid,
+                        buf.getvalue(),
+                        "board.png",
+                        caption="🟢 Общий вид решения",
+                        parse_mode="HTML",
+                        **thread_kwargs(message)
+                    )
                 finally:
                     for p in step_imgs:
                         os.remove(p)
-                    os.remove(tmp.name)
 
             # Голосовой ответ
             if voice_response_requested:
@@ -4153,7 +6211,7 @@ async def handle_msg(
                     **thread_kwargs(message)
                 )
             for p in imgs:
-                await bot.send_photo(cid, FSInputFile(p, "latex_part.png", **thread_kwargs(message)))
+                await send_cached_photo(cid, Path(p).read_bytes(), "latex_part.png", **thread_kwargs(message))
                 os.remove(p)
         return
 
@@ -4177,7 +6235,7 @@ async def handle_msg(
         )
 
     # --- «покажи …» (Unsplash) -----------------------------------------
-    show_image, rus_word, image_en, leftover = parse_russian_show_request(user_input)
+    show_image, rus_word, image_en, leftover = await parse_russian_show_request(user_input)
     if show_image and rus_word:
         leftover = re.sub(r"\b(вай|vai)\b", "", leftover, flags=re.IGNORECASE).strip()
 
@@ -4188,9 +6246,12 @@ async def handle_msg(
         image_en, UNSPLASH_ACCESS_KEY
     ) if show_image else None
 
-    # ответ Gemini
+    # ответ Gemini: текстовый ответ без картинки показываем по мере генерации
+    reply = None
+    if not voice_response_requested and not image_url:
+        reply = StreamedReply(cid, **thread_kwargs(message))
     gemini_text = await generate_and_send_gemini_response(
-        cid, full_prompt, show_image, rus_word, leftover
+        cid, full_prompt, show_image, rus_word, leftover, stream_to=reply, uid=message.from_user.id
     )
 
     # --- если нужен voice‑ответ ----------------------------------------
@@ -4200,25 +6261,29 @@ async def handle_msg(
 
     # --- отправляем результат ------------------------------------------
     if image_url:
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(image_url) as r:
-                if r.status == 200:
-                    tmp_path = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg").name
-                    with open(tmp_path, "wb") as f:
-                        f.write(await r.read())
-                    try:
-                        await bot.send_chat_action(cid, "upload_photo")
-                        caption, rest = split_caption_and_text(gemini_text or "…")
-                        await bot.send_photo(
-                            cid,
-                            FSInputFile(tmp_path, "image.jpg", **thread_kwargs(message)),
-                            caption=caption or "…",
-                            **thread_kwargs(message)
-                        )
-                        for c in rest:
-                            await bot.send_message(cid, c, **thread_kwargs(message))
-                    finally:
-                        os.remove(tmp_path)
+        async def download_image() -> bytes:
+            async with http_client.session.get(image_url) as r:
+                r.raise_for_status()
+                return await r.read()
+
+        try:
+            await bot.send_chat_action(cid, "upload_photo")
+            caption, rest = split_caption_and_text(gemini_text or "…")
+            # одна и та же картинка Unsplash скачивается и загружается в Telegram один раз
+            await send_cached_photo(
+                cid,
+                download_image,
+                "image.jpg",
+                key=FileIdCache.content_key("url", image_url),
+                caption=caption or "…",
+                **thread_kwargs(message)
+            )
+            for c in rest:
+                await bot.send_message(cid, c, **thread_kwargs(message))
+        except Exception as e:
+            logging.warning(f"[UNSPLASH] Не удалось отправить картинку: {e}")
+    elif reply is not None and reply.delivered:
+        pass
     elif gemini_text:
         for chunk in split_smart(gemini_text, TELEGRAM_MSG_LIMIT):
             await message.answer( chunk, parse_mode="HTML", **thread_kwargs(message))
@@ -4232,8 +6297,22 @@ async def group_show_request(message: Message):
     user_input = message.text.strip()
     await handle_msg(message, recognized_text=user_input, voice_response_requested=False)
 
-async def generate_and_send_gemini_response(cid, full_prompt, show_image, rus_word, leftover):
+async def _deliver_streamed(reply: StreamedReply | None, text: str) -> str:
+    """Для потокового режима — дописывает/заменяет показанный ответ итоговым текстом."""
+    if reply is not None:
+        await reply.finish(text)
+    return text
+
+async def generate_and_send_gemini_response(cid, full_prompt, show_image, rus_word, leftover,
+                                            stream_to: StreamedReply | None = None, uid=None):
+    """
+    Ответ Gemini с fallback в веб-поиск.
+    Если передан stream_to, ответ сразу показывается в чате по мере генерации;
+    вызывающему коду остаётся проверить stream_to.delivered.
+    uid — автор запроса для справедливой очереди (по умолчанию чат).
+    """
     gemini_text = ""
+    uid = cid if uid is None else uid
     analysis_keywords = [
         "почему", "зачем", "на кого", "кто", "что такое", "влияние",
         "философ", "отрицал", "повлиял", "смысл", "экзистенциализм", "опроверг"
@@ -4248,18 +6327,20 @@ async def generate_and_send_gemini_response(cid, full_prompt, show_image, rus_wo
 
     # … короткий путь для картинок, если нужно …
     if show_image and rus_word and not leftover:
-        return await generate_short_caption(rus_word)
+        return await generate_short_caption(rus_word, uid=uid)
 
-    # строим контекст
-    conversation = chat_history.setdefault(cid, [])
-    conversation.append({"role": "user", "parts": [full_prompt]})
-    if len(conversation) > 8:
-        conversation.pop(0)
+    # строим контекст: краткое содержание + свежие реплики + вопрос
+    conversation = chat_memory.build(cid, full_prompt)
 
     try:
         await bot.send_chat_action(cid, "typing")
-        resp = await model.generate_content_async(conversation)
-        raw = resp.text.strip()
+        if stream_to is not None:
+            raw = await stream_gemini_text(conversation, stream_to, uid=uid)
+            blocked = not raw
+        else:
+            resp = await gemini_generate(conversation, uid=uid)
+            raw = resp.text.strip()
+            blocked = not resp.candidates or not raw
 
         # 1) если Gemini жалуется на устаревшие данные или на то, что это будущее — fallback в Google
         low = raw.lower()
@@ -4271,112 +6352,166 @@ async def generate_and_send_gemini_response(cid, full_prompt, show_image, rus_wo
             "еще не наступила",
         )):
             logging.info("[GEMINI] нет актуальных данных → web_search fallback")
-            facts = web_search(full_prompt)
+            facts = await web_search(full_prompt)
             fb = (
                 "У меня есть результаты веб-поиска по запросу:\n"
                 f"{facts}\n\n"
                 f"На их основе дай развёрнутый ответ на вопрос:\n{full_prompt}"
             )
-            conversation.append({"role": "user", "parts": [fb]})
-            resp2 = await model.generate_content_async(conversation)
+            # выдача поиска идёт только в этот запрос, в историю её не кладём
+            resp2 = await gemini_generate(conversation + [{"role": "user", "parts": [fb]}], uid=uid)
             raw = resp2.text.strip()
             logging.info("[GEMINI] получил ответ по фактам")
 
         # 2) если модель вообще ничего не сгенерировала или блокирована
-        if not resp.candidates or not raw:
+        if blocked:
             logging.warning("[GEMINI] неизвестный ответ или блокировка → web_search прямой")
-            snippets = web_search(full_prompt)
+            snippets = await web_search(full_prompt)
             if snippets:
-                return f"Я не смог найти ответ в своих данных, вот что нашёл в Google:\n{snippets}"
+                return await _deliver_streamed(stream_to, f"Я не смог найти ответ в своих данных, вот что нашёл в Google:\n{snippets}")
             else:
-                return "❌ Не удалось найти информацию в Google."
+                return await _deliver_streamed(stream_to, "❌ Не удалось найти информацию в Google.")
 
         # 3) форматируем и сохраняем в историю
         gemini_text = format_gemini_response(raw)
-        conversation.append({"role": "model", "parts": [raw]})
-        if len(conversation) > 8:
-            conversation.pop(0)
+        chat_memory.record(cid, full_prompt, raw)
 
         # 4) если в готовом геми́ни-тексте модель извиняется/говорит «не знаю» — на всякий случай тоже WebSearch
         low2 = gemini_text.lower()
         unknown_triggers = ["извин", "не знаю", "не могу дать", "не могу ответить", "нет информации", "у меня нет сведений", "у меня нет данных", "это дата находится в будущем", "ещё не произошло", "дата еще не наступила", "до моего последнего обновления"]
         if any(phr in low2 for phr in unknown_triggers):
             logging.info("[GEMINI] ответ содержит «не знаю» → веб-поиск fallback")
-            snippets = web_search(full_prompt)
+            snippets = await web_search(full_prompt)
             if snippets:
-                return f"Похоже, я не уверен в ответе. Вот что нашёл через Google:\n{snippets}"
+                return await _deliver_streamed(stream_to, f"Похоже, я не уверен в ответе. Вот что нашёл через Google:\n{snippets}")
 
+    except google_exceptions.ResourceExhausted as e:
+        # квота исчерпана — веб-поиск только добавил бы нагрузки
+        logging.warning(f"[BOT] Gemini перегружен: {e}")
+        try:
+            return await _deliver_streamed(stream_to, "⏳ Сейчас слишком много запросов, попробуйте через минуту.")
+        except Exception:
+            return "⏳ Сейчас слишком много запросов, попробуйте через минуту."
     except Exception as e:
         logging.error(f"[BOT] Ошибка Gemini/fallback: {e}")
         # на ошибку тоже пробуем веб-поиск
-        snippets = web_search(full_prompt)
-        if snippets:
-            return f"Произошла ошибка при генерации, но вот что нашёл в Google:\n{snippets}"
-        return "⚠️ Ошибка при генерации ответа."
+        snippets = await web_search(full_prompt)
+        try:
+            if snippets:
+                return await _deliver_streamed(stream_to, f"Произошла ошибка при генерации, но вот что нашёл в Google:\n{snippets}")
+            return await _deliver_streamed(stream_to, "⚠️ Ошибка при генерации ответа.")
+        except Exception as e2:
+            logging.error(f"[BOT] Не удалось дописать потоковый ответ: {e2}")
+            return "⚠️ Ошибка при генерации ответа."
 
-    return gemini_text
+    return await _deliver_streamed(stream_to, gemini_text)
 
 async def vocab_reminder_loop():
     while True:
-        now = datetime.utcnow()
-        for uid, vocab in user_vocab.items():
-            if not vocab_reminders_enabled.get(str(uid), True):
-                continue
-            for entry in vocab:
-                last = datetime.fromisoformat(entry.get("last_reviewed", now.isoformat()))
-                level = entry.get("review_level", 0)
-                interval_days = [0, 1, 2, 4, 7, 14, 30]
-                interval = interval_days[min(level, len(interval_days) - 1)]
-                if (now - last).days >= interval:
-                    try:
-                        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                            [
-                                InlineKeyboardButton(text="✅ Помню", callback_data="review_remember"),
-                                InlineKeyboardButton(text="❌ Не помню", callback_data="review_forget")
-                            ]
-                        ])
-                        await bot.send_message(uid,
-                            f"🔁 Пора повторить слово: <b>{entry['word']}</b>\n"
-                            f"{entry['meaning']}\n<i>{entry['example']}</i>",
-                            reply_markup=keyboard,
-                            parse_mode="HTML"
-                        )
-                        break  # только одно напоминание за цикл
-                    except Exception as e:
-                        logging.exception(f"[VOCAB_REMINDER] Ошибка при отправке: {e}")
-                    break
+        # из индекса берём только созревшие слова; по каждому пользователю — самое старое
+        first_due: dict[int, dict] = {}
+        for uid, entry in vocab_due_index.due(datetime.utcnow()):
+            if uid not in first_due and vocab_reminders_enabled.get(str(uid), True):
+                first_due[uid] = entry
+        for uid, entry in first_due.items():
+            try:
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                    [
+                        InlineKeyboardButton(text="✅ Помню", callback_data="review_remember"),
+                        InlineKeyboardButton(text="❌ Не помню", callback_data="review_forget")
+                    ]
+                ])
+                await bot.send_message(uid,
+                    f"🔁 Пора повторить слово: <b>{entry['word']}</b>\n"
+                    f"{entry['meaning']}\n<i>{entry['example']}</i>",
+                    reply_markup=keyboard,
+                    parse_mode="HTML"
+                )
+            except Exception as e:
+                logging.exception(f"[VOCAB_REMINDER] Ошибка при отправке: {e}")
         await asyncio.sleep(3600)  # проверяем раз в час
 
-async def reminder_loop():
-    global reminders
-    import pytz
-    from datetime import datetime
-    while True:
-        now_utc = datetime.utcnow().replace(tzinfo=pytz.utc)
-        to_send = []
-        to_remove = []
+# ---------------------- Планировщик напоминаний ---------------------- #
+class ReminderScheduler:
+    """
+    Мин-куча напоминаний, упорядоченная по datetime_utc.
+    Цикл спит ровно до ближайшего напоминания и просыпается раньше,
+    если добавили напоминание, которое наступит раньше текущего ближайшего.
+    Удалённые и изменённые напоминания из кучи не вычищаются: при срабатывании
+    проверяем, что кортеж всё ещё лежит в reminders.
+    """
 
-        for i, (user_id, remind_dt_utc, note_text) in enumerate(reminders):
-            if remind_dt_utc <= now_utc:
-                to_send.append((user_id, note_text))
-                to_remove.append(i)
+    def __init__(self):
+        self._heap: list[tuple[datetime, int, tuple]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def rebuild(self, items: list[tuple]):
+        self._heap = [(item[1], next(self._seq), item) for item in items]
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    def schedule(self, item: tuple):
+        heapq.heappush(self._heap, (item[1], next(self._seq), item))
+        if self._heap[0][2] is item:
+            # новое напоминание раньше всех остальных — будим цикл
+            self._wakeup.set()
+
+    def pop_due(self, now: datetime) -> list[tuple]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    async def wait_next(self):
+        timeout = None
+        if self._heap:
+            now_utc = datetime.now(pytz.utc)
+            timeout = max((self._heap[0][0] - now_utc).total_seconds(), 0)
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
 
-        for i in reversed(to_remove):
-            reminders.pop(i)
-        if to_remove:
-            save_reminders()
+reminder_scheduler = ReminderScheduler()
 
-        for user_id, text in to_send:
-            try:
-                if "войс" in text.lower() or "голосом" in text.lower():
-                    await send_voice_message(user_id, f"🔔 Напоминание!\n{text}", message=message)
-                else:
-                    await bot.send_message(user_id, f"🔔 Напоминание!\n{text}", **thread_kwargs(message))
-            except Exception as e:
-                logging.exception(f"[REMINDER] Не удалось отправить напоминание: {e}")
+async def deliver_reminder(user_id: int, text: str, late: bool = False):
+    prefix = "🔔 Напоминание (пока я был недоступен)!" if late else "🔔 Напоминание!"
+    try:
+        if "войс" in text.lower() or "голосом" in text.lower():
+            await send_voice_message(user_id, f"{prefix}\n{text}")
+        else:
+            await bot.send_message(user_id, f"{prefix}\n{text}")
+    except Exception as e:
+        logging.exception(f"[REMINDER] Не удалось отправить напоминание: {e}")
 
-        
-        await asyncio.sleep(30)  # каждые 30 секунд проверяем
+def take_due_reminders(now_utc: datetime) -> list[tuple]:
+    """Снимает наступившие напоминания из кучи и из reminders."""
+    fired = []
+    for item in reminder_scheduler.pop_due(now_utc):
+        try:
+            reminders.remove(item)
+        except ValueError:
+            continue  # напоминание уже удалили или изменили
+        fired.append(item)
+    for user_id in {item[0] for item in fired}:
+        save_reminders(user_id)
+    return fired
+
+async def reminder_loop():
+    reminder_scheduler.rebuild(reminders)
+
+    # Догоняем всё, что наступило, пока бот был выключен
+    missed = take_due_reminders(datetime.now(pytz.utc))
+    if missed:
+        logging.info(f"[REMINDER] Доставляем пропущенные напоминания: {len(missed)}")
+        await asyncio.gather(*(deliver_reminder(user_id, text, late=True) for user_id, _, text in missed))
+
+    while True:
+        await reminder_scheduler.wait_next()
+        for user_id, _, text in take_due_reminders(datetime.now(pytz.utc)):
+            await deliver_reminder(user_id, text)
 
 # ---------------------- Запуск бота ---------------------- #
 async def main():
@@ -4385,10 +6520,26 @@ async def main():
     BOT_ID = me.id
     BOT_USERNAME = me.username
     
+    await http_client.start()
+    persist.start()
     asyncio.create_task(reminder_loop())
     asyncio.create_task(vocab_reminder_loop())
-    
-    await dp.start_polling(bot)
+    asyncio.create_task(rates_service.run())
+    broadcast_engine.resume()
+    exercise_bank.warm()
+    if len(word_pool.words) < WORD_POOL_LOW_WATERMARK:
+        word_pool.refill()
+    content_cache.warm(
+        [("dialogue", topic, "") for topic in DIALOGUE_TOPICS]
+        + [(kind, "", level) for kind in ("course", "course_more") for level in EXERCISE_LEVELS]
+    )
+
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # при остановке сбрасываем всё, что ещё не записано
+        await persist.close()
+        await http_client.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
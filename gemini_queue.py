@@ -0,0 +1,159 @@
+"""
+Планировщик запросов к Gemini.
+Все обращения идут через одну очередь: внутри приоритета пользователи
+обслуживаются по кругу, число одновременных запросов подстраивается по схеме
+AIMD (+1/limit за успех, ×0.5 на 429 или слишком медленный ответ).
+Модуль не зависит от SDK Gemini: какие исключения повторять, передаётся снаружи.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+GEMINI_MIN_CONCURRENCY = 1
+GEMINI_MAX_CONCURRENCY = 12
+GEMINI_START_CONCURRENCY = 4
+GEMINI_SLOW_SECONDS = 25.0
+GEMINI_DECREASE_COOLDOWN = 2.0
+GEMINI_MAX_RETRIES = 3
+GEMINI_BACKOFF_BASE = 1.0
+GEMINI_BACKOFF_MAX = 20.0
+
+class _GeminiJob:
+    __slots__ = ("fn", "uid", "priority", "timed", "future", "attempt")
+
+    def __init__(self, fn, uid, priority: int, timed: bool, future: asyncio.Future):
+        self.fn = fn
+        self.uid = uid
+        self.priority = priority
+        self.timed = timed
+        self.future = future
+        self.attempt = 0
+
+class GeminiScheduler:
+    """
+    retryable — исключения, после которых запрос повторяется с экспоненциальной
+    задержкой и лимит параллельности уменьшается; throttled — те из них, что
+    означают 429 (считаются отдельно для статистики).
+    """
+
+    def __init__(self, retryable: tuple[type[BaseException], ...] = (),
+                 throttled: tuple[type[BaseException], ...] = ()):
+        self.retryable = retryable
+        self.throttled_errors = throttled
+        # priority → uid → очередь заданий этого пользователя
+        self.queues: list[OrderedDict] = [OrderedDict(), OrderedDict()]
+        self.limit = float(GEMINI_START_CONCURRENCY)
+        self.inflight = 0
+        self.last_decrease = 0.0
+        self.completed = 0
+        self.throttled = 0
+        self.retries = 0
+
+    async def submit(self, fn, uid=None, priority: int = PRIORITY_INTERACTIVE, timed: bool = True):
+        """
+        Ставит в очередь fn (корутинную функцию без аргументов, делающую один
+        запрос к Gemini) и ждёт её результата. timed=False — для потоковых
+        ответов, длительность которых не говорит о перегрузке.
+        """
+        job = _GeminiJob(fn, uid, priority, timed, asyncio.get_running_loop().create_future())
+        self._enqueue(job)
+        self._pump()
+        return await job.future
+
+    def queued(self) -> int:
+        return sum(len(dq) for q in self.queues for dq in q.values())
+
+    def _enqueue(self, job: _GeminiJob, front: bool = False):
+        q = self.queues[job.priority]
+        dq = q.get(job.uid)
+        if dq is None:
+            dq = q[job.uid] = deque()
+        if front:
+            dq.appendleft(job)
+        else:
+            dq.append(job)
+
+    def _next(self) -> _GeminiJob | None:
+        for q in self.queues:
+            while q:
+                uid, dq = next(iter(q.items()))
+                job = dq.popleft()
+                if dq:
+                    q.move_to_end(uid)
+                else:
+                    del q[uid]
+                if not job.future.done():  # ожидающий мог уже отмениться
+                    return job
+        return None
+
+    def _pump(self):
+        while self.inflight < int(self.limit):
+            job = self._next()
+            if job is None:
+                return
+            self.inflight += 1
+            asyncio.create_task(self._run(job))
+
+    def _increase(self):
+        self.limit = min(GEMINI_MAX_CONCURRENCY, self.limit + 1 / self.limit)
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease >= GEMINI_DECREASE_COOLDOWN:
+            self.limit = max(GEMINI_MIN_CONCURRENCY, self.limit / 2)
+            self.last_decrease = now
+
+    def _requeue(self, job: _GeminiJob):
+        self._enqueue(job, front=True)
+        self._pump()
+
+    async def _run(self, job: _GeminiJob):
+        started = time.monotonic()
+        try:
+            result = await job.fn()
+        except self.retryable as e:
+            if isinstance(e, self.throttled_errors):
+                self.throttled += 1
+            self._decrease()
+            self.inflight -= 1
+            if job.attempt < GEMINI_MAX_RETRIES and not job.future.done():
+                job.attempt += 1
+                self.retries += 1
+                cap = min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** job.attempt)
+                delay = cap / 2 + random.uniform(0, cap / 2)
+                logging.warning(f"[GEMINI] {type(e).__name__}, повтор #{job.attempt} через {delay:.1f} с")
+                asyncio.get_running_loop().call_later(delay, self._requeue, job)
+            elif not job.future.done():
+                job.future.set_exception(e)
+            self._pump()
+            return
+        except BaseException as e:
+            self.inflight -= 1
+            if not job.future.done():
+                if isinstance(e, asyncio.CancelledError):
+                    job.future.cancel()
+                else:
+                    job.future.set_exception(e)
+            self._pump()
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        self.completed += 1
+        if job.timed and time.monotonic() - started > GEMINI_SLOW_SECONDS:
+            self._decrease()
+        else:
+            self._increase()
+        self.inflight -= 1
+        if not job.future.done():
+            job.future.set_result(result)
+        self._pump()
+
+    def stats_line(self) -> str:
+        return (f"• лимит {self.limit:.1f}, в работе {self.inflight}, в очереди {self.queued()}\n"
+                f"• выполнено {self.completed}, 429: {self.throttled}, повторов {self.retries}")
@@ -0,0 +1,344 @@
+"""
+Хранилище данных бота: JSON-файлы или SQLite (WAL) за слоем отложенной записи.
+Модуль не зависит от aiogram/Gemini, поэтому его можно проверять отдельно от бота.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+def write_file_atomic(path: Path, payload: str | bytes):
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    if isinstance(payload, bytes):
+        f = open(tmp_path, "wb")
+    else:
+        f = open(tmp_path, "w", encoding="utf-8")
+    with f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class StoredCollection:
+    """
+    Описание коллекции данных бота.
+    kind:
+      mapping     — dict «пользователь → значение» (одна строка на пользователя)
+      set         — множество id чатов
+      document    — цельный JSON-документ
+      reminders   — список кортежей (user_id, datetime_utc, text)
+      support_map — dict (chat_id, msg_id) → user_id
+    source() возвращает живой объект из памяти.
+    """
+
+    def __init__(self, name: str, path: Path, kind: str, source):
+        self.name = name
+        self.path = path
+        self.kind = kind
+        self.source = source
+
+    def to_json(self):
+        """Снимок коллекции в формате старого JSON-файла."""
+        obj = self.source()
+        if self.kind == "mapping":
+            return {str(k): v for k, v in obj.items()}
+        if self.kind == "set":
+            return list(obj)
+        if self.kind == "reminders":
+            return [
+                {"user_id": user_id, "datetime_utc": dt_obj.isoformat(), "text": text}
+                for (user_id, dt_obj, text) in obj
+            ]
+        if self.kind == "support_map":
+            return [[c, m, u] for (c, m), u in obj.items()]
+        return obj
+
+class JsonStorage:
+    """Старый формат: по одному JSON-файлу на коллекцию, каждый раз переписывается целиком."""
+
+    def load(self, coll: StoredCollection):
+        if not coll.path.exists():
+            return None
+        with open(coll.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def prepare(self, coll: StoredCollection, keys: set | None):
+        return json.dumps(coll.to_json(), ensure_ascii=False)
+
+    def write(self, coll: StoredCollection, payload: str):
+        write_file_atomic(coll.path, payload)
+
+class SqliteStorage:
+    """
+    SQLite в режиме WAL: по строке на пользователя/чат/напоминание,
+    поэтому изменение одного пользователя обновляет только его строки.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_data (
+            collection TEXT NOT NULL,
+            user_id    TEXT NOT NULL,
+            data       TEXT NOT NULL,
+            PRIMARY KEY (collection, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_user_data_user ON user_data(user_id);
+        CREATE TABLE IF NOT EXISTS reminders (
+            id       INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id  INTEGER NOT NULL,
+            due_utc  TEXT NOT NULL,
+            text     TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders(user_id);
+        CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders(due_utc);
+        CREATE TABLE IF NOT EXISTS chat_sets (
+            collection TEXT NOT NULL,
+            chat_id    INTEGER NOT NULL,
+            PRIMARY KEY (collection, chat_id)
+        );
+        CREATE TABLE IF NOT EXISTS support_map (
+            chat_id INTEGER NOT NULL,
+            msg_id  INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, msg_id)
+        );
+        CREATE TABLE IF NOT EXISTS documents (
+            collection TEXT PRIMARY KEY,
+            data       TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path: Path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+
+    def get_meta(self, key: str) -> str | None:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, value))
+
+    def load(self, coll: StoredCollection):
+        """Собирает коллекцию в формате старого JSON-файла (None — данных нет)."""
+        with self._lock:
+            return self._load(coll)
+
+    def _load(self, coll: StoredCollection):
+        if coll.kind == "mapping":
+            rows = self.conn.execute(
+                "SELECT user_id, data FROM user_data WHERE collection = ?", (coll.name,)
+            ).fetchall()
+            return {uid: json.loads(data) for uid, data in rows} if rows else None
+        if coll.kind == "set":
+            rows = self.conn.execute(
+                "SELECT chat_id FROM chat_sets WHERE collection = ?", (coll.name,)
+            ).fetchall()
+            return [r[0] for r in rows] if rows else None
+        if coll.kind == "reminders":
+            rows = self.conn.execute(
+                "SELECT user_id, due_utc, text FROM reminders ORDER BY due_utc"
+            ).fetchall()
+            return [{"user_id": u, "datetime_utc": d, "text": t} for u, d, t in rows] if rows else None
+        if coll.kind == "support_map":
+            rows = self.conn.execute("SELECT chat_id, msg_id, user_id FROM support_map").fetchall()
+            return [list(r) for r in rows] if rows else None
+        row = self.conn.execute(
+            "SELECT data FROM documents WHERE collection = ?", (coll.name,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def ops_from_json(coll: StoredCollection, doc) -> list[tuple[str, list]]:
+        """Операции полной замены коллекции содержимым doc (формат JSON-файла)."""
+        if coll.kind == "mapping":
+            return [
+                ("DELETE FROM user_data WHERE collection = ?", [(coll.name,)]),
+                ("INSERT INTO user_data(collection, user_id, data) VALUES (?, ?, ?)",
+                 [(coll.name, str(k), json.dumps(v, ensure_ascii=False)) for k, v in doc.items()]),
+            ]
+        if coll.kind == "set":
+            return [
+                ("DELETE FROM chat_sets WHERE collection = ?", [(coll.name,)]),
+                ("INSERT OR IGNORE INTO chat_sets(collection, chat_id) VALUES (?, ?)",
+                 [(coll.name, chat_id) for chat_id in doc]),
+            ]
+        if coll.kind == "reminders":
+            return [
+                ("DELETE FROM reminders", [()]),
+                ("INSERT INTO reminders(user_id, due_utc, text) VALUES (?, ?, ?)",
+                 [(r["user_id"], r["datetime_utc"], r["text"]) for r in doc]),
+            ]
+        if coll.kind == "support_map":
+            return [
+                ("DELETE FROM support_map", [()]),
+                ("INSERT OR REPLACE INTO support_map(chat_id, msg_id, user_id) VALUES (?, ?, ?)",
+                 [tuple(r) for r in doc]),
+            ]
+        return [("INSERT OR REPLACE INTO documents(collection, data) VALUES (?, ?)",
+                 [(coll.name, json.dumps(doc, ensure_ascii=False))])]
+
+    def prepare(self, coll: StoredCollection, keys: set | None) -> list[tuple[str, list]]:
+        """
+        Готовит SQL-операции в event loop (пока данные не меняются).
+        keys=None — полная перезапись коллекции, иначе только затронутые строки.
+        """
+        if keys is None or coll.kind == "document":
+            return self.ops_from_json(coll, coll.to_json())
+
+        obj = coll.source()
+        ops: list[tuple[str, list]] = []
+        if coll.kind == "mapping":
+            upserts = [(coll.name, str(k), json.dumps(obj[k], ensure_ascii=False)) for k in keys if k in obj]
+            deletes = [(coll.name, str(k)) for k in keys if k not in obj]
+            ops.append(("INSERT OR REPLACE INTO user_data(collection, user_id, data) VALUES (?, ?, ?)", upserts))
+            ops.append(("DELETE FROM user_data WHERE collection = ? AND user_id = ?", deletes))
+        elif coll.kind == "set":
+            ops.append(("INSERT OR IGNORE INTO chat_sets(collection, chat_id) VALUES (?, ?)",
+                        [(coll.name, k) for k in keys if k in obj]))
+            ops.append(("DELETE FROM chat_sets WHERE collection = ? AND chat_id = ?",
+                        [(coll.name, k) for k in keys if k not in obj]))
+        elif coll.kind == "reminders":
+            ops.append(("DELETE FROM reminders WHERE user_id = ?", [(k,) for k in keys]))
+            ops.append(("INSERT INTO reminders(user_id, due_utc, text) VALUES (?, ?, ?)",
+                        [(u, dt_obj.isoformat(), text) for (u, dt_obj, text) in obj if u in keys]))
+        elif coll.kind == "support_map":
+            ops.append(("INSERT OR REPLACE INTO support_map(chat_id, msg_id, user_id) VALUES (?, ?, ?)",
+                        [(c, m, obj[(c, m)]) for (c, m) in keys if (c, m) in obj]))
+            ops.append(("DELETE FROM support_map WHERE chat_id = ? AND msg_id = ?",
+                        [(c, m) for (c, m) in keys if (c, m) not in obj]))
+        return ops
+
+    def write(self, coll: StoredCollection, ops: list[tuple[str, list]]):
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                for sql, params in ops:
+                    if params:
+                        self.conn.executemany(sql, params)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+class WriteBehindStore:
+    """
+    Хранилище с отложенной записью: save_* только помечают коллекцию (или отдельные
+    ключи в ней) «грязной», а фоновая задача раз в flush_interval секунд
+    (или раньше, если набралось dirty_threshold изменений) сбрасывает изменения в backend.
+    Сама запись выполняется в отдельном потоке, чтобы не блокировать event loop.
+    """
+
+    def __init__(self, backend, flush_interval: float, dirty_threshold: int):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.dirty_threshold = dirty_threshold
+        self.collections: dict[str, StoredCollection] = {}
+        # имя коллекции → множество изменённых ключей (None — переписать целиком)
+        self._dirty: dict[str, set | None] = {}
+        self._dirty_count = 0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._closing = False
+
+    def register(self, name: str, path: Path, kind: str, source):
+        self.collections[name] = StoredCollection(name, path, kind, source)
+
+    def load(self, name: str):
+        return self.backend.load(self.collections[name])
+
+    def mark_dirty(self, name: str, key=None):
+        if key is None:
+            self._dirty[name] = None
+        elif name not in self._dirty:
+            self._dirty[name] = {key}
+        elif self._dirty[name] is not None:
+            self._dirty[name].add(key)
+        self._dirty_count += 1
+        if self._dirty_count >= self.dirty_threshold:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            self._dirty_count = 0
+            for name, keys in dirty.items():
+                coll = self.collections[name]
+                try:
+                    # Снимок делаем в event loop, чтобы коллекция не менялась во время сериализации
+                    payload = self.backend.prepare(coll, keys)
+                    await asyncio.to_thread(self.backend.write, coll, payload)
+                except Exception as e:
+                    logging.exception(f"[PERSIST] Не удалось сохранить {name}: {e}")
+                    self.mark_dirty(name)
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """
+        Останавливает фоновую задачу и делает финальный сброс.
+        Задачу не отменяем: отмена посреди flush() потеряла бы уже снятые с учёта
+        изменения, поэтому просим её выйти после текущего сброса и дожидаемся.
+        """
+        if self._task:
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+def import_json_files(storage: SqliteStorage, collections: dict[str, StoredCollection]) -> int:
+    """Разовый перенос старых JSON-файлов из DATA_DIR в SQLite. Возвращает число перенесённых файлов."""
+    json_storage = JsonStorage()
+    imported = 0
+    for coll in collections.values():
+        try:
+            doc = json_storage.load(coll)
+        except Exception as e:
+            logging.exception(f"[STORAGE] Не удалось прочитать {coll.path.name} при импорте: {e}")
+            continue
+        if doc is None:
+            continue
+        storage.write(coll, storage.ops_from_json(coll, doc))
+        imported += 1
+    storage.set_meta("json_imported", datetime.utcnow().isoformat())
+    logging.info(f"[STORAGE] Импортировано JSON-файлов в SQLite: {imported}")
+    return imported
+
+def export_json_files(storage: SqliteStorage, collections: dict[str, StoredCollection], target_dir: Path) -> int:
+    """Выгружает все коллекции из SQLite в JSON-файлы старого формата в target_dir."""
+    target_dir.mkdir(parents=True, exist_ok=True)
+    exported = 0
+    for coll in collections.values():
+        doc = storage.load(coll)
+        if doc is None:
+            continue
+        write_file_atomic(target_dir / coll.path.name, json.dumps(doc, ensure_ascii=False, indent=2))
+        exported += 1
+    return exported
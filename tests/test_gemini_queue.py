@@ -0,0 +1,175 @@
+import asyncio
+
+import pytest
+
+import gemini_queue
+from gemini_queue import GeminiScheduler, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+
+
+class Throttled(Exception):
+    """Аналог google_exceptions.ResourceExhausted (HTTP 429)."""
+
+
+class Unavailable(Exception):
+    """Аналог google_exceptions.ServiceUnavailable."""
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(gemini_queue, "GEMINI_BACKOFF_BASE", 0.001)
+    monkeypatch.setattr(gemini_queue, "GEMINI_BACKOFF_MAX", 0.01)
+
+
+def make_scheduler(limit: float | None = None) -> GeminiScheduler:
+    sched = GeminiScheduler((Throttled, Unavailable), throttled=(Throttled,))
+    if limit is not None:
+        sched.limit = float(limit)
+    return sched
+
+
+class FakeGemini:
+    """Поддельный вызов модели: отвечает по сценарию и записывает порядок и параллельность."""
+
+    def __init__(self, failures: int = 0, error=Throttled, sched: GeminiScheduler | None = None):
+        self.sched = sched
+        self.over_limit = False
+        self.failures = failures
+        self.error = error
+        self.calls: list[str] = []
+        self.active = 0
+        self.max_active = 0
+
+    def request(self, name: str):
+        async def call():
+            self.calls.append(name)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            if self.sched is not None and self.active > int(self.sched.limit):
+                self.over_limit = True
+            try:
+                await asyncio.sleep(0.001)
+                if self.failures:
+                    self.failures -= 1
+                    raise self.error("quota")
+                return f"ответ {name}"
+            finally:
+                self.active -= 1
+        return call
+
+
+def blocker(sched: GeminiScheduler):
+    """Занимает слот планировщика, пока не выставлено событие."""
+    release = asyncio.Event()
+
+    async def call():
+        await release.wait()
+        return "blocker"
+
+    task = asyncio.create_task(sched.submit(call, uid="blocker"))
+    return release, task
+
+
+def test_limit_halves_on_429_and_grows_back():
+    async def scenario():
+        sched = make_scheduler(limit=4)
+        gemini = FakeGemini(failures=1)
+
+        assert await sched.submit(gemini.request("a"), uid=1) == "ответ a"
+        assert sched.throttled == 1 and sched.retries == 1
+        assert sched.limit < 4
+        dropped = sched.limit
+
+        for i in range(20):
+            await sched.submit(gemini.request(f"b{i}"), uid=1)
+        assert sched.limit > dropped
+        assert sched.limit >= 4
+        return sched
+
+    sched = asyncio.run(scenario())
+    assert sched.limit <= gemini_queue.GEMINI_MAX_CONCURRENCY
+
+
+def test_inflight_never_exceeds_limit():
+    async def scenario():
+        sched = make_scheduler(limit=3)
+        gemini = FakeGemini(sched=sched)
+        await asyncio.gather(*(sched.submit(gemini.request(str(i)), uid=i % 4) for i in range(30)))
+        return gemini
+
+    gemini = asyncio.run(scenario())
+    assert not gemini.over_limit
+    assert 3 <= gemini.max_active <= gemini_queue.GEMINI_MAX_CONCURRENCY
+
+
+def test_retries_give_up_after_max_attempts():
+    async def scenario():
+        sched = make_scheduler(limit=2)
+        gemini = FakeGemini(failures=100, error=Unavailable)
+        with pytest.raises(Unavailable):
+            await sched.submit(gemini.request("x"), uid=1)
+        return sched, gemini
+
+    sched, gemini = asyncio.run(scenario())
+    assert len(gemini.calls) == gemini_queue.GEMINI_MAX_RETRIES + 1
+    assert sched.inflight == 0
+    assert sched.throttled == 0
+
+
+def test_non_retryable_error_fails_immediately():
+    async def scenario():
+        sched = make_scheduler(limit=2)
+        gemini = FakeGemini(failures=1, error=ValueError)
+        with pytest.raises(ValueError):
+            await sched.submit(gemini.request("x"), uid=1)
+        return sched, gemini
+
+    sched, gemini = asyncio.run(scenario())
+    assert gemini.calls == ["x"]
+    assert sched.limit == 2 and sched.inflight == 0
+
+
+def test_interactive_request_beats_background():
+    async def scenario():
+        sched = make_scheduler(limit=1)
+        gemini = FakeGemini()
+        release, blocked = blocker(sched)
+        await asyncio.sleep(0)
+        background = [
+            asyncio.create_task(sched.submit(gemini.request(f"bg{i}"), uid="warm", priority=PRIORITY_BACKGROUND))
+            for i in range(3)
+        ]
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(
+            sched.submit(gemini.request("user"), uid=42, priority=PRIORITY_INTERACTIVE)
+        )
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocked, interactive, *background)
+        return gemini
+
+    gemini = asyncio.run(scenario())
+    assert gemini.calls[0] == "user"
+
+
+def test_one_user_cannot_starve_another():
+    async def scenario():
+        sched = make_scheduler(limit=1)
+        gemini = FakeGemini()
+        release, blocked = blocker(sched)
+        await asyncio.sleep(0)
+        heavy = [asyncio.create_task(sched.submit(gemini.request(f"a{i}"), uid="a")) for i in range(5)]
+        await asyncio.sleep(0)
+        light = asyncio.create_task(sched.submit(gemini.request("b0"), uid="b"))
+        await asyncio.sleep(0)
+        release.set()
+        # держим лимит на одном слоте, чтобы порядок был строго последовательным
+        done = asyncio.gather(blocked, light, *heavy)
+        while not done.done():
+            sched.limit = 1.0
+            await asyncio.sleep(0)
+        await done
+        return gemini
+
+    gemini = asyncio.run(scenario())
+    assert gemini.calls.index("b0") == 1
+    assert gemini.calls[:3] == ["a0", "b0", "a1"]
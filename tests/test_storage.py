@@ -0,0 +1,191 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+
+import pytest
+
+from storage import JsonStorage, SqliteStorage, WriteBehindStore, export_json_files, import_json_files
+
+
+def make_store(tmp_path, backend, data):
+    """WriteBehindStore с коллекциями всех видов поверх словаря data."""
+    store = WriteBehindStore(backend, flush_interval=3600, dirty_threshold=1000)
+    store.register("notes", tmp_path / "notes.json", "mapping", lambda: data["notes"])
+    store.register("unique_users", tmp_path / "unique_users.json", "set", lambda: data["unique_users"])
+    store.register("stats", tmp_path / "stats.json", "document", lambda: data["stats"])
+    store.register("reminders", tmp_path / "reminders.json", "reminders", lambda: data["reminders"])
+    store.register("support_map", tmp_path / "support_map.json", "support_map", lambda: data["support_map"])
+    return store
+
+
+def sample_data():
+    return {
+        "notes": {1: ["купить хлеб"], 2: ["позвонить"]},
+        "unique_users": {10, 20},
+        "stats": {"messages_total": 5, "commands_used": {"/start": 2}},
+        "reminders": [(1, datetime(2030, 1, 1, 9, 0), "встреча")],
+        "support_map": {(100, 7): 1},
+    }
+
+
+class SlowSqliteStorage(SqliteStorage):
+    """Запись в БД занимает заметное время — чтобы остановка пришлась на середину сброса."""
+
+    def write(self, coll, ops):
+        time.sleep(0.2)
+        super().write(coll, ops)
+
+
+def test_close_flushes_pending_changes(tmp_path):
+    data = sample_data()
+    db = tmp_path / "bot.db"
+
+    async def scenario():
+        store = make_store(tmp_path, SqliteStorage(db), data)
+        store.start()
+        data["notes"][3] = ["новая заметка"]
+        store.mark_dirty("notes", 3)
+        store.mark_dirty("stats")
+        await store.close()
+        return store
+
+    store = asyncio.run(scenario())
+    reopened = SqliteStorage(db)
+    assert reopened.load(store.collections["notes"]) == {"3": ["новая заметка"]}
+    assert reopened.load(store.collections["stats"]) == data["stats"]
+
+
+def test_close_waits_for_flush_in_progress(tmp_path):
+    data = sample_data()
+    db = tmp_path / "bot.db"
+
+    async def scenario():
+        store = make_store(tmp_path, SlowSqliteStorage(db), data)
+        store.dirty_threshold = 1
+        store.start()
+        store.mark_dirty("notes", 1)
+        store.mark_dirty("unique_users", 10)
+        await asyncio.sleep(0.05)  # фоновая задача уже пишет первую коллекцию
+        await store.close()
+        return store
+
+    store = asyncio.run(scenario())
+    reopened = SqliteStorage(db)
+    assert reopened.load(store.collections["notes"]) == {"1": ["купить хлеб"]}
+    assert reopened.load(store.collections["unique_users"]) == [10]
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "json"])
+def test_crash_between_flushes_keeps_last_flushed_state(tmp_path, backend):
+    data = sample_data()
+
+    def open_backend():
+        return SqliteStorage(tmp_path / "bot.db") if backend == "sqlite" else JsonStorage()
+
+    async def scenario():
+        store = make_store(tmp_path, open_backend(), data)
+        for name in store.collections:
+            store.mark_dirty(name)
+        await store.flush()
+        # изменения после сброса до диска не доходят: процесс «падает» без close()
+        data["notes"][1].append("не успели сохранить")
+        store.mark_dirty("notes", 1)
+        data["reminders"].clear()
+        store.mark_dirty("reminders", 1)
+        return store
+
+    store = asyncio.run(scenario())
+    reopened = open_backend()
+    assert reopened.load(store.collections["notes"]) == {"1": ["купить хлеб"], "2": ["позвонить"]}
+    assert reopened.load(store.collections["reminders"]) == [
+        {"user_id": 1, "datetime_utc": "2030-01-01T09:00:00", "text": "встреча"}
+    ]
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_keyed_flush_touches_only_marked_rows(tmp_path):
+    data = sample_data()
+    db = tmp_path / "bot.db"
+
+    async def scenario():
+        store = make_store(tmp_path, SqliteStorage(db), data)
+        store.mark_dirty("notes")
+        await store.flush()
+        data["notes"][1] = ["изменено"]
+        data["notes"][2] = ["изменено, но не помечено"]
+        del data["notes"][1]
+        store.mark_dirty("notes", 1)
+        await store.flush()
+        return store
+
+    store = asyncio.run(scenario())
+    assert SqliteStorage(db).load(store.collections["notes"]) == {"2": ["позвонить"]}
+
+
+def write_json_files(tmp_path, data):
+    """Файлы в старом формате, как их писали прежние save_*."""
+    store = make_store(tmp_path, JsonStorage(), data)
+    for coll in store.collections.values():
+        store.backend.write(coll, store.backend.prepare(coll, None))
+    return store
+
+
+def read_json(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_json_import_is_idempotent(tmp_path):
+    store = write_json_files(tmp_path, sample_data())
+    db = SqliteStorage(tmp_path / "bot.db")
+
+    assert import_json_files(db, store.collections) == len(store.collections)
+    first = {name: db.load(coll) for name, coll in store.collections.items()}
+    assert import_json_files(db, store.collections) == len(store.collections)
+    second = {name: db.load(coll) for name, coll in store.collections.items()}
+
+    assert first == second
+    assert db.conn.execute("SELECT COUNT(*) FROM reminders").fetchone()[0] == 1
+    assert db.conn.execute("SELECT COUNT(*) FROM user_data").fetchone()[0] == 2
+    assert db.get_meta("json_imported")
+
+
+def test_export_matches_old_json_layout(tmp_path):
+    store = write_json_files(tmp_path, sample_data())
+    db = SqliteStorage(tmp_path / "bot.db")
+    import_json_files(db, store.collections)
+
+    out = tmp_path / "export"
+    assert export_json_files(db, store.collections, out) == len(store.collections)
+    for coll in store.collections.values():
+        original = read_json(coll.path)
+        exported = read_json(out / coll.path.name)
+        if coll.kind == "set":
+            original, exported = sorted(original), sorted(exported)
+        assert exported == original, coll.name
+
+
+def test_write_behind_round_trip_through_sqlite(tmp_path):
+    """Живые данные -> SQLite (построчные сбросы) -> экспорт == то, что записал бы JSON-бэкенд."""
+    data = sample_data()
+
+    async def scenario():
+        store = make_store(tmp_path, SqliteStorage(tmp_path / "bot.db"), data)
+        for name in store.collections:
+            store.mark_dirty(name)
+        await store.flush()
+        data["notes"][2].append("ещё одна")
+        store.mark_dirty("notes", 2)
+        data["unique_users"].discard(10)
+        store.mark_dirty("unique_users", 10)
+        data["support_map"][(100, 8)] = 2
+        store.mark_dirty("support_map", (100, 8))
+        await store.close()
+        return store
+
+    store = asyncio.run(scenario())
+    out = tmp_path / "export"
+    export_json_files(store.backend, store.collections, out)
+    for coll in store.collections.values():
+        assert read_json(out / coll.path.name) == coll.to_json(), coll.name